@@ -15,3 +15,10 @@ from apnsexceptions import *
 from connection import *
 from notifications import *
 from feedback import *
+from tokens import *
+from http2 import *
+from sharded import *
+from background import *
+from pacing import *
+from registry import *
+from journal import *
@@ -0,0 +1,510 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Non-blocking APNS connection and wrappers for Twisted reactor.
+Every I/O method returns Deferred instead of blocking. Requires
+Twisted and pyOpenSSL, so module is not imported by APNSWrapper
+package and should be imported explicitly:
+
+    from APNSWrapper.asynchronous import AsyncAPNSNotificationWrapper
+"""
+
+import collections
+import os
+import struct
+
+from twisted.internet import defer, protocol, reactor as default_reactor
+from twisted.internet import ssl, task
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+from apnsexceptions import *
+from connection import APNSConnectionContext
+from feedback import APNSFeedbackWrapper
+from http2 import _unpack
+from notifications import APNSNotificationWrapper, ERROR_RESPONSE_LENGTH
+
+
+__all__ = ('AsyncAPNSConnection', 'AsyncAPNSNotificationWrapper', \
+           'AsyncAPNSFeedbackWrapper')
+
+
+def _contextFactory(certificate):
+    """
+    Client TLS options with certificate and private key from PEM file
+    """
+    if not os.path.exists(str(certificate)):
+        raise APNSCertificateNotFoundError("Apple Push Notification "\
+            "Service Certificate file %s not found." % str(certificate))
+
+    fh = open(certificate, 'r')
+    try:
+        return ssl.PrivateCertificate.loadPEM(fh.read()).options()
+    finally:
+        fh.close()
+
+
+@implementer(IPushProducer)
+class APNSProtocol(protocol.Protocol):
+    """
+    One TLS connection to the APNS. Protocol is registered as producer
+    of its transport, so transport pauses it when write buffer is full
+    and .drain() waits until buffer is flushed.
+    """
+    paused = False
+    connected = False
+    failed = False
+
+    def __init__(self):
+        self.buffer = ""
+        self.waiting = []
+        self.pending = 0
+        # recently written data, see AsyncAPNSConnection.sentSize
+        self.sent = collections.deque()
+        self.sentLength = 0
+
+    def connectionMade(self):
+        self.connected = True
+        self.transport.registerProducer(self, True)
+        self.factory.connected(self)
+
+    def dataReceived(self, data):
+        self.buffer += data
+        self.factory.dataReceived(self)
+
+    def connectionLost(self, reason):
+        self.connected = False
+        waiting, self.waiting = self.waiting, []
+        for deferred in waiting:
+            deferred.errback(APNSConnectionError("Connection to APNS "\
+                                "lost: %s" % reason.getErrorMessage()))
+        self.factory.lost(self, reason)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        waiting, self.waiting = self.waiting, []
+        for deferred in waiting:
+            deferred.callback(None)
+
+    def stopProducing(self):
+        pass
+
+    def write(self, data):
+        """
+        Write data and return Deferred which fires when
+        transport is able to accept more data.
+        """
+        if not self.connected:
+            return defer.fail(APNSConnectionError("There is no "\
+                                            "connection to APNS."))
+        self.transport.write(data)
+        return self.drain()
+
+    def close(self):
+        # transport is closed only after its producer is unregistered
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
+
+    def drain(self):
+        if not self.paused:
+            return defer.succeed(None)
+
+        deferred = defer.Deferred()
+        self.waiting.append(deferred)
+        return deferred
+
+
+class APNSClientFactory(protocol.ReconnectingClientFactory):
+    """
+    Factory of one connection. If `reconnect` is True lost or failed
+    connection is opened again with jittered exponential backoff.
+    """
+    protocol = APNSProtocol
+    maxDelay = 30
+
+    def __init__(self, connection, reconnect=False):
+        self.connection = connection
+        self.reconnect = reconnect
+        self.deferred = defer.Deferred()
+        if not reconnect:
+            self.stopTrying()
+
+    def connected(self, proto):
+        self.resetDelay()
+        self.connection.connected(proto)
+        if self.deferred is not None:
+            self.deferred, deferred = None, self.deferred
+            deferred.callback(proto)
+
+    def dataReceived(self, proto):
+        self.connection.dataReceived(proto)
+
+    def lost(self, proto, reason):
+        self.connection.lost(proto, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        if self.continueTrying:
+            self.retry(connector)
+
+    def clientConnectionFailed(self, connector, reason):
+        if self.deferred is not None:
+            self.deferred, deferred = None, self.deferred
+            deferred.errback(reason)
+        if self.continueTrying:
+            self.retry(connector)
+
+
+class AsyncAPNSConnection(APNSConnectionContext):
+    """
+    Non-blocking connection to the APNS. Connection opens `connections`
+    TLS connections to the same host and spreads writes between them.
+    Not more than `concurrency` writes wait for drain of transport
+    buffers at the same time, other writes wait for their turn.
+    With reconnect=True lost connections are opened again.
+
+    Error-responses are passed to `onError` callback as (status,
+    identifier, data written to the same connection after the failed
+    frame), so caller may send that data again. Last `sentSize` bytes
+    written to every connection are kept for it, if the failed frame
+    is older, all kept data is passed. Connection which reported an
+    error is closed (gateway closes it anyway). Without `onError` last
+    `maxErrors` error-response packets are kept for .read().
+    """
+    sentSize = 1048576
+    maxErrors = 1000
+
+    def __init__(self, certificate=None, connections=1, concurrency=None, \
+                        reactor=None, reconnect=False, onError=None):
+        self.certificate = certificate
+        self.connections = connections
+        self.concurrency = concurrency or connections
+        self.reactor = reactor or default_reactor
+        self.reconnect = reconnect
+        self.onError = onError
+        self.contextFactory = _contextFactory(certificate)
+
+        self.semaphore = defer.DeferredSemaphore(self.concurrency)
+        self.factories = []
+        self.protocols = []
+        self.errors = collections.deque(maxlen=self.maxErrors)
+        self.closing = []
+        self.waiting = []
+
+    def connect(self, host, port):
+        """
+        Open all connections. Return Deferred which fires
+        when all connections are established.
+        """
+        deferreds = []
+        for i in xrange(self.connections):
+            factory = APNSClientFactory(self, self.reconnect)
+            self.factories.append(factory)
+            deferreds.append(factory.deferred)
+            self.reactor.connectSSL(host, port, factory, self.contextFactory)
+
+        return defer.gatherResults(deferreds, consumeErrors=True)\
+                                        .addCallback(lambda ignored: self)
+
+    def connected(self, proto):
+        self.protocols.append(proto)
+        waiting, self.waiting = self.waiting, []
+        for deferred in waiting:
+            deferred.callback(self)
+
+    def _alive(self):
+        return [p for p in self.protocols if p.connected and not p.failed]
+
+    def isConnected(self):
+        return len(self._alive()) > 0
+
+    def isBusy(self):
+        """
+        True if there is no connection with free transport buffer
+        """
+        return len([p for p in self._alive() if not p.paused]) == 0
+
+    def whenConnected(self):
+        """
+        Return Deferred which fires when at least one connection
+        is established.
+        """
+        if self.isConnected():
+            return defer.succeed(self)
+
+        deferred = defer.Deferred()
+        self.waiting.append(deferred)
+        return deferred
+
+    def _choose(self):
+        connected = self._alive()
+        if not connected:
+            raise APNSConnectionError("There is no connection to APNS.")
+
+        # prefer connections with free transport buffers
+        return min(connected, key=lambda p: (p.paused, p.pending))
+
+    def write(self, data=None):
+        """
+        Write data to the least loaded connection. Return Deferred
+        which fires when data accepted by transport buffer.
+        """
+        return self.semaphore.run(self._write, data)
+
+    def _write(self, data):
+        proto = self._choose()
+        proto.pending += 1
+
+        def done(result):
+            proto.pending -= 1
+            return result
+
+        if self.onError is not None:
+            proto.sent.append(data)
+            proto.sentLength += len(data)
+            while proto.sentLength - len(proto.sent[0]) >= self.sentSize:
+                proto.sentLength -= len(proto.sent.popleft())
+        return proto.write(data).addBoth(done)
+
+    def dataReceived(self, proto):
+        """
+        Parse error-response packets received from gateway
+        """
+        while len(proto.buffer) >= ERROR_RESPONSE_LENGTH:
+            packet = proto.buffer[:ERROR_RESPONSE_LENGTH]
+            proto.buffer = proto.buffer[ERROR_RESPONSE_LENGTH:]
+            if self.onError is None:
+                self.errors.append(packet)
+                continue
+
+            command, status, identifier = struct.unpack("!BBI", packet)
+            resend = self._sentAfter(proto, identifier)
+            if not proto.failed:
+                proto.failed = True
+                proto.close()
+            self.onError(status, identifier, resend)
+
+    def _sentAfter(self, proto, identifier):
+        """
+        Return data written to connection after the frame with
+        identifier and forget all written data. If there is no such
+        frame (or data is not parsed), return all data.
+        """
+        data = "".join(proto.sent)
+        proto.sent.clear()
+        proto.sentLength = 0
+
+        offset = 0
+        try:
+            while offset < len(data):
+                frame = _unpack(data, offset)
+                if frame is None:
+                    break
+                offset = frame[0]
+                if frame[3] == identifier:
+                    return data[offset:]
+        except (APNSValueError, struct.error):
+            pass
+        return data
+
+    def lost(self, proto, reason):
+        if proto in self.protocols:
+            self.protocols.remove(proto)
+
+        closing, self.closing = self.closing, []
+        for deferred in closing:
+            if not self.protocols:
+                deferred.callback(None)
+            else:
+                self.closing.append(deferred)
+
+    def readable(self, timeout=0):
+        return len(self.errors) > 0
+
+    def read(self, blockSize=ERROR_RESPONSE_LENGTH):
+        """
+        Return received error-response packet or empty string
+        """
+        if not self.errors:
+            return ""
+        return self.errors.popleft()
+
+    def context(self):
+        return self
+
+    def close(self):
+        """
+        Close all connections. Return Deferred which
+        fires when all connections are closed.
+        """
+        for factory in self.factories:
+            factory.stopTrying()
+        self.factories = []
+
+        if not self.protocols:
+            return defer.succeed(None)
+
+        deferred = defer.Deferred()
+        self.closing.append(deferred)
+        for proto in list(self.protocols):
+            proto.close()
+        return deferred
+
+
+class AsyncAPNSNotificationWrapper(APNSNotificationWrapper):
+    """
+    APNSNotificationWrapper which doesn't block reactor. Methods connect,
+    disconnect, notify, notify_stream, notify_raw, broadcast and recover
+    return Deferreds, which fire with the same values as blocking
+    methods of APNSNotificationWrapper.
+    """
+    def __init__(self, certificate=None, sandbox=True, connections=1, \
+                    concurrency=None, connection=None, reactor=None, **kwargs):
+        if connection is None:
+            connection = AsyncAPNSConnection(certificate, \
+                                connections, concurrency, reactor=reactor)
+
+        self.reactor = reactor or default_reactor
+        self.writes = []
+        APNSNotificationWrapper.__init__(self, certificate, sandbox=sandbox, \
+                                            connection=connection, **kwargs)
+
+    def connect(self):
+        """Make connections to APNS server"""
+        if self.sandbox != True:
+            apnsHost = self.apnsHost
+        else:
+            apnsHost = self.apnsSandboxHost
+
+        return self.connection.connect(apnsHost, self.apnsPort)
+
+    def disconnect(self):
+        """Close connections to APNS server"""
+        return self.connection.close()
+
+    def _write(self, data):
+        self.writes.append(self.connection.write(data))
+
+    def _gather(self, method, *args):
+        """
+        Run blocking method of the wrapper and return Deferred which
+        fires with its result when all written data is drained.
+        """
+        self.writes = []
+        try:
+            result = method(self, *args)
+        except Exception:
+            return defer.fail()
+
+        writes, self.writes = self.writes, []
+        return defer.gatherResults(writes, consumeErrors=True).addCallbacks(\
+                                    lambda ignored: result, _firstError)
+
+    def notify(self):
+        """
+        Send all queued notifications. Return Deferred.
+        """
+        return self._gather(APNSNotificationWrapper.notify)
+
+    def notify_stream(self, notifications=None):
+        return self._gather(APNSNotificationWrapper.notify_stream, \
+                                                            notifications)
+
+    def broadcast(self, template=None, tokens=None):
+        return self._gather(APNSNotificationWrapper.broadcast, \
+                                                        template, tokens)
+
+    def notify_raw(self, data=None, encoded_data=None):
+        return self._gather(APNSNotificationWrapper.notify_raw, \
+                                                        data, encoded_data)
+
+    def recover(self, timeout=1):
+        """
+        Wait `timeout` seconds for error-response. If APNS reported an
+        error, reconnect and resend frames sent after the failed one.
+        Return Deferred which fires with (status, identifier) or None.
+        """
+        def check(ignored):
+            error = self.read_error()
+            if error == None:
+                return None
+
+            resend = self._framesAfter(error[1])
+            deferred = defer.maybeDeferred(self.disconnect)
+            deferred.addCallback(lambda ignored: self.connect())
+            deferred.addCallback(lambda ignored: self._gather(\
+                        APNSNotificationWrapper._write_frames, resend))
+            return deferred.addCallback(lambda ignored: error)
+
+        return task.deferLater(self.reactor, timeout, check, None)
+
+
+def _firstError(failure):
+    """
+    Unwrap failure of the first failed write from gatherResults
+    """
+    failure.trap(defer.FirstError)
+    return failure.value.subFailure
+
+
+class FeedbackProtocol(protocol.Protocol):
+    def __init__(self):
+        self.data = []
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        self.factory.deferred.callback("".join(self.data))
+
+
+class FeedbackClientFactory(protocol.ClientFactory):
+    protocol = FeedbackProtocol
+
+    def __init__(self):
+        self.deferred = defer.Deferred()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.deferred.errback(reason)
+
+
+class AsyncAPNSFeedbackWrapper(APNSFeedbackWrapper):
+    """
+    APNSFeedbackWrapper which doesn't block reactor. Method receive
+    returns Deferred which fires with list of (datetime, deviceToken)
+    tuples when feedback service closes connection.
+    """
+    def __init__(self, certificate=None, sandbox=True, reactor=None):
+        self.reactor = reactor or default_reactor
+        self.contextFactory = _contextFactory(certificate)
+        self.sandbox = sandbox
+        self.feedbacks = []
+        self._currentTuple = 0
+        self._tuplesCount = 0
+
+    def receive(self):
+        if self.sandbox != True:
+            apnsHost = self.apnsHost
+        else:
+            apnsHost = self.apnsSandboxHost
+
+        factory = FeedbackClientFactory()
+        self.reactor.connectSSL(apnsHost, self.apnsPort, factory, \
+                                                    self.contextFactory)
+
+        def parse(reply):
+            self._parse_reply(reply)
+            return self.feedbacks
+
+        return factory.deferred.addCallback(parse)
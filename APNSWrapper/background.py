@@ -0,0 +1,222 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import Queue
+import threading
+
+from apnsexceptions import *
+from notifications import APNSNotification, APNSCompactNotification, \
+                            APNSNotificationWrapper
+
+
+__all__ = ('APNSBackgroundNotificationWrapper',)
+
+
+# marker which stops sender thread
+_STOP = object()
+
+
+class APNSBackgroundNotificationWrapper(APNSNotificationWrapper):
+    """
+    APNSNotificationWrapper which may be shared by many threads.
+    Method append only puts notification into bounded queue and
+    returns, background thread builds queued notifications and sends
+    them over persistent connection. When queue is full append blocks
+    (whenFull='block', up to `putTimeout` seconds) or drops notification
+    (whenFull='drop') and returns False. Methods flush and close wait
+    until all queued notifications are sent.
+
+    When send fails, connection is reopened and failed notifications
+    are counted in failedCount and passed with the error to `onError`
+    callback (called by sender thread), e.g. to queue them again.
+    """
+    BLOCK = 'block'
+    DROP = 'drop'
+
+    queueSize = 10000
+    batchSize = 1000    # max count of notifications sent at once
+
+    def __init__(self, certificate=None, sandbox=True, queueSize=10000, \
+                    whenFull='block', putTimeout=None, batchSize=1000, \
+                                                    onError=None, **kwargs):
+        if whenFull not in (self.BLOCK, self.DROP):
+            raise APNSValueError("Unexpected whenFull value. It should "\
+                            "be '%s' or '%s'." % (self.BLOCK, self.DROP))
+
+        APNSNotificationWrapper.__init__(self, certificate, sandbox=sandbox, \
+                                                                    **kwargs)
+        self.queue = Queue.Queue(queueSize)
+        self.whenFull = whenFull
+        self.putTimeout = putTimeout
+        self.batchSize = batchSize
+        self.onError = onError
+
+        self.lock = threading.Lock()
+        # connection is used by sender thread and flush
+        self.sending = threading.Lock()
+        self.thread = None
+        self.closed = False
+        self.broken = False
+        self.sentCount = 0
+        self.failedCount = 0
+        self.droppedCount = 0
+        self.error = None
+
+    def connect(self):
+        """
+        Make connection to APNS server and start sender thread
+        """
+        APNSNotificationWrapper.connect(self)
+        self.closed = False
+        self.broken = False
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._sender)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def append(self, payload=None):
+        """
+        Put notification into queue. Return False if
+        notification dropped because queue is full.
+        """
+        if not isinstance(payload, (APNSNotification, \
+                                        APNSCompactNotification)):
+            raise APNSTypeError("Unexpected argument type. Argument should "\
+                                "be an instance of APNSNotification object")
+
+        if self.thread is None:
+            raise APNSConnectionError("Sender thread is not started, "\
+                                        "call connect() first.")
+
+        if self.closed:
+            raise APNSConnectionError("Wrapper is closed, notification "\
+                                        "would not be sent.")
+
+        if self.compact and isinstance(payload, APNSNotification):
+            payload = payload.compact()
+
+        try:
+            self.queue.put(payload, self.whenFull == self.BLOCK, \
+                                                        self.putTimeout)
+        except Queue.Full:
+            with self.lock:
+                self.droppedCount += 1
+            return False
+        return True
+
+    def count(self):
+        """Get count of queued notifications
+        """
+        return self.queue.qsize()
+
+    def _batch(self):
+        """
+        Wait for notification and take all queued
+        ones, but not more than batchSize
+        """
+        batch = [self.queue.get()]
+        while len(batch) < self.batchSize:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _sender(self):
+        """
+        Background thread: send queued notifications
+        """
+        while True:
+            batch = self._batch()
+            notifications = [o for o in batch if o is not _STOP]
+
+            try:
+                if notifications:
+                    self._send(notifications)
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+
+            if len(notifications) != len(batch):
+                return
+
+    def _send(self, notifications):
+        """
+        Send batch, reopen connection and report if send failed
+        """
+        try:
+            with self.sending:
+                if self.broken:
+                    self._reconnect()
+                self.notify_stream(notifications)
+            self.sentCount += len(notifications)
+            return
+        except Exception, e:
+            logging.exception("Unable to send %d notifications" % \
+                                                        len(notifications))
+            self.failedCount += len(notifications)
+            self.error = e
+
+        with self.sending:
+            try:
+                self._reconnect()
+            except Exception:
+                logging.exception("Unable to reconnect to APNS")
+
+        if self.onError is not None:
+            try:
+                self.onError(self.error, notifications)
+            except Exception:
+                logging.exception("Error callback failed")
+
+    def _reconnect(self):
+        """
+        Reopen connection, sending lock should be held
+        """
+        self.broken = True
+        try:
+            self.disconnect()
+        except Exception:
+            pass
+        APNSNotificationWrapper.connect(self)
+        self.broken = False
+
+    def flush(self):
+        """
+        Wait until all queued notifications are sent
+        and flush connection
+        """
+        self.queue.join()
+        with self.sending:
+            self.connection.flush()
+
+    def notify(self):
+        """
+        Wait until all queued notifications are sent
+        """
+        self.flush()
+        return True
+
+    def close(self):
+        """
+        Send queued notifications, stop sender
+        thread and close connection.
+        """
+        self.closed = True
+        if self.thread is not None:
+            # stop marker is queued after all notifications
+            self.queue.put(_STOP)
+            self.thread.join()
+            self.thread = None
+
+        self.disconnect()
@@ -10,10 +10,16 @@
 # limitations under the License.
 
 import base64
+import collections
 import logging
 import os
+import random
+import select
 import socket
+import struct
 import subprocess
+import threading
+import time
 
 
 try:
@@ -26,7 +32,9 @@ from utils import *
 
 
 __all__ = ('APNSConnectionContext', 'OpenSSLCommandLine', \
-           'APNSConnection', 'APNSServiceConnection', 'SSLModuleConnection')
+           'APNSConnection', 'APNSServiceConnection', 'SSLModuleConnection', \
+           'APNSConnectionPool', 'APNSSSLContextCache', \
+           'APNSBufferedConnection', 'APNSResilientConnection')
 
 
 class APNSConnectionContext(object):
@@ -48,30 +56,81 @@ class APNSConnectionContext(object):
         raise APNSNotImplementedMethod("APNSConnectionContext.read method "\
                                         "not implemented")
 
+    def readable(self, timeout=0):
+        raise APNSNotImplementedMethod("APNSConnectionContext.readable "\
+                                        "method not implemented")
+
+    def sendBufferSize(self):
+        raise APNSNotImplementedMethod("APNSConnectionContext."\
+                                "sendBufferSize method not implemented")
+
+    def flush(self):
+        """
+        Push written data to the network, nothing to do by default.
+        """
+        pass
+
     def close(self):
         raise APNSNotImplementedMethod("APNSConnectionContext.close method "\
                                         "not implemented")
 
 
+# header of binary framing of APNSService: length of data and message id
+SERVICE_FRAME_HEADER = "!II"
+SERVICE_FRAME_HEADER_LENGTH = struct.calcsize(SERVICE_FRAME_HEADER)
+
+# max length of one message: notification frame or chunk of
+# frames written at once (see APNSNotificationWrapper.chunkSize)
+SERVICE_MAX_MESSAGE_LENGTH = 65536
+
+# status of acknowledge in binary framing, error text follows status byte
+SERVICE_ACK_OK, SERVICE_ACK_ERROR = (0, 1)
+
+
 class APNSServiceConnection(object):
     """
     Class which handle connection between local application
     and remote APNSService which provide possibility to
     send a lot of messages simultaneously and with one connection
     to real APNS
+
+    With framing='binary' connection asks service to switch to
+    length-prefixed binary frames instead of JSON lines with base64
+    encoded messages. With acks=True service acknowledges every message
+    after writing it to APNS (or reports error), acknowledges are read
+    while writing and not more than `window` messages wait for them.
+    If service doesn't answer in `negotiationTimeout` seconds (old
+    version of service) JSON lines without acknowledges are used.
     """
     WAITING, CONNECTED = (1, 2)
     NEWLINE = "\r\n"
-
-    def __init__(self, host='127.0.0.1', port=1025, bufsize=1024):
+    JSON, BINARY = ('json', 'binary')
+    negotiationTimeout = 1
+    window = 1000
+
+    def __init__(self, host='127.0.0.1', port=1025, bufsize=1024, \
+                                framing='json', acks=False, window=1000):
+        if framing not in (self.JSON, self.BINARY):
+            raise APNSValueError("Unexpected framing of service "\
+                "connection. It should be '%s' or '%s'." % (self.JSON, \
+                                                            self.BINARY))
         self.status = self.WAITING
         self.host = host
         self.port = port
         self.bufsize = bufsize
+        self.framing = framing
+        self.acks = acks
+        self.window = window
+        self.rest = ""
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        # ids of messages waiting for acknowledge
+        self.outstanding = set()
+        self.finished = []
+
+        # message ids start from 1, binary frame with id 0 has no id
         if not hasattr(self.__class__, '_connection'):
-            self.__class__._connection = 0
+            self.__class__._connection = 1
 
     def close(self):
         """
@@ -89,23 +148,149 @@ class APNSServiceConnection(object):
         if self.status == self.WAITING:
             self.sock.connect((self.host, self.port))
             self.status = self.CONNECTED
+            if self.framing == self.BINARY or self.acks:
+                self._negotiate()
 
         return self.sock
 
-    def write(self, data=None):
+    def _readline(self):
+        while self.NEWLINE not in self.rest:
+            self._recv()
+
+        line, self.rest = self.rest.split(self.NEWLINE, 1)
+        return line
+
+    def _recv(self):
+        data = self.sock.recv(self.bufsize)
+        if not data:
+            raise APNSConnectionError("Connection to APNS service "\
+                                                "closed by service.")
+        self.rest += data
+
+    def _negotiate(self):
         """
-        Send message to the internal APNS Service server, read
-        response and parse it to JSON
+        Ask service to switch to binary framing and/or acknowledges
         """
+        hello = {}
+        if self.framing == self.BINARY:
+            hello['framing'] = self.BINARY
+        if self.acks:
+            hello['acks'] = True
+
+        self.sock.sendall("%s%s" % (json.dumps(hello), self.NEWLINE))
+        self.sock.settimeout(self.negotiationTimeout)
+        try:
+            try:
+                reply = json.loads(self._readline())
+            except (socket.timeout, ValueError):
+                reply = {}
+        finally:
+            self.sock.settimeout(None)
+
+        if reply.get('framing') != self.BINARY:
+            self.framing = self.JSON
+        self.acks = bool(self.acks and reply.get('acks'))
+
+    def _nextId(self):
+        identifier = self.__class__._connection
+        self.__class__._connection = identifier % 0xffffffff + 1
+        return identifier
+
+    def _request(self, identifier, data):
+        if self.framing == self.BINARY:
+            return struct.pack(SERVICE_FRAME_HEADER, len(data), \
+                                                    identifier) + data
 
         request = {
         'message': base64.standard_b64encode(data),
-        'id': '#%d' % self.__class__._connection,
+        'id': '#%d' % identifier,
         }
+        return "%s%s" % (json.dumps(request), self.NEWLINE)
 
-        self.__class__._connection += 1
-        self.socket.send("%s%s" % (json.dumps(request), self.NEWLINE))
-        response = []
+    def write(self, data=None):
+        """
+        Send message to the internal APNS Service server.
+        Return id of the message.
+        """
+        return self.writeMany([data])[0]
+
+    def writeMany(self, messages):
+        """
+        Send many messages at once. Return list of their ids.
+        """
+        messages = list(messages)
+        for data in messages:
+            if len(data) > SERVICE_MAX_MESSAGE_LENGTH:
+                raise APNSValueError("Message to APNS service is longer "\
+                    "than %d bytes, use notify_stream to send it by "\
+                    "chunks." % SERVICE_MAX_MESSAGE_LENGTH)
+
+        sock = self.socket
+        ids = []
+
+        while messages:
+            count = len(messages)
+            if self.acks:
+                while len(self.outstanding) >= self.window:
+                    self._receive()
+                count = min(count, self.window - len(self.outstanding))
+
+            batch = [(self._nextId(), data) for data in messages[:count]]
+            messages = messages[count:]
+
+            if self.acks:
+                self.outstanding.update([i for i, data in batch])
+            sock.sendall("".join([self._request(i, data) \
+                                                for i, data in batch]))
+            ids.extend([i for i, data in batch])
+
+            if self.acks:
+                self._receive(block=False)
+
+        return ids
+
+    def _receive(self, block=True):
+        """
+        Read acknowledges sent by service
+        """
+        if not block and not select.select([self.sock], [], [], 0)[0]:
+            return
+        self._recv()
+
+        if self.framing == self.BINARY:
+            while len(self.rest) >= SERVICE_FRAME_HEADER_LENGTH:
+                length, identifier = struct.unpack_from(\
+                                        SERVICE_FRAME_HEADER, self.rest)
+                end = SERVICE_FRAME_HEADER_LENGTH + length
+                if len(self.rest) < end:
+                    break
+                body = self.rest[SERVICE_FRAME_HEADER_LENGTH:end]
+                self.rest = self.rest[end:]
+                self._ack(identifier, ord(body[0]) == SERVICE_ACK_OK, \
+                                                        body[1:] or None)
+        else:
+            while self.NEWLINE in self.rest:
+                line, self.rest = self.rest.split(self.NEWLINE, 1)
+                ack = json.loads(line)
+                self._ack(int(str(ack['id']).lstrip('#')), \
+                            ack.get('status') == 'ok', ack.get('error'))
+
+    def _ack(self, identifier, ok, error):
+        self.outstanding.discard(identifier)
+        self.finished.append((identifier, ok, error))
+
+    def results(self, wait=True):
+        """
+        Return list of (id, ok, error) tuples of acknowledged messages
+        since previous call. If `wait` is True wait for all outstanding
+        acknowledges.
+        """
+        while wait and self.outstanding:
+            self._receive()
+
+        finished = self.finished
+        self.finished = []
+        return finished
 
 
 class DummyConnection(APNSConnectionContext):
@@ -124,13 +309,20 @@ class DummyConnection(APNSConnectionContext):
     def read(self):
         logging.debug("    < Reading data from the stream")
 
+    def readable(self, timeout=0):
+        return False
+
     def close(self):
         logging.debug("    - Closing connection to the APNS service")
 
 
 class OpenSSLCommandLine(APNSConnectionContext):
     """
-    This class execute and send data with openssl command line tool
+    This class execute and send data with openssl command line tool.
+    By default new openssl process is started for every write. In
+    persistent mode `processes` openssl processes are kept alive with
+    open pipes, frames are streamed into them and dead processes are
+    restarted.
     """
 
     certificate = None
@@ -138,17 +330,34 @@ class OpenSSLCommandLine(APNSConnectionContext):
     port = None
     executable = None
     debug = False
+    persistent = False
+    processes = 1
+    outputSize = 1024   # count of stdout blocks kept for read
+    closeTimeout = 1    # seconds to wait for process to send data and exit
 
-    def __init__(self, certificate=None, executable=None, debug=False):
+    def __init__(self, certificate=None, executable=None, debug=False, \
+                                            persistent=False, processes=1):
         self.certificate = certificate
         self.executable = executable
         self.debug = debug
+        self.persistent = persistent
+        self.processes = processes
+
+        self.pipes = []
+        self.next = 0
+        self.restarts = 0
+        self.output = collections.deque(maxlen=self.outputSize)
+        self.outputReady = threading.Condition()
 
     def connect(self, host, port):
         self.host = host
         self.port = port
 
-    def _command(self):
+        if self.persistent:
+            self.close()
+            self.pipes = [self._start() for i in xrange(self.processes)]
+
+    def _arguments(self):
         command = "%(executable)s s_client -ssl3 -cert "\
                     "%(cert)s -connect %(host)s:%(port)s" % {
             'executable': self.executable,
@@ -157,13 +366,105 @@ class OpenSSLCommandLine(APNSConnectionContext):
             'port': self.port,
             }
 
-        return subprocess.Popen(command.split(' '), \
+        arguments = command.split(' ')
+        if self.persistent:
+            # -quiet implies -ign_eof, so lines of binary data which
+            # start with Q or R are not treated as s_client commands
+            arguments.append('-quiet')
+        return arguments
+
+    def _command(self):
+        return subprocess.Popen(self._arguments(), \
                             shell=False, bufsize=256, \
                             stdin=subprocess.PIPE, \
                             stdout=subprocess.PIPE, \
                             stderr=subprocess.PIPE)
 
+    def _start(self):
+        """
+        Start persistent openssl process and thread
+        which drains its standard output.
+        """
+        stderr = None
+        if not self.debug:
+            stderr = open(os.devnull, 'w')
+
+        pipe = subprocess.Popen(self._arguments(), shell=False, \
+                            stdin=subprocess.PIPE, \
+                            stdout=subprocess.PIPE, \
+                            stderr=stderr)
+        if stderr:
+            stderr.close()
+
+        reader = threading.Thread(target=self._drain, args=(pipe,))
+        reader.setDaemon(True)
+        reader.start()
+        return pipe
+
+    def _drain(self, pipe):
+        fd = pipe.stdout.fileno()
+        while True:
+            data = os.read(fd, 1024)
+            if not data:
+                break
+
+            with self.outputReady:
+                self.output.append(data)
+                self.outputReady.notifyAll()
+
+        pipe.stdout.close()
+
+    def _restart(self, index):
+        pipe = self.pipes[index]
+        self._stop(pipe)
+        self.pipes[index] = self._start()
+        self.restarts += 1
+        return self.pipes[index]
+
+    def _stop(self, pipe):
+        try:
+            pipe.stdin.close()
+        except IOError:
+            pass
+
+        # s_client with -quiet doesn't exit on end of input,
+        # so give it some time to send the rest of data
+        deadline = time.time() + self.closeTimeout
+        while pipe.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+
+        if pipe.poll() is None:
+            pipe.terminate()
+        pipe.wait()
+
+    def _writePersistent(self, data):
+        """
+        Write data to the next openssl process, restart process
+        if it's dead or broken pipe.
+        """
+        if not self.pipes:
+            raise APNSConnectionError("There is no openssl processes, "\
+                                            "call connect() first.")
+
+        index = self.next
+        self.next = (self.next + 1) % len(self.pipes)
+
+        pipe = self.pipes[index]
+        if pipe.poll() is not None:
+            pipe = self._restart(index)
+
+        try:
+            pipe.stdin.write(data)
+            pipe.stdin.flush()
+        except IOError:
+            pipe = self._restart(index)
+            pipe.stdin.write(data)
+            pipe.stdin.flush()
+
     def write(self, data=None):
+        if self.persistent:
+            return self._writePersistent(data)
+
         pipe = self._command()
 
         std_in = pipe.stdin
@@ -174,17 +475,35 @@ class OpenSSLCommandLine(APNSConnectionContext):
         std_out = pipe.stdout
         if self.debug:
             print "-------------- SSL Debug Output --------------"
-            print command
+            print " ".join(self._arguments())
             print "----------------------------------------------"
             print std_out.read()
             std_out.close()
         pipe.wait()
 
+    def readable(self, timeout=0):
+        if not self.persistent:
+            return APNSConnectionContext.readable(self, timeout)
+
+        with self.outputReady:
+            if not self.output:
+                self.outputReady.wait(timeout)
+            return len(self.output) > 0
+
     def read(self, blockSize=1024):
         """
         There is method to read data from feedback service.
         WARNING! It's not tested and doesn't work yet!
+        In persistent mode return data received from processes.
         """
+        if self.persistent:
+            with self.outputReady:
+                data = "".join(self.output)
+                self.output.clear()
+                if len(data) > blockSize:
+                    self.output.append(data[blockSize:])
+                return data[:blockSize]
+
         pipe = self._command()
         std_out = pipe.stdout
 
@@ -198,7 +517,67 @@ class OpenSSLCommandLine(APNSConnectionContext):
         return self
 
     def close(self):
-        pass
+        pipes, self.pipes = self.pipes, []
+        for pipe in pipes:
+            self._stop(pipe)
+
+
+class APNSSSLContextCache(object):
+    """
+    Cache of SSL contexts shared by connections with the same certificate,
+    so certificate is read and parsed only once. Count and time of
+    handshakes are collected.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def context(self, ssl_module, certificate):
+        """
+        Return shared SSLContext for the certificate. Context is
+        created again if certificate file was modified.
+        """
+        key = (certificate, os.path.getmtime(certificate))
+        with self.lock:
+            context = self.contexts.get(key)
+            if context is None:
+                context = ssl_module.SSLContext(ssl_module.PROTOCOL_SSLv23)
+                context.load_cert_chain(certificate)
+                self.contexts[key] = context
+            return context
+
+    def handshake(self, seconds):
+        """
+        Count handshake which took `seconds`
+        """
+        with self.lock:
+            self.handshakes += 1
+            self.handshakeTime += seconds
+
+    def stats(self):
+        """
+        Return dict with count of handshakes and
+        average handshake time in seconds.
+        """
+        with self.lock:
+            handshakes = self.handshakes
+            return {
+                'handshakes': handshakes,
+                'averageHandshakeTime': handshakes and \
+                                    self.handshakeTime / handshakes or 0.0,
+            }
+
+    def clear(self):
+        """
+        Forget all contexts and reset counters.
+        """
+        self.contexts = {}
+        self.handshakes = 0
+        self.handshakeTime = 0.0
+
+
+# SSL contexts shared by all connections of the process
+sslContextCache = APNSSSLContextCache()
 
 
 class SSLModuleConnection(APNSConnectionContext):
@@ -211,28 +590,55 @@ class SSLModuleConnection(APNSConnectionContext):
     certificate = None
     connectionContext = None
     ssl_module = None
+    contextCache = sslContextCache  # None disables shared SSL contexts
 
-    def __init__(self, certificate=None, ssl_module=None):
+    def __init__(self, certificate=None, ssl_module=None, noDelay=None, \
+                                                cork=None, sendBuffer=None):
         self.socket = None
         self.connectionContext = None
         self.certificate = certificate
         self.ssl_module = ssl_module
 
+        # socket options, None keeps system default
+        self.noDelay = noDelay
+        self.cork = cork and hasattr(socket, 'TCP_CORK')
+        self.sendBuffer = sendBuffer
+
+    def _shared(self):
+        """
+        Shared contexts require SSLContext (Python 2.7.9+)
+        """
+        return self.contextCache is not None and \
+                                hasattr(self.ssl_module, 'SSLContext')
+
     def context(self):
         """
-        Initialize SSL context.
+        Initialize SSL context. Socket with shared SSL
+        context is wrapped on connect.
         """
-        if self.connectionContext != None:
+        if self.connectionContext != None or self.socket != None:
             return self
 
         self.socket = socket.socket()
-        self.connectionContext = self.ssl_module.wrap_socket(\
-                    self.socket,
-                    ssl_version=self.ssl_module.PROTOCOL_SSLv3,
-                    certfile=self.certificate)
+        self._setOptions()
+        if not self._shared():
+            self.connectionContext = self.ssl_module.wrap_socket(\
+                        self.socket,
+                        ssl_version=self.ssl_module.PROTOCOL_SSLv3,
+                        certfile=self.certificate)
 
         return self
 
+    def _setOptions(self):
+        if self.noDelay is not None:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, \
+                                                        int(self.noDelay))
+        if self.cork:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        if self.sendBuffer:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, \
+                                                        self.sendBuffer)
+
     def certificate(self, path):
         self.certificate = path
         return self
@@ -244,6 +650,30 @@ class SSLModuleConnection(APNSConnectionContext):
 
         return self.connectionContext.read(blockSize)
 
+    def flush(self):
+        """
+        Send partial frames held by TCP_CORK right now.
+        """
+        if self.cork and self.socket:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+    def readable(self, timeout=0):
+        """
+        Wait up to `timeout` seconds for data available to read.
+        """
+        if self.connectionContext.pending():
+            return True
+
+        readable = select.select([self.connectionContext], [], [], timeout)[0]
+        return len(readable) > 0
+
+    def sendBufferSize(self):
+        """
+        Size of socket send buffer (SO_SNDBUF) in bytes.
+        """
+        return self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+
     def write(self, data=None):
         """
         Make connection to the host and port.
@@ -255,15 +685,25 @@ class SSLModuleConnection(APNSConnectionContext):
         """
         Make connection to the host and port.
         """
+        if self.connectionContext == None:
+            self.connectionContext = self.contextCache.context(\
+                    self.ssl_module, self.certificate).wrap_socket(self.socket)
 
+        started = time.time()
         self.connectionContext.connect((host, port))
 
+        if self._shared():
+            self.contextCache.handshake(time.time() - started)
+
     def close(self):
         """
         Close connection.
         """
         self.connectionContext.close()
         self.socket.close()
+        # new context will be initialized on next connect
+        self.connectionContext = None
+        self.socket = None
 
 
 class APNSConnection(APNSConnectionContext):
@@ -278,7 +718,12 @@ class APNSConnection(APNSConnectionContext):
                         ssl_command="openssl",
                         force_ssl_command=False,
                         disable_executable_search=False,
-                        debug=False):
+                        debug=False,
+                        persistent_ssl_command=False,
+                        ssl_command_processes=1,
+                        tcp_nodelay=None,
+                        tcp_cork=None,
+                        send_buffer_size=None):
         self.connectionContext = None
         self.debug = debug
 
@@ -294,7 +739,9 @@ class APNSConnection(APNSConnectionContext):
             # use ssl library to handle secure connection
             import ssl as ssl_module
             self.connectionContext = SSLModuleConnection(certificate, \
-                                        ssl_module=ssl_module)
+                                        ssl_module=ssl_module, \
+                                        noDelay=tcp_nodelay, cork=tcp_cork, \
+                                        sendBuffer=send_buffer_size)
         except:
             # use command line openssl tool to handle secure connection
             if not disable_executable_search:
@@ -307,7 +754,9 @@ class APNSConnection(APNSConnectionContext):
                                 "your PATH environment" % str(ssl_command))
 
             self.connectionContext = OpenSSLCommandLine(certificate, \
-                                                    executable, debug=debug)
+                                    executable, debug=debug, \
+                                    persistent=persistent_ssl_command, \
+                                    processes=ssl_command_processes)
 
         self.certificate = str(certificate)
 
@@ -328,6 +777,15 @@ class APNSConnection(APNSConnectionContext):
     def read(self, blockSize=1024):
         return self.context().read(blockSize)
 
+    def readable(self, timeout=0):
+        return self.context().readable(timeout)
+
+    def sendBufferSize(self):
+        return self.context().sendBufferSize()
+
+    def flush(self):
+        self.context().flush()
+
     def context(self):
         if not self.connectionContext:
             raise APNSNoSSLContextFound("There is no SSL context available "\
@@ -339,3 +797,620 @@ class APNSConnection(APNSConnectionContext):
         Close connection.
         """
         self.context().close()
+
+
+class APNSPooledConnection(object):
+    """
+    Connection of APNSConnectionPool with its usage statistics
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.active = 0
+        self.lastUsed = time.time()
+        self.alive = True
+
+
+class APNSConnectionPool(APNSConnectionContext):
+    """
+    Pool of warm connections to the same APNS host with the same
+    certificate. Writes are spread over connections round-robin or to
+    the least loaded one, dead connections are replaced in background.
+    Pool may be used as `connection` argument of APNSNotificationWrapper.
+    Use APNSConnectionPool.shared to get pool shared per certificate
+    and host by all wrappers of the process. Shared pool counts its
+    users: every .shared() call should be paired with one .close()
+    (APNSNotificationWrapper.disconnect), connections are closed when
+    the last user closes the pool.
+    """
+    ROUND_ROBIN = 'round-robin'
+    LEAST_LOADED = 'least-loaded'
+
+    _shared = {}
+    _sharedLock = threading.RLock()
+
+    def __init__(self, certificate=None, size=4, strategy='round-robin', \
+                    healthCheckInterval=30, factory=None):
+        if strategy not in (self.ROUND_ROBIN, self.LEAST_LOADED):
+            raise APNSValueError("Unexpected strategy of connection pool. "\
+                        "It should be '%s' or '%s'." % (self.ROUND_ROBIN, \
+                                                        self.LEAST_LOADED))
+
+        self.certificate = certificate
+        self.size = size
+        self.strategy = strategy
+        self.healthCheckInterval = healthCheckInterval
+        self.factory = factory or self._factory
+
+        self.host = None
+        self.port = None
+        self.connections = []
+        self.lock = threading.Lock()
+        self.next = 0
+        self.replaced = 0
+        self.references = 1
+
+        self.wakeup = threading.Event()
+        self.closed = threading.Event()
+        self.thread = None
+
+    @classmethod
+    def shared(cls, certificate, host, port, size=4, **kwargs):
+        """
+        Return connected pool shared by all callers with the
+        same certificate, host and port.
+        """
+        key = (certificate, host, port)
+        with cls._sharedLock:
+            pool = cls._shared.get(key)
+            if pool is None or pool.closed.is_set():
+                pool = cls(certificate, size=size, **kwargs)
+                pool.connect(host, port)
+                cls._shared[key] = pool
+            else:
+                pool.references += 1
+            return pool
+
+    def _factory(self):
+        return APNSConnection(certificate=self.certificate)
+
+    def _open(self):
+        connection = self.factory()
+        connection.connect(self.host, self.port)
+        return APNSPooledConnection(connection)
+
+    def connect(self, host, port):
+        """
+        Open `size` connections to the host and start maintenance
+        thread. Does nothing if pool already connected to the host.
+        """
+        with self.lock:
+            if self.connections and (self.host, self.port) == (host, port):
+                return self
+
+        self._close()
+        with self._sharedLock:
+            self.references = max(self.references, 1)
+        self.host = host
+        self.port = port
+        self.closed.clear()
+
+        connections = [self._open() for i in xrange(self.size)]
+        with self.lock:
+            self.connections = connections
+
+        self.thread = threading.Thread(target=self._maintain)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def resize(self, size):
+        """
+        Change count of connections. New connections are opened
+        right now, extra ones are closed after their current writes.
+        """
+        with self.lock:
+            self.size = size
+            extra = self.connections[size:]
+            self.connections = self.connections[:size]
+            missing = size - len(self.connections)
+            connected = self.host is not None and not self.closed.is_set()
+
+        if connected and missing > 0:
+            fresh = [self._open() for i in xrange(missing)]
+            with self.lock:
+                self.connections.extend(fresh)
+
+        for pooled in extra:
+            try:
+                with pooled.lock:
+                    pooled.connection.close()
+            except Exception:
+                pass
+        return self
+
+    def _choose(self):
+        """
+        Choose alive connection for next write
+        """
+        with self.lock:
+            alive = [c for c in self.connections if c.alive]
+            if not alive:
+                raise APNSConnectionError("There is no alive connections "\
+                            "in the pool to %s:%s" % (self.host, self.port))
+
+            if self.strategy == self.LEAST_LOADED:
+                chosen = min(alive, key=lambda c: (c.active, c.lastUsed))
+            else:
+                self.next = (self.next + 1) % len(alive)
+                chosen = alive[self.next]
+
+            chosen.active += 1
+            return chosen
+
+    def write(self, data=None):
+        """
+        Write data to one of connections. If write failed, connection
+        is marked as dead and data is written to another one.
+        """
+        for attempt in xrange(max(self.size, 1)):
+            pooled = self._choose()
+            try:
+                with pooled.lock:
+                    pooled.connection.write(data)
+                    pooled.lastUsed = time.time()
+                return
+            except (socket.error, IOError):
+                self._dead(pooled)
+            finally:
+                with self.lock:
+                    pooled.active -= 1
+
+        raise APNSConnectionError("Unable to write data to any connection "\
+                            "of the pool to %s:%s" % (self.host, self.port))
+
+    def _dead(self, pooled):
+        pooled.alive = False
+        self.wakeup.set()
+
+    def readable(self, timeout=0):
+        """
+        Wait up to `timeout` seconds for data on any connection
+        """
+        deadline = time.time() + timeout
+        while True:
+            for pooled in list(self.connections):
+                if pooled.alive and pooled.connection.readable(0):
+                    return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(min(0.01, timeout))
+
+    def read(self, blockSize=1024):
+        """
+        Read data from the first readable connection
+        """
+        for pooled in list(self.connections):
+            if pooled.alive and pooled.connection.readable(0):
+                with pooled.lock:
+                    return pooled.connection.read(blockSize)
+        return ""
+
+    def sendBufferSize(self):
+        return self.connections[0].connection.sendBufferSize()
+
+    def _check(self, pooled):
+        """
+        Idle connection of binary gateway should have nothing to read,
+        otherwise it's closed or got an error-response.
+        """
+        if not pooled.lock.acquire(False):
+            return
+        try:
+            if pooled.connection.readable(0):
+                pooled.alive = False
+        except Exception:
+            pooled.alive = False
+        finally:
+            pooled.lock.release()
+
+    def _maintain(self):
+        """
+        Background thread: check idle connections and
+        replace dead ones by new connections.
+        """
+        while not self.closed.is_set():
+            self.wakeup.wait(self.healthCheckInterval)
+            self.wakeup.clear()
+            if self.closed.is_set():
+                return
+
+            idle = time.time() - self.healthCheckInterval
+            for pooled in list(self.connections):
+                if pooled.alive and pooled.active == 0 \
+                                            and pooled.lastUsed < idle:
+                    self._check(pooled)
+
+            for pooled in list(self.connections):
+                if not pooled.alive:
+                    self._replace(pooled)
+
+    def _replace(self, pooled):
+        try:
+            fresh = self._open()
+        except Exception:
+            # gateway is not available, try on next check
+            return
+
+        with self.lock:
+            if pooled in self.connections:
+                self.connections[self.connections.index(pooled)] = fresh
+            self.replaced += 1
+
+        try:
+            with pooled.lock:
+                pooled.connection.close()
+        except Exception:
+            pass
+
+    def context(self):
+        return self
+
+    def close(self):
+        """
+        Release the pool. Maintenance thread is stopped and
+        connections are closed when there are no other users.
+        """
+        with self._sharedLock:
+            self.references -= 1
+            if self.references > 0:
+                return
+            self.references = 0
+            self.closed.set()
+
+        self._close()
+
+    def _close(self):
+        self.closed.set()
+        self.wakeup.set()
+        if self.thread and self.thread is not threading.currentThread():
+            self.thread.join()
+        self.thread = None
+
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+
+        for pooled in connections:
+            try:
+                pooled.connection.close()
+            except Exception:
+                pass
+
+
+class APNSBufferedConnection(APNSConnectionContext):
+    """
+    Write buffer on top of another connection. Small writes are
+    coalesced and written at once when buffer reaches `bufferSize`
+    bytes, when the oldest buffered write waits `flushDelay` seconds
+    or on explicit .flush(). Buffer is flushed before reading error
+    responses and on close. With flushDelay=None data is written
+    only by size or explicitly.
+    """
+    bufferSize = 16384  # maximal TLS record size
+    flushDelay = 0.01
+
+    def __init__(self, connection, bufferSize=16384, flushDelay=0.01):
+        self.connection = connection
+        self.certificate = getattr(connection, 'certificate', None)
+        self.bufferSize = bufferSize
+        self.flushDelay = flushDelay
+
+        self.buffer = []
+        self.buffered = 0
+        self.firstWrite = None
+        self.error = None
+        self.writes = 0
+        self.flushes = 0
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.closed = False
+        self.thread = None
+
+    def connect(self, host, port):
+        """
+        Make connection and start thread which flushes
+        buffer after `flushDelay` seconds. Data which was
+        not written because of error is kept in buffer.
+        """
+        self.connection.connect(host, port)
+        with self.lock:
+            self.closed = False
+            self.error = None
+            self.condition.notify()
+
+        if self.flushDelay and self.thread is None:
+            self.thread = threading.Thread(target=self._flusher)
+            self.thread.setDaemon(True)
+            self.thread.start()
+        return self
+
+    def _raise(self):
+        # error of background flush is raised by next call,
+        # after that background flushes are resumed
+        if self.error is not None:
+            error, self.error = self.error, None
+            self.condition.notify()
+            raise error
+
+    def write(self, data=None):
+        """
+        Append data to the buffer, write buffer if it's full.
+        """
+        with self.lock:
+            self._raise()
+            if not self.buffer:
+                self.firstWrite = time.time()
+                self.condition.notify()
+
+            self.buffer.append(data)
+            self.buffered += len(data)
+            self.writes += 1
+
+            if self.buffered >= self.bufferSize:
+                self._flush()
+
+    def _flush(self):
+        """
+        Write buffer to the connection, lock should be held.
+        Buffer is kept if write failed.
+        """
+        if not self.buffer:
+            return
+
+        data = "".join(self.buffer)
+        self.connection.write(data)
+
+        self.buffer = []
+        self.buffered = 0
+        self.firstWrite = None
+        self.flushes += 1
+        self.connection.flush()
+
+    def flush(self):
+        """
+        Write all buffered data right now.
+        """
+        with self.lock:
+            self._raise()
+            self._flush()
+
+    def _flusher(self):
+        """
+        Background thread: flush buffer when the
+        oldest buffered write is `flushDelay` seconds old.
+        """
+        with self.lock:
+            while not self.closed:
+                if not self.buffer:
+                    self.condition.wait()
+                    continue
+
+                wait = self.firstWrite + self.flushDelay - time.time()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+
+                try:
+                    self._flush()
+                except Exception, e:
+                    self.error = e
+                    # don't retry until error is reported
+                    self.condition.wait()
+
+    def readable(self, timeout=0):
+        self.flush()
+        return self.connection.readable(timeout)
+
+    def read(self, blockSize=1024):
+        self.flush()
+        return self.connection.read(blockSize)
+
+    def sendBufferSize(self):
+        return self.connection.sendBufferSize()
+
+    def context(self):
+        return self
+
+    def close(self):
+        """
+        Flush buffer, stop flushing thread and close connection.
+        """
+        try:
+            self.flush()
+        finally:
+            with self.lock:
+                self.closed = True
+                self.condition.notify()
+
+            if self.thread and self.thread is not threading.currentThread():
+                self.thread.join()
+            self.thread = None
+            self.connection.close()
+
+
+class APNSResilientConnection(APNSConnectionContext):
+    """
+    Connection which survives broken connections to the gateway. When
+    write fails (EPIPE, ECONNRESET, SSL EOF, dead openssl process)
+    connection is reopened with jittered exponential backoff and the
+    last written data (up to `inflightSize` bytes, which the gateway
+    may not have received) is written again, so delivery is
+    at-least-once. Data older than `inflightAge` seconds or checked
+    by readable(timeout) without error-response is considered
+    delivered and is not written again. APNSConnectionError is raised
+    after `retries` failed attempts to reconnect.
+    """
+    retries = 5
+    backoff = 0.5       # delay before second attempt, doubled every attempt
+    maxBackoff = 30
+    inflightSize = 65536
+    inflightAge = 1     # seconds, window of error-response
+
+    def __init__(self, connection, retries=5, backoff=0.5, maxBackoff=30, \
+                                        inflightSize=65536, inflightAge=1):
+        self.connection = connection
+        self.certificate = getattr(connection, 'certificate', None)
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.inflightSize = inflightSize
+        self.inflightAge = inflightAge
+
+        self.host = None
+        self.port = None
+        self.broken = False
+        # (time of write, data) of the last writes
+        self.inflight = collections.deque()
+        self.inflightBytes = 0
+        self.reconnects = 0
+        self.replayed = 0
+        self.lock = threading.RLock()
+
+    def connect(self, host, port):
+        self.host = host
+        self.port = port
+        self.connection.connect(host, port)
+        self.broken = False
+        return self
+
+    def _remember(self, data):
+        """
+        Keep data in in-flight buffer, drop the oldest data over limit
+        """
+        self.inflight.append((time.time(), data))
+        self.inflightBytes += len(data)
+        while self.inflightBytes > self.inflightSize and \
+                                                len(self.inflight) > 1:
+            self.inflightBytes -= len(self.inflight.popleft()[1])
+
+    def _expire(self, deadline):
+        """
+        Drop data written before `deadline`
+        """
+        while self.inflight and self.inflight[0][0] < deadline:
+            self.inflightBytes -= len(self.inflight.popleft()[1])
+
+    def _forget(self):
+        self.inflight.clear()
+        self.inflightBytes = 0
+
+    def _delay(self, attempt):
+        """
+        Full jitter: random delay up to exponentially growing limit
+        """
+        if attempt == 0:
+            return 0
+        return random.uniform(0, min(self.maxBackoff, \
+                                        self.backoff * 2 ** (attempt - 1)))
+
+    def _reconnect(self):
+        """
+        Reopen connection and replay in-flight data
+        """
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+        error = None
+        for attempt in xrange(self.retries):
+            time.sleep(self._delay(attempt))
+            try:
+                self.connection.connect(self.host, self.port)
+                for written, data in self.inflight:
+                    self.connection.write(data)
+            except (socket.error, IOError, APNSConnectionError), e:
+                error = e
+                try:
+                    self.connection.close()
+                except Exception:
+                    pass
+                continue
+
+            self.broken = False
+            self.reconnects += 1
+            self.replayed += len(self.inflight)
+            return
+
+        self.broken = True
+        raise APNSConnectionError("Unable to reconnect to %s:%s after %d "\
+                    "attempts: %s" % (self.host, self.port, self.retries, error))
+
+    def write(self, data=None):
+        """
+        Write data, reconnect and write again if connection is broken.
+        """
+        with self.lock:
+            self._expire(time.time() - self.inflightAge)
+            if self.broken:
+                self._reconnect()
+
+            self._remember(data)
+            try:
+                self.connection.write(data)
+                return
+            except (socket.error, IOError, APNSConnectionError):
+                self.broken = True
+
+            self._reconnect()
+
+    def readable(self, timeout=0):
+        """
+        Check for error-response. If there was no error-response
+        for `timeout` seconds, written data is considered delivered.
+        """
+        started = time.time()
+        try:
+            readable = self.connection.readable(timeout)
+        except (socket.error, IOError):
+            self.broken = True
+            return False
+
+        if not readable and timeout > 0:
+            with self.lock:
+                self._expire(started)
+        return readable
+
+    def read(self, blockSize=1024):
+        """
+        Read from connection, connection closed by gateway is
+        reopened on next write. Gateway closes connection after
+        error-response, so in-flight data is not replayed then:
+        failed notification should be found by wrapper.recover
+        """
+        try:
+            data = self.connection.read(blockSize)
+        except (socket.error, IOError):
+            data = ""
+
+        with self.lock:
+            self.broken = True
+            if data:
+                self._forget()
+        return data
+
+    def sendBufferSize(self):
+        return self.connection.sendBufferSize()
+
+    def flush(self):
+        self.connection.flush()
+
+    def context(self):
+        return self
+
+    def close(self):
+        with self.lock:
+            self._forget()
+            self.connection.close()
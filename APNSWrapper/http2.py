@@ -0,0 +1,389 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import binascii
+import socket
+import struct
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+from apnsexceptions import *
+from connection import APNSConnectionContext
+
+
+__all__ = ('HTTP2Connection',)
+
+
+# binary gateway hosts used by wrappers and their HTTP/2 provider API hosts
+HOSTS = {
+    'gateway.push.apple.com': 'api.push.apple.com',
+    'gateway.sandbox.push.apple.com': 'api.sandbox.push.apple.com',
+}
+
+
+class HTTP2Connection(APNSConnectionContext):
+    """
+    Connection to the APNS HTTP/2 provider API. Binary notification
+    frames written by APNSNotificationWrapper are split into separate
+    requests which are multiplexed as concurrent streams over one TLS
+    connection. Status of every request is available via .responses()
+
+    When server sends GOAWAY, streams it didn't process are sent
+    again over a new connection, streams it did process are waited
+    for until the server closes connection.
+
+    Requires h2 module. With secure=False connection talks HTTP/2
+    without TLS (prior knowledge), e.g. to the local testing server.
+    """
+    host = None
+    port = 443
+    topic = None
+    secure = True
+    maxConcurrentStreams = 100
+    blockSize = 65536
+
+    def __init__(self, certificate=None, topic=None, host=None, port=443, \
+                    secure=True, maxConcurrentStreams=100, ssl_context=None):
+        if h2 is None:
+            raise APNSNoSSLContextFound("There is no h2 module available "\
+                            "in your python environment to use HTTP/2.")
+
+        self.certificate = certificate
+        self.topic = topic
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.maxConcurrentStreams = maxConcurrentStreams
+        self.sslContext = ssl_context
+
+        self.sock = None
+        self.h2 = None
+        self.authority = None
+        self.address = None
+        self.rest = ""
+
+        # stream id -> [identifier, token, status, body, notification]
+        self.streams = {}
+        self.finished = []
+        # notifications of streams refused by GOAWAY, sent after reconnect
+        self.retrying = []
+        # reason of GOAWAY, connection doesn't accept new streams
+        self.goaway = None
+
+    def _context(self):
+        if self.sslContext:
+            return self.sslContext
+
+        import ssl
+        context = ssl.create_default_context()
+        context.load_cert_chain(self.certificate)
+        context.set_alpn_protocols(['h2'])
+        return context
+
+    def connect(self, host, port):
+        """
+        Make connection to the host and port. Gateway hosts of binary
+        protocol are replaced by hosts of HTTP/2 provider API.
+        """
+        self.address = (host, port)
+        if self.host:
+            host = self.host
+        else:
+            host = HOSTS.get(host, host)
+        port = self.port
+
+        self.sock = socket.create_connection((host, port))
+        if self.secure:
+            self.sock = self._context().wrap_socket(self.sock, \
+                                                    server_hostname=host)
+
+        self.authority = "%s:%d" % (host, port)
+        self.goaway = None
+        self.h2 = h2.connection.H2Connection(\
+                    config=h2.config.H2Configuration(client_side=True))
+        self.h2.initiate_connection()
+        self.sock.sendall(self.h2.data_to_send())
+
+    def _concurrency(self):
+        return min(self.maxConcurrentStreams, \
+                    self.h2.remote_settings.max_concurrent_streams)
+
+    def send(self, token, payload, identifier=None, expiry=None, \
+                                                            priority=None):
+        """
+        Send one notification as new stream. Blocks only if there are
+        too many outstanding streams or flow control window is closed.
+        Return stream id.
+        """
+        while True:
+            if self.goaway is not None:
+                self._reconnect()
+            elif len(self.streams) >= self._concurrency():
+                self._receive()
+            else:
+                break
+
+        streamId = self.h2.get_next_available_stream_id()
+        headers = [
+            (':method', 'POST'),
+            (':scheme', self.secure and 'https' or 'http'),
+            (':path', '/3/device/%s' % binascii.hexlify(token)),
+            (':authority', self.authority),
+        ]
+        if self.topic:
+            headers.append(('apns-topic', self.topic))
+        if expiry != None:
+            headers.append(('apns-expiration', str(expiry)))
+        if priority != None:
+            headers.append(('apns-priority', str(priority)))
+
+        self.h2.send_headers(streamId, headers)
+        self.streams[streamId] = [identifier, token, None, [], \
+                                (token, payload, identifier, expiry, priority)]
+
+        while self.h2.local_flow_control_window(streamId) < len(payload):
+            self.sock.sendall(self.h2.data_to_send())
+            self._receive()
+            if streamId not in self.streams:
+                # refused by GOAWAY, will be sent after reconnect
+                return streamId
+
+        self.h2.send_data(streamId, payload, end_stream=True)
+        self.sock.sendall(self.h2.data_to_send())
+        return streamId
+
+    def write(self, data=None):
+        """
+        Parse binary notification frames (command 0, 1 or 2)
+        and send every notification as separate stream.
+        """
+        data = self.rest + data
+        offset = 0
+
+        while offset < len(data):
+            notification = _unpack(data, offset)
+            if notification is None:
+                break
+
+            offset, token, payload, identifier, expiry, priority = \
+                                                                notification
+            self.send(token, payload, identifier, expiry, priority)
+
+        self.rest = data[offset:]
+
+    def _receive(self):
+        """
+        Read data from the socket and process HTTP/2 events
+        """
+        try:
+            data = self.sock.recv(self.blockSize)
+        except socket.error:
+            if self.goaway is None:
+                raise
+            data = ""
+
+        if not data and self.goaway is not None:
+            # server closed connection after GOAWAY
+            for streamId in self.streams.keys():
+                self.streams[streamId][2:4] = [None, [self.goaway]]
+                self._finish(streamId)
+            return
+
+        if not data:
+            raise APNSConnectionError("HTTP/2 connection closed by "\
+                    "server with %d outstanding streams." % len(self.streams))
+
+        for event in self.h2.receive_data(data):
+            if isinstance(event, h2.events.ResponseReceived):
+                stream = self.streams.get(event.stream_id)
+                if stream:
+                    stream[2] = int(dict(event.headers)[':status'])
+
+            elif isinstance(event, h2.events.DataReceived):
+                stream = self.streams.get(event.stream_id)
+                if stream:
+                    stream[3].append(event.data)
+                self.h2.acknowledge_received_data(\
+                            event.flow_controlled_length, event.stream_id)
+
+            elif isinstance(event, (h2.events.StreamEnded, \
+                                        h2.events.StreamReset)):
+                self._finish(event.stream_id)
+
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self._terminated(event)
+
+        self.sock.sendall(self.h2.data_to_send())
+
+    def _terminated(self, event):
+        """
+        Server sent GOAWAY: streams after last processed
+        one should be sent again over new connection
+        """
+        reason = getattr(event.error_code, 'name', event.error_code)
+        if event.additional_data:
+            try:
+                reason = json.loads(event.additional_data).get('reason', \
+                                                                    reason)
+            except ValueError:
+                pass
+        self.goaway = str(reason)
+
+        lastStreamId = event.last_stream_id or 0
+        for streamId in sorted(self.streams.keys()):
+            if streamId > lastStreamId:
+                self.retrying.append(self.streams.pop(streamId)[4])
+
+    def _reconnect(self):
+        """
+        Wait for streams processed by server before GOAWAY,
+        open new connection and send refused streams again
+        """
+        while self.streams:
+            self._receive()
+
+        self.close()
+        self.connect(*self.address)
+
+        retrying, self.retrying = self.retrying, []
+        for notification in retrying:
+            self.send(*notification)
+
+    def _finish(self, streamId):
+        stream = self.streams.pop(streamId, None)
+        if stream is None:
+            return
+
+        identifier, token, status, body = stream[:4]
+        reason = None
+        if body:
+            try:
+                reason = json.loads("".join(body)).get('reason')
+            except ValueError:
+                reason = "".join(body)
+
+        self.finished.append((identifier, token, status, reason))
+
+    def responses(self, wait=True):
+        """
+        Return list of (identifier, token, status, reason) tuples of
+        finished requests since previous call. Status is 200 for
+        delivered notification and None for reset stream or stream
+        lost when server closed connection after GOAWAY.
+        If `wait` is True wait for all outstanding streams.
+        """
+        while wait and (self.streams or self.retrying):
+            if self.goaway is not None:
+                self._reconnect()
+            else:
+                self._receive()
+
+        finished = self.finished
+        self.finished = []
+        return finished
+
+    def read(self, blockSize=1024):
+        raise APNSNotImplementedMethod("HTTP/2 connection has no binary "\
+                    "stream to read, use HTTP2Connection.responses")
+
+    def readable(self, timeout=0):
+        return False
+
+    def context(self):
+        return self
+
+    def close(self):
+        """
+        Close connection. Socket may be already closed by server.
+        """
+        try:
+            if self.h2 and self.sock:
+                self.h2.close_connection()
+                self.sock.sendall(self.h2.data_to_send())
+        except (socket.error, h2.exceptions.ProtocolError):
+            pass
+
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.h2 = None
+
+
+def _unpack(data, offset):
+    """
+    Unpack one binary notification frame from data starting at offset.
+    Return tuple (next offset, token, payload, identifier, expiry,
+    priority) or None if frame is not complete.
+    """
+    if len(data) - offset < 5:
+        return None
+
+    command = ord(data[offset])
+    identifier = expiry = priority = None
+
+    if command == 2:
+        length = struct.unpack_from("!I", data, offset + 1)[0]
+        end = offset + 5 + length
+        if len(data) < end:
+            return None
+
+        items = {}
+        position = offset + 5
+        while position < end:
+            item, itemLength = struct.unpack_from("!BH", data, position)
+            items[item] = data[position + 3:position + 3 + itemLength]
+            position += 3 + itemLength
+
+        if 3 in items:
+            identifier = struct.unpack("!I", items[3])[0]
+        if 4 in items:
+            expiry = struct.unpack("!I", items[4])[0]
+        if 5 in items:
+            priority = ord(items[5])
+        return end, items.get(1), items.get(2), identifier, expiry, priority
+
+    if command == 1:
+        if len(data) - offset < 11:
+            return None
+        identifier, expiry = struct.unpack_from("!II", data, offset + 1)
+        position = offset + 9
+    elif command == 0:
+        position = offset + 1
+    else:
+        raise APNSValueError("Unexpected command %d of binary "\
+                                    "notification frame." % command)
+
+    tokenLength = struct.unpack_from("!H", data, position)[0]
+    position += 2
+    token = data[position:position + tokenLength]
+    position += tokenLength
+
+    if len(data) < position + 2:
+        return None
+    payloadLength = struct.unpack_from("!H", data, position)[0]
+    position += 2
+    payload = data[position:position + payloadLength]
+    position += payloadLength
+
+    if len(data) < position:
+        return None
+    return position, token, payload, identifier, expiry, priority
@@ -0,0 +1,259 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import binascii
+import mmap
+import os
+import struct
+
+from apnsexceptions import *
+
+
+__all__ = ('APNSJournal',)
+
+
+# header of journal record: length of data and its crc32
+RECORD_HEADER = "!II"
+RECORD_HEADER_LENGTH = struct.calcsize(RECORD_HEADER)
+ACK_FORMAT = "!Q"
+SEGMENT_SUFFIX = ".seg"
+
+
+def _crc(data):
+    return binascii.crc32(data) & 0xffffffff
+
+
+class APNSJournalSegment(object):
+    """
+    One preallocated memory-mapped journal file. Records are appended
+    after the last valid one, end of segment is found on open by
+    scanning records until empty header or broken checksum.
+    """
+    def __init__(self, path, base, size):
+        self.path = path
+        self.base = base
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+        self.end = self._scan()
+        self.dirty = False
+
+    def _scan(self):
+        position = 0
+        for end, data in self.records():
+            position = end - self.base
+        return position
+
+    def records(self, start=0):
+        """
+        Iterate (end offset, data) of valid records from `start`
+        """
+        position = start
+        while position + RECORD_HEADER_LENGTH <= self.size:
+            length, crc = struct.unpack_from(RECORD_HEADER, self.map, \
+                                                                position)
+            begin = position + RECORD_HEADER_LENGTH
+            if length == 0 or begin + length > self.size:
+                return
+
+            data = self.map[begin:begin + length]
+            if _crc(data) != crc:
+                # record was not written completely
+                return
+
+            position = begin + length
+            yield self.base + position, data
+
+    def fits(self, length):
+        return self.end + RECORD_HEADER_LENGTH + length <= self.size
+
+    def append(self, data):
+        """
+        Append record, return its end offset
+        """
+        position = self.end
+        begin = position + RECORD_HEADER_LENGTH
+        self.map[begin:begin + len(data)] = data
+        self.map[position:begin] = struct.pack(RECORD_HEADER, len(data), \
+                                                                _crc(data))
+        self.end = begin + len(data)
+        self.dirty = True
+        return self.base + self.end
+
+    def sync(self):
+        if self.dirty:
+            # cleared first, so record appended by other
+            # thread during flush is flushed next time
+            self.dirty = False
+            self.map.flush()
+
+    def close(self):
+        self.sync()
+        self.map.close()
+
+
+class APNSJournal(object):
+    """
+    Append-only journal of messages in memory-mapped segment files of
+    `segmentSize` bytes in `path` directory. Every record has offset
+    of its end, records up to acknowledged offset are not replayed
+    and their segments are removed by .compact().
+
+    Appended records are in page cache right away, so they survive
+    restart of the process. .sync() writes them and acknowledged
+    offset to disk (call it periodically to commit group of records).
+    .sync() and .compact() may run in other thread than the rest of
+    methods.
+    """
+    segmentSize = 64 * 1024 * 1024
+
+    def __init__(self, path, segmentSize=64 * 1024 * 1024):
+        self.path = path
+        self.segmentSize = segmentSize
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        ackPath = os.path.join(path, "ack")
+        if not os.path.exists(ackPath):
+            open(ackPath, "wb").close()
+
+        self.ackFile = open(ackPath, "r+b")
+        data = self.ackFile.read(struct.calcsize(ACK_FORMAT))
+        if len(data) == struct.calcsize(ACK_FORMAT):
+            self.ackOffset = struct.unpack(ACK_FORMAT, data)[0]
+        else:
+            self.ackOffset = 0
+        self.ackDirty = False
+        # base of segment read by .replay(), it's not compacted
+        self.replaying = None
+
+        self.segments = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(SEGMENT_SUFFIX):
+                base = int(name[:-len(SEGMENT_SUFFIX)])
+                self.segments.append(APNSJournalSegment(\
+                            os.path.join(path, name), base, segmentSize))
+        self.segments.sort(key=lambda segment: segment.base)
+
+        if not self.segments:
+            self._segment(self.ackOffset, segmentSize)
+
+        # records lost by crash of the system before sync
+        self.ackOffset = min(self.ackOffset, self.offset)
+
+    def _segment(self, base, size):
+        name = "%020d%s" % (base, SEGMENT_SUFFIX)
+        segment = APNSJournalSegment(os.path.join(self.path, name), \
+                                                                base, size)
+        self.segments.append(segment)
+        return segment
+
+    @property
+    def offset(self):
+        """
+        End offset of the last record
+        """
+        current = self.segments[-1]
+        return current.base + current.end
+
+    def append(self, data):
+        """
+        Append record, return its end offset
+        """
+        if not data:
+            raise APNSValueError("Journal record should not be empty.")
+
+        current = self.segments[-1]
+        if not current.fits(len(data)):
+            current = self._segment(self.offset, max(self.segmentSize, \
+                                        RECORD_HEADER_LENGTH + len(data)))
+        return current.append(data)
+
+    def ack(self, offset):
+        """
+        Acknowledge all records up to `offset`
+        """
+        if offset > self.ackOffset:
+            self.ackOffset = offset
+            self.ackDirty = True
+
+    def pending(self):
+        """
+        Count of bytes of not acknowledged records
+        """
+        return self.offset - self.ackOffset
+
+    def replay(self, end=None):
+        """
+        Iterate (end offset, data) of not acknowledged records up to
+        `end` offset (all records by default). Segments from the one
+        being read are not removed by .compact() until iteration is
+        finished.
+        """
+        ackOffset = self.ackOffset
+        try:
+            for segment in list(self.segments):
+                if segment.base + segment.end <= ackOffset:
+                    continue
+                self.replaying = segment.base
+                start = max(0, ackOffset - segment.base)
+                for record in segment.records(start):
+                    if end is not None and record[0] > end:
+                        return
+                    yield record
+        finally:
+            self.replaying = None
+
+    def sync(self):
+        """
+        Write appended records and acknowledged offset to disk
+        """
+        for segment in self.segments:
+            segment.sync()
+
+        if self.ackDirty:
+            self.ackDirty = False
+            self.ackFile.seek(0)
+            self.ackFile.write(struct.pack(ACK_FORMAT, self.ackOffset))
+            self.ackFile.flush()
+            os.fsync(self.ackFile.fileno())
+
+    def compact(self):
+        """
+        Remove segments with acknowledged records only, which are
+        before segment being replayed. Return count of removed segments.
+        """
+        removed = 0
+        while len(self.segments) > 1:
+            segment = self.segments[0]
+            if segment.base + segment.end > self.ackOffset:
+                break
+            replaying = self.replaying
+            if replaying is not None and segment.base >= replaying:
+                break
+            segment.close()
+            os.remove(segment.path)
+            self.segments.pop(0)
+            removed += 1
+        return removed
+
+    def close(self):
+        self.sync()
+        for segment in self.segments:
+            segment.close()
+        self.ackFile.close()
@@ -13,14 +13,40 @@
 import struct
 import base64
 import binascii
+import collections
+import copy
+import datetime
+import threading
+import time
 
 from APNSWrapper import *
 from APNSWrapper.connection import *
 from APNSWrapper.apnsexceptions import *
-from APNSWrapper.utils import _doublequote
+from APNSWrapper.tokens import TokenBatch
+from APNSWrapper.utils import _quote, _encode, _doublequote
 
 NULL = 'null'
 
+# temporary value of truncated text, see APNSNotification.truncate
+TRUNCATE_PLACEHOLDER = '@@APNSWrapper-truncated-text@@'
+
+# status codes of error-response packet of enhanced notification format
+ERROR_RESPONSE_COMMAND = 8
+ERROR_RESPONSE_LENGTH = 6
+ERROR_STATUSES = {
+    0: 'No errors encountered',
+    1: 'Processing error',
+    2: 'Missing device token',
+    3: 'Missing topic',
+    4: 'Missing payload',
+    5: 'Invalid token size',
+    6: 'Invalid topic size',
+    7: 'Invalid payload size',
+    8: 'Invalid token',
+    10: 'Shutdown',
+    255: 'None (unknown)',
+}
+
 
 _all__ = ('APNSAlert', 'APNSProperty', 'APNSNotificationWrapper', \
            'APNSNotification')
@@ -81,7 +107,7 @@ class APNSAlert(object):
             raise APNSValueError("Unexpected type of argument. "\
                                     "It should be list or tuple of strings")
 
-        self.locArgs = ['"%s"' % unicode(x).encode("utf-8") for x in la]
+        self.locArgs = [_quote(unicode(x)) for x in la]
         return self
 
     def build(self):
@@ -91,20 +117,24 @@ class APNSAlert(object):
 
         arguments = []
         if self.alertBody:
-            arguments.append('"body":"%s"' % _doublequote(self.alertBody))
+            arguments.append('"body":' + _quote(self.alertBody))
 
         if self.actionLocKey:
-            arguments.append('"action-loc-key":"%s"' % _doublequote(\
-                                                        self.actionLocKey))
+            arguments.append('"action-loc-key":' + _quote(self.actionLocKey))
 
         if self.locKey:
-            arguments.append('"loc-key":"%s"' % _doublequote(self.locKey))
+            arguments.append('"loc-key":' + _quote(self.locKey))
 
         if self.locArgs:
-            arguments.append('"loc-args":[%s]' % ",".join(self.locArgs))
+            arguments.append('"loc-args":[' + ",".join(self.locArgs) + ']')
 
         return ",".join(arguments)
 
+    def _key(self):
+        """Normalized content of alert for payload cache"""
+        return (APNSAlert, self.alertBody, self.actionLocKey, self.locKey, \
+                                                    tuple(self.locArgs or ()))
+
 
 class APNSProperty(object):
     """
@@ -127,25 +157,90 @@ class APNSProperty(object):
 
     def build(self):
         """Build property for payload"""
-        arguments = []
-        name = '"%s":' % self.name
+        return _quote(self.name) + ':' + _encode(self.data)
 
-        if isinstance(self.data, (int, float)):
-            return "%s%s" % (name, data)
+    def _key(self):
+        """Normalized content of property for payload cache"""
+        return (self.name, _hashable(self.data))
 
-        if isinstance(self.data, (str, unicode)):
-            return '%s"%s"' % (name, _doublequote(
-                                     unicode(self.data).encode("utf-8")))
 
-        if isinstance(self.data, (tuple, list)):
-            arguments = map(lambda x: if_else(isinstance(x, (str, unicode)), \
-                            '"%s"' % _doublequote(unicode(x).encode("utf-8")),
-                                                  unicode(x).encode("utf-8")),
-                                                  self.data)
+class APNSPayloadCache(object):
+    """
+    Bounded LRU cache of built payloads keyed by normalized content
+    of notification (aps keys, alert and properties). To use it set
+    cache to APNSNotification.payloadCache globally or per object:
 
-            return "%s[%s]" % (name, ",".join(arguments))
+        APNSNotification.payloadCache = APNSPayloadCache(size=10000)
+    """
+    def __init__(self, size=1024):
+        if not isinstance(size, int) or size < 1:
+            raise APNSValueError("Size of payload cache should be "\
+                                    "a positive number")
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def get(self, key):
+        """
+        Return cached payload and mark it as recently used
+        or None if there is no payload for the key.
+        """
+        with self.lock:
+            link = self.links.get(key)
+            if link is None:
+                self.misses += 1
+                return None
+
+            # move link to the most recently used end of the list
+            prev, next = link[0], link[1]
+            prev[1] = next
+            next[0] = prev
+            root = self.root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+
+            self.hits += 1
+            return link[3]
+
+    def put(self, key, payload):
+        """
+        Add payload to the cache, least recently used
+        payload is evicted if cache is full.
+        """
+        with self.lock:
+            if key in self.links:
+                self.links[key][3] = payload
+                return
+
+            root = self.root
+            last = root[0]
+            link = [last, root, key, payload]
+            last[1] = root[0] = self.links[key] = link
+
+            if len(self.links) > self.size:
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del self.links[oldest[2]]
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all payloads and reset counters.
+        """
+        with self.lock:
+            # circular doubly linked list of [prev, next, key, payload]
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None]
+            self.links = {}
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
 
-        return '%s%s' % (name, NULL)
+    def __len__(self):
+        return len(self.links)
 
 
 class APNSNotificationWrapper(object):
@@ -161,10 +256,30 @@ class APNSNotificationWrapper(object):
     payloads = None
     connection = None
     debug_ssl = False
+    chunkSize = 65536   # max size of one write in streaming mode
+    enhanced = False
+    command = None
+    sentBufferSize = 10000  # count of sent frames kept for recovery
 
     def __init__(self, certificate=None, sandbox=True, debug_ssl=False, \
-                    force_ssl_command=False, connection=None):
+                    force_ssl_command=False, connection=None, compact=False, \
+                    enhanced=False, sentBufferSize=10000, command=None):
         self.debug_ssl = debug_ssl
+        self.compact = compact
+        self.sentBufferSize = sentBufferSize
+
+        # command 1 and 2 are enhanced formats with identifiers
+        if enhanced and command == None:
+            command = 1
+        if command not in (None, 0, 1, 2):
+            raise APNSValueError("Unexpected notification format command. "\
+                                    "It should be 0, 1 or 2.")
+        self.command = command
+        self.enhanced = command in (1, 2)
+
+        # ring buffer of frames sent in enhanced format
+        self.sent = collections.deque(maxlen=sentBufferSize)
+        self.nextIdentifier = 1
 
         if not connection:
             self.connection = APNSConnection(certificate=certificate, \
@@ -177,10 +292,21 @@ class APNSNotificationWrapper(object):
         self.payloads = []
 
     def append(self, payload=None):
-        """Append payload to wrapper"""
+        """
+        Append payload to wrapper. If wrapper created with compact=True
+        payload is built immediately and only APNSCompactNotification
+        with device token and payload string is kept in the queue.
+        """
+        if isinstance(payload, APNSCompactNotification):
+            self.payloads.append(payload)
+            return
+
         if not isinstance(payload, APNSNotification):
             raise APNSTypeError("Unexpected argument type. Argument should "\
                                 "be an instance of APNSNotification object")
+
+        if self.compact:
+            payload = payload.compact()
         self.payloads.append(payload)
 
     def count(self):
@@ -198,6 +324,13 @@ class APNSNotificationWrapper(object):
 
         self.connection.connect(apnsHost, self.apnsPort)
 
+        if self.command == 2:
+            # coalesce frames into writes which fit socket send buffer
+            try:
+                self.chunkSize = self.connection.sendBufferSize()
+            except APNSNotImplementedMethod:
+                pass
+
     def disconnect(self):
         """Close connection ton APNS server"""
         self.connection.close()
@@ -209,17 +342,186 @@ class APNSNotificationWrapper(object):
         another place/another side) so just send it and forget
         """
         if data:
-            self.connection.write(data)
+            self._write(data)
             return True
 
         if encoded_data:
             # TODO: encode data
             data = ""
-            self.connection.write(data)
+            self._write(data)
             return True
 
         return False
 
+    def broadcast(self, template=None, tokens=None):
+        """
+        Send the same notification to many devices. Payload of
+        `template` is built and validated only once, after that
+        only frame header packed for every token from `tokens`.
+        Tokens should be in binary format (see APNSNotification.token)
+        or TokenBatch instance.
+        """
+        if not isinstance(template, APNSNotification):
+            raise APNSTypeError("Unexpected argument type. Argument should "\
+                                "be an instance of APNSNotification object")
+
+        command = self.command
+        if command == None:
+            command = template.command
+
+        payload = template.build(command)
+        tokenLength = template.deviceTokenLength
+
+        # everything but token and identifier is packed only once
+        pack = _packer(command, tokenLength, payload, template.expiryValue, \
+                                                    template.priorityValue)
+
+        if isinstance(tokens, TokenBatch):
+            # tokens already validated by batch
+            if tokens.tokenLength != tokenLength:
+                raise APNSValueError("Length of device tokens in batch "\
+                                        "should be %d bytes." % tokenLength)
+        else:
+            tokens = (self._checkToken(token, tokenLength) \
+                                                        for token in tokens)
+
+        if self.enhanced:
+            frames = (pack(token, self._identifier()) for token in tokens)
+        else:
+            identifier = template.identifierValue or 0
+            frames = (pack(token, identifier) for token in tokens)
+
+        return self._write_frames(frames) > 0
+
+    def _identifier(self):
+        identifier = self.nextIdentifier
+        self.nextIdentifier = (identifier + 1) % 0x100000000
+        return identifier
+
+    def _frame(self, notification):
+        """
+        Build frame of queued notification. In enhanced mode
+        notification without identifier gets next one of the wrapper.
+        """
+        if not self.enhanced:
+            return notification.payload(command=self.command)
+
+        identifier = notification.identifierValue
+        if identifier == None:
+            identifier = self._identifier()
+
+        return notification.payload(command=self.command, \
+                                                identifier=identifier)
+
+    def _checkToken(self, token, tokenLength):
+        if len(token) != tokenLength:
+            raise APNSValueError("Length of device token should "\
+                                    "be %d bytes." % tokenLength)
+        return token
+
+    def _write_frames(self, frames):
+        """
+        Coalesce frames into chunks of chunkSize bytes and write every
+        chunk as soon as it's ready, flush connection at the end (e.g.
+        uncork TCP socket). Return count of written frames.
+        """
+        chunkSize = self.chunkSize
+        chunk = []
+        size = 0
+        count = 0
+
+        sent = None
+        if self.enhanced:
+            sent = self.sent
+
+        for frame in frames:
+            if sent is not None:
+                sent.append(frame)
+
+            chunk.append(frame)
+            size += len(frame)
+            count += 1
+
+            if size >= chunkSize:
+                self._write("".join(chunk))
+                chunk = []
+                size = 0
+
+        if chunk:
+            self._write("".join(chunk))
+
+        self.connection.flush()
+        return count
+
+    def _write(self, data):
+        self.connection.write(data)
+
+    def notify_stream(self, notifications=None):
+        """
+        Streaming version of notify. Notifications are pulled from
+        `notifications` iterable (generator, for example), or from
+        queue of the wrapper, and written by chunks of chunkSize bytes,
+        so whole message never built in memory.
+        Return count of sent notifications.
+        """
+        if notifications is None:
+            notifications = self.payloads
+
+        return self._write_frames(self._frame(o) for o in notifications)
+
+    def read_error(self, timeout=0):
+        """
+        Wait up to `timeout` seconds for error-response packet from APNS.
+        Return tuple (status, identifier) or None if there is no error.
+        Gateway closes connection after error-response sent.
+        """
+        if not self.connection.readable(timeout):
+            return None
+
+        data = self.connection.read(ERROR_RESPONSE_LENGTH)
+        if not data or len(data) < ERROR_RESPONSE_LENGTH:
+            return None
+
+        command, status, identifier = struct.unpack("!BBI", data)
+        if command != ERROR_RESPONSE_COMMAND:
+            raise APNSValueError("Unexpected command %d in APNS "\
+                                    "error-response packet." % command)
+        return status, identifier
+
+    def recover(self, timeout=1):
+        """
+        Check error-response of enhanced notifications. If APNS reported
+        an error, reconnect and resend frames which was sent after the
+        failed one (APNS drops them after error). If the failed frame
+        is not in the ring buffer any more, all buffered frames were
+        sent after it and are resent. Return tuple (status, identifier)
+        of error (see ERROR_STATUSES) or None.
+        """
+        error = self.read_error(timeout)
+        if error == None:
+            return None
+
+        status, identifier = error
+        resend = self._framesAfter(identifier)
+
+        self.disconnect()
+        self.connect()
+        self._write_frames(resend)
+
+        return error
+
+    def _framesAfter(self, identifier):
+        """
+        Take frames sent after the failed one out of ring buffer
+        """
+        frames = list(self.sent)
+        self.sent.clear()
+
+        for index, frame in enumerate(frames):
+            if _identifier(frame) == identifier:
+                return frames[index + 1:]
+        return frames
+
     @property
     def prepared_message(self):
         """
@@ -227,26 +529,22 @@ class APNSNotificationWrapper(object):
             1) prepare all internal variables to APNS Payout JSON
             2) return prepared data
         """
-        payloads = [o.payload() for o in self.payloads]
-        messages = []
-
-        if len(payloads) == 0:
+        if len(self.payloads) == 0:
             return False
 
-        for p in payloads:
-            plen = len(p)
-            messages.append(struct.pack('%ds' % plen, p))
-
-        message = "".join(messages)
-
-        return message
+        return "".join([self._frame(o) for o in self.payloads])
 
     def notify(self):
         """
         Prepare all messages and send it to the currently opened connection
         """
+        if self.enhanced:
+            # frames should be kept in ring buffer for recovery
+            self.notify_stream()
+            return True
 
-        self.connection.write(self.prepared_message)
+        self._write(self.prepared_message)
+        self.connection.flush()
 
         return True
 
@@ -265,9 +563,11 @@ class APNSNotification(object):
     deviceToken = None
 
     maxPayloadLength = 256
+    frameMaxPayloadLength = 2048    # limit of frame-based format
     deviceTokenLength = 32
 
     properties = None
+    payloadCache = None     # APNSPayloadCache instance
 
     def __init__(self):
         """
@@ -278,6 +578,11 @@ class APNSNotification(object):
         self.soundValue = None
         self.alertObject = None
         self.deviceToken = None
+        self.identifierValue = None
+        self.expiryValue = 0
+        self.priorityValue = 10
+        self.truncateTarget = None
+        self.truncateEllipsis = None
 
     def token(self, token):
         """
@@ -304,6 +609,59 @@ class APNSNotification(object):
 
         return self
 
+    def identifier(self, identifier=None):
+        """
+        Set identifier of notification for enhanced format, it is
+        returned by APNS in error-response. If None then identifier
+        will be assigned by APNSNotificationWrapper.
+        """
+        if identifier != None and not isinstance(identifier, (int, long)):
+            raise APNSValueError("Identifier argument must be a number")
+        self.identifierValue = identifier
+        return self
+
+    def expiry(self, expiry=0):
+        """
+        Set expiry of notification for enhanced format. It may be
+        UNIX timestamp or datetime object, 0 means that APNS
+        should not store notification at all.
+        """
+        if isinstance(expiry, datetime.datetime):
+            expiry = int(time.mktime(expiry.timetuple()))
+
+        if not isinstance(expiry, (int, long)):
+            raise APNSValueError("Expiry argument must be a number "\
+                                    "or datetime")
+        self.expiryValue = expiry
+        return self
+
+    def priority(self, priority=10):
+        """
+        Set priority of notification for frame-based format (command 2).
+        10 means send immediately, 5 - send at time that conserves
+        power on the device.
+        """
+        if priority not in (5, 10):
+            raise APNSValueError("Priority argument must be 5 or 10")
+        self.priorityValue = priority
+        return self
+
+    def truncate(self, target='alert', ellipsis=u'\u2026'):
+        """
+        Enable truncation of text to fit payload into maxPayloadLength
+        bytes instead of APNSPayloadLengthError. Target is 'alert'
+        (alert string or body of APNSAlert) or name of string property.
+        UTF-8 characters are never split, `ellipsis` is appended to
+        truncated text. If target is None truncation is disabled.
+        """
+        if target != None and not isinstance(target, (str, unicode)):
+            raise APNSValueError("Truncate target should be 'alert' "\
+                                    "or name of property")
+
+        self.truncateTarget = target
+        self.truncateEllipsis = unicode(ellipsis or '').encode("utf-8")
+        return self
+
     def unbadge(self):
         """Simple shorcut to remove badge from your application.
         """
@@ -368,63 +726,310 @@ class APNSNotification(object):
     def _build(self):
         return self.build()
 
-    def build(self):
+    def _payloadLimit(self, command=None):
         """
-        Build all notifications items to one string.
+        Max length of payload in format of `command`
         """
-        keys = []
+        if command == None:
+            command = self.command
+
+        if command == 2:
+            return self.frameMaxPayloadLength
+        return self.maxPayloadLength
+
+    def _key(self, limit):
+        """
+        Normalized content of notification for payload cache
+        """
+        alert = self.alertObject
+        if isinstance(alert, APNSAlert):
+            alert = alert._key()
+
+        return (self.soundValue, self.badgeValue, alert, \
+                tuple([p._key() for p in self.properties or ()]), \
+                limit, self.truncateTarget, self.truncateEllipsis)
+
+    def build(self, command=None):
+        """
+        Build all notifications items to one string. Length of payload
+        is limited by format of `command` (command of notification by
+        default). If payloadCache is set, payload of the same content
+        is built only once.
+        """
+        limit = self._payloadLimit(command)
+        cache = self.payloadCache
+        if cache is None:
+            return self._buildPayload(limit)
+
+        key = self._key(limit)
+        payload = cache.get(key)
+        if payload is None:
+            payload = self._buildPayload(limit)
+            cache.put(key, payload)
+
+        return payload
+
+    def _buildPayload(self, limit):
+        if self.truncateTarget != None:
+            payload = self._truncatedPayload(limit)
+        else:
+            payload = self._encodePayload()
+
+        if len(payload) > limit:
+            raise APNSPayloadLengthError("Length of Payload more "\
+                                    "than %d bytes." % limit)
+
+        return payload
+
+    def _truncateField(self):
+        """
+        Return object and name of attribute with text to truncate
+        """
+        if self.truncateTarget == 'alert':
+            if isinstance(self.alertObject, APNSAlert):
+                return self.alertObject, 'alertBody'
+            return self, 'alertObject'
+
+        for property in self.properties:
+            if property.name == self.truncateTarget:
+                return property, 'data'
+
+        return None, None
+
+    def _truncatedPayload(self, limit):
+        """
+        Build payload once with placeholder instead of target text
+        to get size of the rest of payload, then put truncated
+        text to the place of placeholder.
+        """
+        owner, attribute = self._truncateField()
+        if owner is None:
+            # there is no property with such name, nothing to truncate
+            return self._encodePayload()
+
+        text = getattr(owner, attribute, None)
+        if not text or not isinstance(text, (str, unicode)):
+            return self._encodePayload()
+
+        # placeholder is put into a copy, so alert and properties
+        # shared with other notifications (threads) are not changed
+        notification = copy.copy(self)
+        if owner is self:
+            notification.alertObject = TRUNCATE_PLACEHOLDER
+        else:
+            placeholder = copy.copy(owner)
+            setattr(placeholder, attribute, TRUNCATE_PLACEHOLDER)
+            if owner is self.alertObject:
+                notification.alertObject = placeholder
+            else:
+                notification.properties = list(self.properties)
+                index = notification.properties.index(owner)
+                notification.properties[index] = placeholder
+        payload = notification._encodePayload()
+
+        budget = limit - (len(payload) - len(TRUNCATE_PLACEHOLDER))
+        return payload.replace(TRUNCATE_PLACEHOLDER, \
+                            _truncate(text, budget, self.truncateEllipsis), 1)
+
+    def _encodePayload(self):
         apsKeys = []
         if self.soundValue:
-            apsKeys.append('"sound":"%s"' % _doublequote(self.soundValue))
+            apsKeys.append('"sound":' + _quote(self.soundValue))
 
         if self.badgeValue:
-            apsKeys.append('"badge":%d' % int(self.badgeValue))
+            apsKeys.append('"badge":' + str(int(self.badgeValue)))
 
         if self.alertObject != None:
-            alertArgument = ""
-            if isinstance(self.alertObject, str):
-                alertArgument = _doublequote(self.alertObject)
-                apsKeys.append('"alert":"%s"' % alertArgument)
-            elif isinstance(self.alertObject, APNSAlert):
-                alertArgument = self.alertObject.build()
-                apsKeys.append('"alert":{%s}' % alertArgument)
+            if isinstance(self.alertObject, APNSAlert):
+                apsKeys.append('"alert":{' + self.alertObject.build() + '}')
+            else:
+                apsKeys.append('"alert":' + _quote(self.alertObject))
 
+        keys = []
         # issue #10, thanks to Ami.Lutt
         if len(apsKeys) > 0:
-            keys.append('"aps":{%s}' % ",".join(apsKeys))
+            keys.append('"aps":{' + ",".join(apsKeys) + '}')
 
         # prepare properties
         for property in self.properties:
             keys.append(property.build())
 
-        payload = "{%s}" % ",".join(keys)
+        return '{' + ",".join(keys) + '}'
 
-        if len(payload) > self.maxPayloadLength:
-            raise APNSPayloadLengthError("Length of Payload more "\
-                                    "than %d bytes." % self.maxPayloadLength)
+    def payload(self, command=None, identifier=None):
+        """Build payload via struct module"""
+        if self.deviceToken == None:
+            raise APNSUndefinedDeviceToken("You forget to set deviceToken "\
+                                            "in your notification.")
 
-        return payload
+        if command == None:
+            command = self.command
 
-    def payload(self):
-        """Build payload via struct module"""
+        return self.frame(self.deviceToken, self.build(command), command, \
+                                                                identifier)
+
+    def frame(self, token, payload, command=None, identifier=None):
+        """
+        Pack device token and already built payload
+        into binary notification frame. Command 1 is enhanced
+        format with identifier and expiry, command 2 is frame-based
+        format with items and priority.
+        """
+        if command == None:
+            command = self.command
+
+        if identifier == None:
+            identifier = self.identifierValue or 0
+
+        return _pack(command, token, payload, identifier, \
+                                    self.expiryValue, self.priorityValue)
+
+    def compact(self):
+        """
+        Build payload and return APNSCompactNotification which
+        keep only device token and payload string.
+        """
         if self.deviceToken == None:
             raise APNSUndefinedDeviceToken("You forget to set deviceToken "\
                                             "in your notification.")
 
-        payload = self.build()
-        payloadLength = len(payload)
-        tokenLength = len(self.deviceToken)
-        # Below not used at the moment
-        # tokenFormat = "s" * tokenLength
-        # payloadFormat = "s" * payloadLength
-
-        apnsPackFormat = "!BH" + str(tokenLength) + "sH" + \
-                                            str(payloadLength) + "s"
-
-        # build notification message in binary format
-        return struct.pack(apnsPackFormat,
-                                    self.command,
-                                    tokenLength,
-                                    self.deviceToken,
-                                    payloadLength,
-                                    payload)
+        return APNSCompactNotification(self.deviceToken, self.build(), \
+                    self.command, self.identifierValue, self.expiryValue, \
+                                                        self.priorityValue)
+
+
+class APNSCompactNotification(object):
+    """
+    Memory efficient representation of already built notification.
+    It has no __dict__ and keep only device token and payload, so
+    it is suitable for large in-memory queues of the wrapper.
+    """
+    __slots__ = ('deviceToken', 'payloadData', 'command', \
+                 'identifierValue', 'expiryValue', 'priorityValue')
+
+    def __init__(self, deviceToken, payloadData, command=0, \
+                    identifierValue=None, expiryValue=0, priorityValue=10):
+        self.deviceToken = deviceToken
+        self.payloadData = payloadData
+        self.command = command
+        self.identifierValue = identifierValue
+        self.expiryValue = expiryValue
+        self.priorityValue = priorityValue
+
+    def build(self):
+        return self.payloadData
+
+    def payload(self, command=None, identifier=None):
+        """Build binary notification frame"""
+        if command == None:
+            command = self.command
+
+        if identifier == None:
+            identifier = self.identifierValue or 0
+
+        return _pack(command, self.deviceToken, self.payloadData, \
+                        identifier, self.expiryValue, self.priorityValue)
+
+
+def _truncate(text, budget, ellipsis):
+    """
+    Cut text so that JSON escaped text with ellipsis fits into `budget`
+    bytes without splitting of UTF-8 characters. Return escaped text.
+    """
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+
+    escaped = _doublequote(text)
+    if len(escaped) <= budget:
+        return escaped
+
+    ellipsis = _doublequote(ellipsis)
+    limit = budget - len(ellipsis)
+    if limit < 0:
+        # even ellipsis doesn't fit, length check will fail anyway
+        return ""
+
+    end = limit
+    if len(_doublequote(text[:end])) > limit:
+        # escape sequences took more space, find longest prefix which fits
+        low, high = 0, end
+        while low < high:
+            middle = (low + high + 1) / 2
+            if len(_doublequote(text[:middle])) <= limit:
+                low = middle
+            else:
+                high = middle - 1
+        end = low
+
+    # step back from continuation bytes of UTF-8 character
+    while 0 < end < len(text) and (ord(text[end]) & 0xC0) == 0x80:
+        end -= 1
+
+    return _doublequote(text[:end]) + ellipsis
+
+
+def _hashable(value):
+    """
+    Convert property data to hashable value. Type is kept because
+    equal values like 1, 1.0 and True are encoded differently.
+    """
+    if isinstance(value, (list, tuple)):
+        return (list, tuple([_hashable(x) for x in value]))
+    return (value.__class__, value)
+
+
+def _identifier(frame):
+    """
+    Get identifier of notification from enhanced or frame-based frame
+    """
+    command = ord(frame[0])
+    if command == 1:
+        return struct.unpack_from("!I", frame, 1)[0]
+
+    if command == 2:
+        offset = 5
+        while offset < len(frame):
+            item, length = struct.unpack_from("!BH", frame, offset)
+            if item == 3:
+                return struct.unpack_from("!I", frame, offset + 3)[0]
+            offset += 3 + length
+
+    return None
+
+
+def _packer(command, tokenLength, payload, expiry=0, priority=10):
+    """
+    Return function (token, identifier) which packs notification with
+    the given payload into binary frame. Everything but token and
+    identifier is packed only once.
+    """
+    payloadLength = len(payload)
+
+    if command == 2:
+        # frame-based format: list of items (id, length, data)
+        middle = struct.pack("!BH", 2, payloadLength) + payload + \
+                                                    struct.pack("!BH", 3, 4)
+        tail = struct.pack("!BHIBHB", 4, 4, expiry, 5, 1, priority)
+        itemsLength = 3 + tokenLength + len(middle) + 4 + len(tail)
+        header = struct.pack("!BIBH", command, itemsLength, 1, tokenLength)
+        return lambda token, identifier: header + token + middle + \
+                                        struct.pack("!I", identifier) + tail
+
+    tail = struct.pack("!H", payloadLength) + payload
+
+    if command == 1:
+        # enhanced notification format
+        middle = struct.pack("!IH", expiry, tokenLength)
+        return lambda token, identifier: struct.pack("!BI", command, \
+                                        identifier) + middle + token + tail
+
+    header = struct.pack("!BH", command, tokenLength)
+    return lambda token, identifier: header + token + tail
+
+
+def _pack(command, token, payload, identifier=0, expiry=0, priority=10):
+    """
+    Pack notification into binary frame via struct module
+    """
+    return _packer(command, len(token), payload, expiry, priority)(token, \
+                                                                identifier)
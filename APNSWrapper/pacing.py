@@ -0,0 +1,282 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import math
+import socket
+import struct
+import threading
+import time
+
+from apnsexceptions import *
+from connection import APNSConnectionContext
+
+
+__all__ = ('TokenBucket', 'APNSRateController', 'APNSPacedConnection')
+
+
+# statuses of error-response sent when gateway drops connection
+# by itself, other statuses are errors of the notification
+CONNECTION_STATUSES = (10,)    # shutdown
+
+
+class TokenBucket(object):
+    """
+    Token bucket of `rate` bytes per second with capacity of `burst`
+    bytes. Write larger than available tokens is allowed and makes
+    a debt, so next writes wait until it's paid.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, \
+                            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def setRate(self, rate, burst=None):
+        with self.lock:
+            self._refill(time.time())
+            self.rate = float(rate)
+            self.burst = float(burst or rate)
+            self.tokens = min(self.tokens, self.burst)
+
+    def take(self, amount):
+        """
+        Take `amount` tokens, sleep if there is not enough
+        tokens. Return count of seconds waited.
+        """
+        with self.lock:
+            self._refill(time.time())
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+
+        if wait <= 0:
+            return 0
+        time.sleep(wait)
+        return wait
+
+
+class APNSRateController(object):
+    """
+    AIMD controller of send rate (bytes per second). Rate grows by
+    `increase` every `interval` seconds of successful writes, but not
+    more than by `increase` above the observed send rate, and is
+    multiplied by `decrease` on connection-level errors (resets,
+    shutdown of gateway) and writes slower than `latency` seconds.
+    Rate is shared between registered token buckets. If `pool`
+    (APNSConnectionPool) is given, count of its connections follows
+    the rate, one connection per `connectionRate` bytes per second;
+    pool is resized by background thread, not by writes.
+    """
+    def __init__(self, rate=262144, minRate=16384, maxRate=None, \
+                    increase=32768, decrease=0.5, interval=1.0, latency=0.5, \
+                    pool=None, connectionRate=262144, maxConnections=None):
+        self.rate = float(rate)
+        self.minRate = minRate
+        self.maxRate = maxRate
+        self.increase = increase
+        self.decrease = decrease
+        self.interval = interval
+        self.latency = latency
+
+        self.pool = pool
+        self.connectionRate = connectionRate
+        self.maxConnections = maxConnections
+
+        self.buckets = []
+        self.lastIncrease = self.lastDecrease = time.time()
+        self.sentBytes = 0      # bytes written since lastIncrease
+        self.congestions = 0
+        self.lock = threading.Lock()
+
+        self.resizing = threading.Condition(self.lock)
+        self.closed = False
+        self.resizer = None
+        if pool is not None:
+            self.resizer = threading.Thread(target=self._resizer)
+            self.resizer.setDaemon(True)
+            self.resizer.start()
+
+    def bucket(self):
+        """
+        Create token bucket which gets its part of rate
+        """
+        with self.lock:
+            bucket = TokenBucket(self.rate)
+            self.buckets.append(bucket)
+        self._apply()
+        return bucket
+
+    def connections(self):
+        """
+        Count of pool connections for current rate
+        """
+        count = max(1, int(math.ceil(self.rate / self.connectionRate)))
+        if self.maxConnections:
+            count = min(count, self.maxConnections)
+        return count
+
+    def _apply(self):
+        with self.lock:
+            buckets = list(self.buckets)
+            rate = self.rate
+
+        for bucket in buckets:
+            bucket.setRate(rate / len(buckets))
+
+        if self.pool is not None:
+            with self.lock:
+                self.resizing.notify()
+
+    def _resizer(self):
+        """
+        Background thread: open or close connections of the
+        pool when count of connections for rate is changed
+        """
+        while True:
+            with self.lock:
+                while not self.closed and \
+                                self.pool.size == self.connections():
+                    self.resizing.wait()
+                if self.closed:
+                    return
+                size = self.connections()
+
+            try:
+                self.pool.resize(size)
+            except Exception:
+                logging.exception("Unable to resize pool to %d "\
+                                                    "connections" % size)
+                time.sleep(max(self.interval, 0.1))
+
+    def success(self, latency, size=0):
+        """
+        Register successful write of `size` bytes
+        which took `latency` seconds
+        """
+        if latency > self.latency:
+            return self.congestion()
+
+        now = time.time()
+        with self.lock:
+            self.sentBytes += size
+            elapsed = now - self.lastIncrease
+            if elapsed < self.interval:
+                return
+
+            # rate which is not used by writers is not increased
+            observed = self.sentBytes / max(elapsed, 1e-6)
+            self.lastIncrease = now
+            self.sentBytes = 0
+
+            rate = min(self.rate + self.increase, observed + self.increase)
+            if self.maxRate:
+                rate = min(rate, self.maxRate)
+            if rate <= self.rate:
+                return
+            self.rate = rate
+        self._apply()
+
+    def congestion(self):
+        """
+        Register reset, shutdown of gateway or slow write. Rate
+        is decreased not more than once per `interval` seconds.
+        """
+        now = time.time()
+        with self.lock:
+            if now - self.lastDecrease < self.interval:
+                return
+            self.lastDecrease = self.lastIncrease = now
+            self.sentBytes = 0
+            self.rate = max(self.minRate, self.rate * self.decrease)
+            self.congestions += 1
+        self._apply()
+
+    def close(self):
+        """
+        Stop thread which resizes pool
+        """
+        with self.lock:
+            self.closed = True
+            self.resizing.notify()
+        if self.resizer is not None:
+            self.resizer.join()
+            self.resizer = None
+
+
+class APNSPacedConnection(APNSConnectionContext):
+    """
+    Connection which paces writes by token bucket of the rate
+    controller and reports write latency and connection-level errors
+    to it. Error-responses about invalid notifications (e.g. status 8,
+    invalid token) don't slow down writes. Controller may be shared
+    by many connections.
+    """
+    def __init__(self, connection, rate=262144, controller=None):
+        self.connection = connection
+        self.certificate = getattr(connection, 'certificate', None)
+        self.controller = controller or APNSRateController(rate)
+        self.bucket = self.controller.bucket()
+        self.waited = 0
+
+    def connect(self, host, port):
+        self.connection.connect(host, port)
+        return self
+
+    def write(self, data=None):
+        self.waited += self.bucket.take(len(data))
+
+        started = time.time()
+        try:
+            self.connection.write(data)
+        except (socket.error, IOError, APNSConnectionError):
+            self.controller.congestion()
+            raise
+        self.controller.success(time.time() - started, len(data))
+
+    def readable(self, timeout=0):
+        try:
+            return self.connection.readable(timeout)
+        except (socket.error, IOError):
+            self.controller.congestion()
+            raise
+
+    def read(self, blockSize=1024):
+        try:
+            data = self.connection.read(blockSize)
+        except (socket.error, IOError):
+            self.controller.congestion()
+            raise
+
+        # gateway sends nothing but error-responses,
+        # empty read means connection is closed
+        if not data or (len(data) >= 2 and \
+                        struct.unpack_from("!B", data, 1)[0] in \
+                                                CONNECTION_STATUSES):
+            self.controller.congestion()
+        return data
+
+    def sendBufferSize(self):
+        return self.connection.sendBufferSize()
+
+    def flush(self):
+        self.connection.flush()
+
+    def context(self):
+        return self
+
+    def close(self):
+        self.connection.close()
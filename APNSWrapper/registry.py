@@ -0,0 +1,254 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import os
+import threading
+import time
+
+from apnsexceptions import *
+from connection import APNSConnection
+from notifications import APNSNotificationWrapper
+
+
+__all__ = ('APNSCertificateRegistry',)
+
+
+class APNSRegistryEntry(object):
+    """
+    Connected wrapper of one application and environment
+    """
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.lock = threading.Lock()
+        self.active = 0
+        self.lastUsed = time.time()
+
+
+class APNSCertificateRegistry(object):
+    """
+    Certificates of many applications. Connections to sandbox or
+    production gateway are created on first send to application and
+    kept open for next sends. Not more than `maxConnections` connections
+    are open at once: the least recently used one is closed to open
+    new one. Connections idle for `idleTimeout` seconds are closed by
+    background thread which checks them every `sweepInterval` seconds
+    (with sweepInterval=None only when new connection is opened or
+    by explicit .sweep()).
+
+    `factory(certificate)` should return connection for certificate,
+    APNSConnection by default. Other keyword arguments are passed
+    to APNSNotificationWrapper of applications.
+    """
+    maxConnections = 100
+    idleTimeout = 300
+    sweepInterval = 60
+
+    def __init__(self, maxConnections=100, idleTimeout=300, factory=None, \
+                                            sweepInterval=60, **options):
+        self.maxConnections = maxConnections
+        self.idleTimeout = idleTimeout
+        self.sweepInterval = sweepInterval
+        self.factory = factory or self._factory
+        self.options = options
+
+        self.certificates = {}
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.evicted = 0
+
+        self.sweeper = None
+        self.stopped = threading.Event()
+
+    def _factory(self, certificate):
+        return APNSConnection(certificate=certificate)
+
+    def register(self, app, certificate, sandbox=False):
+        """
+        Register certificate of application for sandbox
+        or production environment.
+        """
+        if not os.path.exists(str(certificate)):
+            raise APNSCertificateNotFoundError("Apple Push Notification "\
+                "Service Certificate file %s not found." % str(certificate))
+
+        key = (app, bool(sandbox))
+        with self.lock:
+            changed = self.certificates.get(key) != certificate
+            self.certificates[key] = certificate
+            entry = changed and self.entries.pop(key, None) or None
+
+        if entry is not None:
+            self._close(entry)
+        return self
+
+    def unregister(self, app, sandbox=False):
+        """
+        Forget certificate of application and close its connection
+        """
+        key = (app, bool(sandbox))
+        with self.lock:
+            self.certificates.pop(key, None)
+            entry = self.entries.pop(key, None)
+
+        if entry is not None:
+            self._close(entry)
+
+    def _close(self, entry):
+        with entry.lock:
+            try:
+                entry.wrapper.disconnect()
+            except Exception:
+                pass
+
+    def _evict(self, limit=True):
+        """
+        Remove idle entries and, if `limit` is True, least recently
+        used ones over the limit, lock should be held. Return entries
+        to close.
+        """
+        idle = time.time() - self.idleTimeout
+        unused = [(entry.lastUsed, key) for key, entry \
+                        in self.entries.iteritems() if entry.active == 0]
+        unused.sort()
+
+        evicted = []
+        for lastUsed, key in unused:
+            if lastUsed >= idle and (not limit or \
+                                len(self.entries) < self.maxConnections):
+                break
+            evicted.append(self.entries.pop(key))
+
+        self.evicted += len(evicted)
+        return evicted
+
+    def sweep(self):
+        """
+        Close connections idle for idleTimeout seconds.
+        Return count of closed connections.
+        """
+        with self.lock:
+            evicted = self._evict(limit=False)
+
+        for entry in evicted:
+            self._close(entry)
+        return len(evicted)
+
+    def _sweeper(self):
+        """
+        Background thread: close idle connections
+        """
+        while not self.stopped.wait(self.sweepInterval):
+            self.sweep()
+
+    def _startSweeper(self):
+        # lock should be held
+        if self.sweepInterval and self.sweeper is None:
+            self.stopped.clear()
+            self.sweeper = threading.Thread(target=self._sweeper)
+            self.sweeper.setDaemon(True)
+            self.sweeper.start()
+
+    def _acquire(self, app, sandbox):
+        key = (app, bool(sandbox))
+        with self.lock:
+            certificate = self.certificates.get(key)
+            if certificate is None:
+                raise APNSCertificateNotFoundError("There is no certificate "\
+                            "of application %s (sandbox=%s) in registry." % \
+                                                            (app, sandbox))
+
+            entry = self.entries.get(key)
+            evicted = []
+            if entry is None:
+                evicted = self._evict()
+                self._startSweeper()
+            else:
+                entry.active += 1
+
+        for old in evicted:
+            self._close(old)
+
+        if entry is None:
+            # connect outside of registry lock
+            wrapper = APNSNotificationWrapper(certificate, sandbox=sandbox, \
+                        connection=self.factory(certificate), **self.options)
+            wrapper.connect()
+
+            entry = APNSRegistryEntry(wrapper)
+            entry.active = 1
+            with self.lock:
+                self.opened += 1
+                if key in self.entries:
+                    # another thread connected at the same time
+                    extra, entry = entry, self.entries[key]
+                    entry.active += 1
+                else:
+                    extra = None
+                    self.entries[key] = entry
+            if extra is not None:
+                self._close(extra)
+
+        return entry
+
+    def _release(self, entry):
+        with self.lock:
+            entry.active -= 1
+            entry.lastUsed = time.time()
+
+    def send(self, app, notifications, sandbox=False):
+        """
+        Send notifications to devices of application
+        over its connection. Return count of sent ones.
+        """
+        entry = self._acquire(app, sandbox)
+        try:
+            with entry.lock:
+                return entry.wrapper.notify_stream(notifications)
+        finally:
+            self._release(entry)
+
+    def route(self, stream):
+        """
+        Send mixed stream of (app, sandbox, notification) tuples.
+        Consecutive notifications of the same application are sent
+        at once. Return dict of sent counts by (app, sandbox).
+        """
+        sent = {}
+        for key, group in itertools.groupby(stream, lambda item: item[:2]):
+            app, sandbox = key
+            count = self.send(app, (item[2] for item in group), sandbox)
+            key = (app, bool(sandbox))
+            sent[key] = sent.get(key, 0) + count
+        return sent
+
+    def connections(self):
+        """
+        Count of open connections
+        """
+        return len(self.entries)
+
+    def close(self):
+        """
+        Close all connections and stop sweeper thread
+        """
+        with self.lock:
+            entries = self.entries.values()
+            self.entries = {}
+            sweeper, self.sweeper = self.sweeper, None
+            self.stopped.set()
+
+        if sweeper is not None and sweeper is not threading.currentThread():
+            sweeper.join()
+
+        for entry in entries:
+            self._close(entry)
@@ -11,13 +11,18 @@ except ImportError:
 
 import base64
 import logging
+import struct
 import sys
-import ssl
 
-from APNSWrapper.connection import DummyConnection, APNSConnection
-from APNSWrapper.notifications import APNSNotificationWrapper
+from APNSWrapper.connection import APNSServiceConnection, \
+                                    SERVICE_FRAME_HEADER, \
+                                    SERVICE_FRAME_HEADER_LENGTH, \
+                                    SERVICE_MAX_MESSAGE_LENGTH, \
+                                    SERVICE_ACK_OK, SERVICE_ACK_ERROR
+from APNSWrapper.journal import APNSJournal
+from APNSWrapper.upstream import APNSUpstream
 
-from twisted.internet import protocol, reactor
+from twisted.internet import protocol, reactor, task
 from twisted.protocols import basic
 from twisted.python import log
 
@@ -25,30 +30,20 @@ from twisted.python import log
 LISTEN_PORT = 1025
 CERT_PATH='cert.pem'
 SANDBOX = True
-
-try:
-    CERT_PATH = sys.argv[1]
-except:
-    sys.stderr.write("Please, specify path to your certificate file"\
-                     " as first argument of service.py\n\n")
-    sys.exit(1)
-
-try:
-    SANDBOX = bool(sys.argv[2])
-except:
-    sys.stderr.write("Please, specify 1/0 or true/false value"\
-                     " for second argument - it will be sandbox or"\
-                     " production mode of service connection\n\n")
-    sys.exit(1)
+JOURNAL_PATH = None
+UPSTREAM_CONNECTIONS = 4      # count of connections to APNS
+JOURNAL_SYNC_INTERVAL = 0.1   # seconds between group commits of journal
 
 
 class APNSServiceListener(basic.LineReceiver):
-    _wrapper = None
+    _upstream = None
     _connection = 0
+    framing = APNSServiceConnection.JSON
+    acks = False
 
     def __init__(self, *args, **kwargs):
-        self.__class__.establish_connection()
         self.__class__._connection += 1
+        self.buffer = ""
 
     @property
     def connection(self):
@@ -58,39 +53,35 @@ class APNSServiceListener(basic.LineReceiver):
     @classmethod
     def establish_connection(cls):
         """
-        Class method to establish connection to the APNS service
-        for whole service (for all clients)
+        Class method to establish connections to the APNS service
+        for whole service (for all clients). Connections are created
+        only once, when reactor is started.
         """
-        log.msg("Estabilishing connection to the APNS Service...",
-                logLevel=logging.INFO)
-        cls._ssl_connection = APNSConnection(certificate=CERT_PATH,
-                                         force_ssl_command=False,
-                                         debug=True)
-        cls._wrapper = APNSNotificationWrapper('', sandbox=SANDBOX,
-                                      connection=cls._ssl_connection)
-        cls._wrapper.connect()
-        return cls._wrapper
+        if cls._upstream is None:
+            log.msg("Estabilishing connection to the APNS Service...",
+                    logLevel=logging.INFO)
+            journal = None
+            if JOURNAL_PATH:
+                journal = APNSJournal(JOURNAL_PATH)
+
+            cls._upstream = APNSUpstream(CERT_PATH, SANDBOX, factory.clients,
+                                         journal, UPSTREAM_CONNECTIONS)
+            cls._upstream.connect()
+
+            if journal is not None:
+                cls._upstream.replay()
+                commits = task.LoopingCall(cls._upstream.commit)
+                commits.start(JOURNAL_SYNC_INTERVAL, now=False)
+
+                def close():
+                    commits.stop()
+                    return cls._upstream.close()
+                reactor.addSystemEventTrigger('before', 'shutdown', close)
+        return cls._upstream
 
     @property
-    def wrapper(self):
-        if not hasattr(self.__class__, '_wrapper'):
-            wrapper = APNSServiceListener.establish_connection()
-            return wrapper
-
-        # TODO: check that connection in wrapper still exist
-        return self._wrapper
-
-        """
-        encoded_token = '0/w68oJxIYlFpDDC/4eeo/bpt/44JTzZ6ZEXEgVvU6c='
-
-        badge(wrapper, encoded_token)
-
-        sound(wrapper, encoded_token)
-
-        alert(wrapper, encoded_token)
-
-        wrapper.notify()
-        """
+    def upstream(self):
+        return self.__class__.establish_connection()
 
     def connectionMade(self):
         """
@@ -100,6 +91,8 @@ class APNSServiceListener(basic.LineReceiver):
         log.msg("Got new client on connection %d!" % self.connection,
                 logLevel=logging.DEBUG)
         self.factory.clients.append(self)
+        if self.upstream.paused:
+            self.transport.pauseProducing()
 
     def connectionLost(self, reason):
         """
@@ -121,13 +114,99 @@ class APNSServiceListener(basic.LineReceiver):
 
         response = json.loads(line)
 
+        if 'message' not in response and \
+                            ('framing' in response or 'acks' in response):
+            return self.negotiate(response)
+
         if not 'message' in response:
             return self.error(msg=u"You're not specified message to send")
 
         msg_data = base64.standard_b64decode(response['message'])
-        log.msg("Received message for APNS: %s" % msg_data,
-                logLevel=logging.INFO)
-        self.wrapper.connection.write(data=msg_data)
+        self.message(response.get('id'), msg_data)
+
+    def negotiate(self, hello):
+        """
+        Client asks to switch to length-prefixed binary frames
+        and/or to acknowledge every message with id.
+        """
+        reply = {}
+        if hello.get('acks'):
+            self.acks = True
+            reply['acks'] = True
+        if hello.get('framing') == APNSServiceConnection.BINARY:
+            reply['framing'] = APNSServiceConnection.BINARY
+
+        self.response(reply)
+        if 'framing' in reply:
+            self.framing = APNSServiceConnection.BINARY
+            self.setRawMode()
+
+    def rawDataReceived(self, data):
+        """
+        Receive binary frames: length of message, message id
+        (0 if there is no id) and message itself. Client which
+        sends too long message is disconnected.
+        """
+        if self.transport.disconnecting:
+            return
+
+        self.buffer += data
+        offset = 0
+
+        while len(self.buffer) - offset >= SERVICE_FRAME_HEADER_LENGTH:
+            length, identifier = struct.unpack_from(SERVICE_FRAME_HEADER,
+                                                    self.buffer, offset)
+            if length > SERVICE_MAX_MESSAGE_LENGTH:
+                self.error(msg="Message %d of client is %d bytes long, "
+                               "disconnecting" % (identifier, length))
+                self.buffer = ""
+                self.transport.loseConnection()
+                return
+
+            start = offset + SERVICE_FRAME_HEADER_LENGTH
+            if len(self.buffer) < start + length:
+                break
+
+            self.message(identifier or None,
+                         self.buffer[start:start + length])
+            offset = start + length
+
+        self.buffer = self.buffer[offset:]
+
+    def message(self, identifier, msg_data):
+        """
+        Send message received from the client to APNS
+        """
+        def failed(failure):
+            error = failure.getErrorMessage()
+            self.error(msg="Unable to send message %s: %s" % (identifier,
+                                                              error))
+            self.ack(identifier, error)
+
+        deferred = self.upstream.write(msg_data)
+        deferred.addCallbacks(lambda ignored: self.ack(identifier), failed)
+
+    def ack(self, identifier, error=None):
+        """
+        Acknowledge message accepted by APNS connection or report error, if
+        client asked for acknowledges. Acknowledges are pipelined:
+        client doesn't wait for them before sending next messages.
+        """
+        if not self.acks or not identifier:
+            return
+
+        if self.framing == APNSServiceConnection.BINARY:
+            if error is None:
+                body = chr(SERVICE_ACK_OK)
+            else:
+                body = chr(SERVICE_ACK_ERROR) + error
+            self.transport.write(struct.pack(SERVICE_FRAME_HEADER,
+                                             len(body), identifier) + body)
+        elif error is None:
+            self.response({'id': identifier, 'status': 'ok'})
+        else:
+            self.response({'id': identifier, 'status': 'error',
+                           'error': error})
 
     def response(self, response):
         """
@@ -136,19 +215,54 @@ class APNSServiceListener(basic.LineReceiver):
 
         Method automatically dump it to JSON and send response to the client.
         """
-        self.transport.write(json.dumps(response))
+        self.transport.write(json.dumps(response) + self.delimiter)
 
 
 factory = protocol.ServerFactory()
 factory.protocol = APNSServiceListener
 factory.clients = []
 
-reactor.listenTCP(LISTEN_PORT, factory)
-log.msg("  > Starting APNS service "\
-                 "listener on port %d ...\n\n" % LISTEN_PORT,
-                 logLevel=logging.INFO)
 
+def main(argv):
+    global CERT_PATH, SANDBOX, JOURNAL_PATH, UPSTREAM_CONNECTIONS, \
+           JOURNAL_SYNC_INTERVAL
+
+    try:
+        CERT_PATH = argv[1]
+    except:
+        sys.stderr.write("Please, specify path to your certificate file"\
+                         " as first argument of service.py\n\n")
+        sys.exit(1)
+
+    try:
+        SANDBOX = bool(argv[2])
+    except:
+        sys.stderr.write("Please, specify 1/0 or true/false value"\
+                         " for second argument - it will be sandbox or"\
+                         " production mode of service connection\n\n")
+        sys.exit(1)
+
+    if len(argv) > 3:
+        # optional directory of journal of accepted messages
+        JOURNAL_PATH = argv[3] or None
+
+    if len(argv) > 4:
+        UPSTREAM_CONNECTIONS = int(argv[4])
+
+    if len(argv) > 5:
+        # 0 syncs journal to disk on every reactor iteration
+        JOURNAL_SYNC_INTERVAL = float(argv[5])
 
-if __name__ == '__main__':
     log.startLogging(sys.stdout)
+
+    # connect and replay journal as soon as reactor is started
+    reactor.callWhenRunning(APNSServiceListener.establish_connection)
+    reactor.listenTCP(LISTEN_PORT, factory)
+    log.msg("  > Starting APNS service "\
+                "listener on port %d ...\n\n" % LISTEN_PORT,
+            logLevel=logging.INFO)
     reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,296 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import multiprocessing.util
+
+from apnsexceptions import *
+from notifications import APNSNotification, APNSNotificationWrapper
+from tokens import TokenBatch
+
+
+__all__ = ('APNSShardedSender',)
+
+
+# wrapper of worker process, created by _initWorker
+_worker = None
+_errorTimeout = 1
+_shardSize = 10000
+# shared counter and condition of workers, see _drainWorker
+_barrier = None
+_processes = 1
+# (offset, count) of the last shard written by worker
+_last = None
+
+
+def _initWorker(certificate, sandbox, connectionFactory, errorTimeout, \
+                                    shardSize, barrier, processes, options):
+    """
+    Create and connect wrapper of worker process. Connection is
+    closed (and flushed) when worker process exits.
+    """
+    global _worker, _errorTimeout, _shardSize, _barrier, _processes
+
+    connection = None
+    if connectionFactory is not None:
+        connection = connectionFactory()
+
+    _worker = APNSNotificationWrapper(certificate, sandbox=sandbox, \
+                                        connection=connection, **options)
+    _errorTimeout = errorTimeout
+    _shardSize = shardSize
+    _barrier = barrier
+    _processes = processes
+    _worker.connect()
+    multiprocessing.util.Finalize(_worker, _worker.disconnect, \
+                                                        exitpriority=10)
+
+
+def _reconnect():
+    """
+    Open connection of worker again, so next shards
+    are not written to broken connection.
+    """
+    try:
+        _worker.disconnect()
+    except Exception:
+        pass
+    try:
+        _worker.connect()
+    except Exception:
+        pass
+
+
+def _check(timeout):
+    """
+    Check errors of shards written by worker, wait up to `timeout`
+    seconds. Return (failed, errors), errors is list of (offset,
+    error). In enhanced mode identifier of failed notification is
+    its global index plus one, recover() reconnects and resends the
+    notifications after it. Without enhanced format gateway just
+    closes connection, so all notifications of the last shard are
+    counted as failed.
+    """
+    global _last
+
+    errors = []
+    try:
+        if _worker.enhanced:
+            while True:
+                response = _worker.recover(timeout)
+                if response is None:
+                    break
+                offset = (response[1] - 1) // _shardSize * _shardSize
+                errors.append((offset, "status %d of notification %d" % \
+                                                                response))
+            return len(errors), errors
+
+        if not _worker.connection.readable(timeout):
+            return 0, errors
+        _worker.connection.read()
+    except Exception, e:
+        if _last is None:
+            _reconnect()
+            return 0, errors
+        errors.append((_last[0], repr(e)))
+    else:
+        if _last is None:
+            _reconnect()
+            return 0, errors
+        errors.append((_last[0], "connection closed by gateway"))
+
+    _reconnect()
+    offset, count = _last
+    _last = None
+    return count, errors
+
+
+def _sendShard(offset, count, send):
+    """
+    Write shard and check errors without waiting for them, so errors
+    of a shard are usually found while the next one is written.
+    Return (shards, sent, failed, errors) of shard and of errors of
+    previous shards found meanwhile.
+    """
+    global _last
+
+    failed, errors = _check(0)
+    _last = (offset, count)
+    try:
+        send()
+    except Exception, e:
+        _last = None
+        _reconnect()
+        return 1, -failed, count + failed, errors + [(offset, repr(e))]
+
+    shardFailed, shardErrors = _check(0)
+    failed += shardFailed
+    return 1, count - failed, failed, errors + shardErrors
+
+
+def _broadcastShard(args):
+    """
+    Send template to tokens of shard. Identifiers of enhanced
+    notifications are global indexes of tokens plus one.
+    """
+    template, tokenLength, offset, tokens = args
+    batch = TokenBatch(tokenLength=tokenLength)
+    batch.buffer = bytearray(tokens)
+
+    def send():
+        _worker.nextIdentifier = offset + 1
+        _worker.broadcast(template, batch)
+    return _sendShard(offset, len(batch), send)
+
+
+def _notifyShard(args):
+    """
+    Build and send notifications of shard.
+    """
+    offset, notifications = args
+
+    def send():
+        _worker.nextIdentifier = offset + 1
+        _worker.notify_stream(notifications)
+    return _sendShard(offset, len(notifications), send)
+
+
+def _drainWorker(ignored):
+    """
+    Wait up to errorTimeout for errors of the last shards. Every
+    worker waits on barrier until all workers took their drain
+    task, so every worker gets exactly one.
+    """
+    counter, condition = _barrier
+    with condition:
+        counter.value += 1
+        condition.notify_all()
+        while counter.value < _processes:
+            condition.wait()
+
+    failed, errors = _check(_errorTimeout)
+    return 0, -failed, failed, errors
+
+
+class APNSShardedSender(object):
+    """
+    Send notifications from many processes. Tokens or notifications
+    are split into shards of `shardSize` items, shards are built and
+    sent by `processes` worker processes, every worker has its own
+    connection to the gateway. Methods return dict with total count
+    of sent and failed notifications and list of (offset, error) of
+    failed shards.
+
+    `connectionFactory` should be module level callable which returns
+    connection for worker (APNSConnection by default), other keyword
+    arguments are passed to APNSNotificationWrapper of workers.
+    Workers check error-responses (or connection closed by gateway
+    without enhanced format) without waiting after every shard, and
+    wait up to `errorTimeout` seconds only once, after all shards are
+    sent. In enhanced mode notifications which follow the failed one
+    are sent again, without it the shard written before gateway closed
+    connection is counted as failed.
+    """
+    shardSize = 10000
+    errorTimeout = 1
+
+    def __init__(self, certificate=None, sandbox=True, processes=None, \
+                    shardSize=10000, connectionFactory=None, errorTimeout=1, \
+                                                                **options):
+        self.certificate = certificate
+        self.sandbox = sandbox
+        self.processes = processes or multiprocessing.cpu_count()
+        self.shardSize = shardSize
+        self.connectionFactory = connectionFactory
+        self.errorTimeout = errorTimeout
+        self.options = options
+        self.pool = None
+        self.barrier = None
+
+    def start(self):
+        """
+        Start worker processes and connect them to the gateway
+        """
+        if self.pool is None:
+            self.barrier = (multiprocessing.Value('i', 0), \
+                                            multiprocessing.Condition())
+            self.pool = multiprocessing.Pool(self.processes, _initWorker, \
+                        (self.certificate, self.sandbox, \
+                            self.connectionFactory, self.errorTimeout, \
+                            self.shardSize, self.barrier, self.processes, \
+                                                            self.options))
+        return self
+
+    def _gather(self, function, shards):
+        self.start()
+
+        result = {'sent': 0, 'failed': 0, 'shards': 0}
+        errors = {}
+
+        def add(results):
+            for shards, sent, failed, shardErrors in results:
+                result['shards'] += shards
+                result['sent'] += sent
+                result['failed'] += failed
+                for offset, error in shardErrors:
+                    errors.setdefault(offset, []).append(error)
+
+        add(self.pool.imap_unordered(function, shards))
+
+        # every worker waits for errors of its last shards
+        counter, condition = self.barrier
+        with condition:
+            counter.value = 0
+        add(self.pool.imap_unordered(_drainWorker, xrange(self.processes)))
+
+        result['errors'] = [(offset, ", ".join(errors[offset])) \
+                                                for offset in sorted(errors)]
+        return result
+
+    def broadcast(self, template=None, tokens=None):
+        """
+        Send the same notification to all `tokens`, which should
+        be TokenBatch or list of tokens in binary format.
+        """
+        if not isinstance(template, APNSNotification):
+            raise APNSTypeError("Unexpected argument type. Argument should "\
+                                "be an instance of APNSNotification object")
+
+        if not isinstance(tokens, TokenBatch):
+            batch = TokenBatch(tokenLength=template.deviceTokenLength)
+            for token in tokens:
+                batch.append(token)
+            tokens = batch
+
+        # tokens are passed to workers as binary strings
+        tokenLength = tokens.tokenLength
+        shards = ((template, tokenLength, offset, \
+                    tokens[offset:offset + self.shardSize].tostring()) \
+                    for offset in xrange(0, len(tokens), self.shardSize))
+        return self._gather(_broadcastShard, shards)
+
+    def notify(self, notifications=None):
+        """
+        Send list of APNSNotification or APNSCompactNotification.
+        Payloads of APNSNotification are built by workers.
+        """
+        shards = ((offset, notifications[offset:offset + self.shardSize]) \
+                for offset in xrange(0, len(notifications), self.shardSize))
+        return self._gather(_notifyShard, shards)
+
+    def close(self):
+        """
+        Wait until workers send all shards and stop them
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
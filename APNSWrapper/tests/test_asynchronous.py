@@ -0,0 +1,247 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+try:
+    from OpenSSL import crypto
+    from twisted.internet import defer, task
+    from twisted.test.proto_helpers import StringTransport
+    from APNSWrapper.asynchronous import APNSClientFactory, \
+                    AsyncAPNSConnection, AsyncAPNSNotificationWrapper
+except ImportError:
+    defer = None
+
+from APNSWrapper.apnsexceptions import APNSConnectionError
+from APNSWrapper.connection import APNSConnectionContext
+from APNSWrapper.notifications import APNSNotification
+
+
+class DeferredConnection(APNSConnectionContext):
+    """
+    Connection of AsyncAPNSConnection interface, every write
+    returns Deferred which is fired by test.
+    """
+    def __init__(self):
+        self.writes = []
+        self.errors = []
+        self.events = []
+
+    def connect(self, host, port):
+        self.events.append('connect')
+        return defer.succeed(self)
+
+    def write(self, data=None):
+        deferred = defer.Deferred()
+        self.writes.append((data, deferred))
+        return deferred
+
+    def readable(self, timeout=0):
+        return len(self.errors) > 0
+
+    def read(self, blockSize=6):
+        return self.errors.pop(0)
+
+    def close(self):
+        self.events.append('close')
+        # connection is closed later, writes should wait for it
+        self.closed = defer.Deferred()
+        return self.closed
+
+
+class AsyncNotificationWrapperTest(unittest.TestCase):
+    def setUp(self):
+        if defer is None:
+            self.skipTest("Twisted is not available")
+
+        self.connection = DeferredConnection()
+        self.clock = task.Clock()
+
+    def wrapper(self, **kwargs):
+        return AsyncAPNSNotificationWrapper(connection=self.connection, \
+                                            reactor=self.clock, **kwargs)
+
+    def result(self, deferred):
+        results = []
+        deferred.addBoth(results.append)
+        return results
+
+    def testNotifyWaitsForWrite(self):
+        wrapper = self.wrapper()
+        wrapper.append(APNSNotification().token('t' * 32).badge(1))
+        results = self.result(wrapper.notify())
+
+        self.assertEqual(len(self.connection.writes), 1)
+        self.assertEqual(results, [])
+        self.connection.writes[0][1].callback(None)
+        self.assertEqual(results, [True])
+
+    def testNotifyRawWaitsForWrite(self):
+        results = self.result(self.wrapper().notify_raw('raw data'))
+
+        self.assertEqual(results, [])
+        data, deferred = self.connection.writes[0]
+        self.assertEqual(data, 'raw data')
+        deferred.callback(None)
+        self.assertEqual(results, [True])
+
+    def testWriteFailure(self):
+        results = self.result(self.wrapper().notify_raw('raw data'))
+        self.connection.writes[0][1].errback(APNSConnectionError("lost"))
+
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0].check(APNSConnectionError))
+
+    def testRecover(self):
+        wrapper = self.wrapper(enhanced=True)
+        for identifier in (1, 2, 3):
+            wrapper.append(APNSNotification().token('t' * 32).badge(1)\
+                                                    .identifier(identifier))
+        wrapper.notify()
+        self.connection.writes.pop()[1].callback(None)
+        self.connection.errors.append(struct.pack("!BBI", 8, 8, 2))
+
+        results = self.result(wrapper.recover(timeout=1))
+        self.clock.advance(1)
+        # frames are not written until connection is closed
+        self.assertEqual(self.connection.events, ['close'])
+        self.assertEqual(self.connection.writes, [])
+
+        self.connection.closed.callback(None)
+        self.assertEqual(self.connection.events, ['close', 'connect'])
+        data, deferred = self.connection.writes[0]
+        self.assertEqual(struct.unpack_from("!I", data, 1)[0], 3)
+
+        self.assertEqual(results, [])
+        deferred.callback(None)
+        self.assertEqual(results, [(8, 2)])
+
+    def testRecoverWithoutError(self):
+        results = self.result(self.wrapper(enhanced=True).recover(timeout=1))
+        self.clock.advance(1)
+        self.assertEqual(results, [None])
+        self.assertEqual(self.connection.events, [])
+
+
+def _certificate(path):
+    """
+    Write self-signed certificate with private key to PEM file
+    """
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 1024)
+    certificate = crypto.X509()
+    certificate.get_subject().CN = 'APNSWrapper test'
+    certificate.set_serial_number(1)
+    certificate.gmtime_adj_notBefore(0)
+    certificate.gmtime_adj_notAfter(3600)
+    certificate.set_issuer(certificate.get_subject())
+    certificate.set_pubkey(key)
+    certificate.sign(key, 'sha256')
+
+    fh = open(path, 'w')
+    try:
+        fh.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+        fh.write(crypto.dump_certificate(crypto.FILETYPE_PEM, certificate))
+    finally:
+        fh.close()
+
+
+class AsyncConnectionTest(unittest.TestCase):
+    def setUp(self):
+        if defer is None:
+            self.skipTest("Twisted is not available")
+
+        self.path = tempfile.mkdtemp()
+        self.certificate = os.path.join(self.path, 'cert.pem')
+        _certificate(self.certificate)
+        self.rejected = []
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def connection(self, count=1, **kwargs):
+        """
+        AsyncAPNSConnection with `count` connections over
+        in-memory transports instead of TLS
+        """
+        connection = AsyncAPNSConnection(self.certificate, count, \
+                                        reactor=task.Clock(), **kwargs)
+        for index in range(count):
+            proto = APNSClientFactory(connection).buildProtocol(None)
+            proto.makeConnection(StringTransport())
+        return connection
+
+    def frame(self, identifier):
+        return APNSNotification().token('t' * 32).badge(1)\
+                            .payload(command=1, identifier=identifier)
+
+    def testFramesAfterErrorAreResent(self):
+        connection = self.connection(onError=lambda *args: \
+                                                    self.rejected.append(args))
+        for identifier in (1, 2, 3, 4):
+            connection.write(self.frame(identifier))
+
+        proto = connection.protocols[0]
+        proto.dataReceived(struct.pack("!BBI", 8, 8, 2))
+        self.assertEqual(self.rejected, [(8, 2, self.frame(3) + \
+                                                        self.frame(4))])
+        # failed connection is closed and not used for writes
+        self.assertTrue(proto.transport.disconnecting)
+        self.assertFalse(connection.isConnected())
+        self.assertEqual(connection.read(), "")
+
+    def testUnknownIdentifierResendsAllData(self):
+        connection = self.connection(onError=lambda *args: \
+                                                    self.rejected.append(args))
+        connection.sentSize = len(self.frame(1)) * 2
+        for identifier in (1, 2, 3, 4):
+            connection.write(self.frame(identifier))
+
+        # the oldest frames are forgotten
+        connection.protocols[0].dataReceived(struct.pack("!BBI", 8, 8, 1))
+        self.assertEqual(self.rejected, [(8, 1, self.frame(3) + \
+                                                        self.frame(4))])
+
+    def testErrorsAreBounded(self):
+        connection = self.connection()
+        connection.write(self.frame(1))
+        packets = [struct.pack("!BBI", 8, 8, identifier) \
+                    for identifier in range(connection.maxErrors + 5)]
+        connection.protocols[0].dataReceived("".join(packets))
+
+        self.assertEqual(len(connection.errors), connection.maxErrors)
+        self.assertEqual(connection.read(), packets[5])
+        self.assertEqual(len(connection.protocols[0].sent), 0)
+
+    def testWritesGoToLeastLoadedConnection(self):
+        connection = self.connection(3, concurrency=3)
+        first, second, third = connection.protocols
+        first.pauseProducing()
+        second.pauseProducing()
+
+        # connection with free transport buffer is preferred
+        connection.write('a')
+        third.pauseProducing()
+
+        # then connection with less writes waiting for drain
+        for data in ('b', 'c', 'd'):
+            connection.write(data)
+        self.assertEqual([proto.pending for proto in connection.protocols], \
+                                                                [1, 1, 1])
+
+        second.resumeProducing()
+        connection.write('e')
+        self.assertEqual([proto.transport.value() for proto in \
+                                connection.protocols], ['b', 'ce', 'ad'])
@@ -0,0 +1,148 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import unittest
+
+from APNSWrapper.apnsexceptions import APNSConnectionError
+from APNSWrapper.background import APNSBackgroundNotificationWrapper
+from APNSWrapper.connection import APNSConnectionContext
+from APNSWrapper.notifications import APNSNotification
+
+
+TOKEN = '\x01' * 32
+
+
+class QueueConnection(APNSConnectionContext):
+    """
+    Connection which keeps written data, fails `failures` next
+    writes and blocks writes while `gate` is not set
+    """
+    def __init__(self):
+        self.writes = []
+        self.failures = 0
+        self.flushes = 0
+        self.connects = 0
+        self.closes = 0
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def connect(self, host, port):
+        self.connects += 1
+
+    def write(self, data=None):
+        self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise APNSConnectionError("write failed")
+        self.writes.append(data)
+
+    def flush(self):
+        self.flushes += 1
+
+    def readable(self, timeout=0):
+        return False
+
+    def close(self):
+        self.closes += 1
+
+
+class BackgroundWrapperTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = QueueConnection()
+        # failed sends are logged with traceback
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def wrapper(self, **kwargs):
+        wrapper = APNSBackgroundNotificationWrapper( \
+                                connection=self.connection, **kwargs)
+        wrapper.connect()
+        return wrapper
+
+    def notification(self, badge=1):
+        return APNSNotification().token(TOKEN).badge(badge)
+
+    def testNotificationsFromThreads(self):
+        wrapper = self.wrapper()
+        threads = [threading.Thread(target=lambda: [wrapper.append( \
+                    self.notification()) for i in range(50)]) \
+                    for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        wrapper.flush()
+        self.assertEqual(wrapper.sentCount, 200)
+        self.assertEqual(len("".join(self.connection.writes)), \
+                                200 * len(self.notification().payload()))
+        flushes = self.connection.flushes
+
+        # flush of wrapper flushes connection too
+        wrapper.flush()
+        self.assertEqual(self.connection.flushes, flushes + 1)
+        wrapper.close()
+
+    def testFailedSendIsReported(self):
+        errors = []
+        wrapper = self.wrapper(onError=lambda error, notifications: \
+                                    errors.append((error, notifications)))
+        self.connection.failures = 1
+        failed = self.notification(1)
+        wrapper.append(failed)
+        wrapper.flush()
+
+        self.assertEqual(wrapper.failedCount, 1)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0][0], APNSConnectionError))
+        self.assertEqual(errors[0][1], [failed])
+        # connection is reopened for next notifications
+        self.assertEqual((self.connection.closes, \
+                                    self.connection.connects), (1, 2))
+
+        wrapper.append(self.notification(2))
+        wrapper.close()
+        self.assertEqual(wrapper.sentCount, 1)
+        self.assertEqual(len(self.connection.writes), 1)
+
+    def testDropWhenFull(self):
+        wrapper = self.wrapper(queueSize=1, whenFull='drop', batchSize=1)
+        self.connection.gate.clear()
+        try:
+            # first is taken by blocked sender, second fills the queue
+            self.assertTrue(wrapper.append(self.notification()))
+            while wrapper.count():
+                pass
+            self.assertTrue(wrapper.append(self.notification()))
+            self.assertFalse(wrapper.append(self.notification()))
+            self.assertEqual(wrapper.droppedCount, 1)
+        finally:
+            self.connection.gate.set()
+        wrapper.close()
+        self.assertEqual(wrapper.sentCount, 2)
+
+    def testAppendAfterClose(self):
+        wrapper = self.wrapper()
+        wrapper.append(self.notification())
+        wrapper.close()
+        self.assertEqual(wrapper.sentCount, 1)
+        self.assertRaises(APNSConnectionError, wrapper.append, \
+                                                        self.notification())
+
+    def testAppendBeforeConnect(self):
+        wrapper = APNSBackgroundNotificationWrapper( \
+                                            connection=self.connection)
+        self.assertRaises(APNSConnectionError, wrapper.append, \
+                                                        self.notification())
@@ -0,0 +1,456 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+
+from APNSWrapper.apnsexceptions import APNSConnectionError
+from APNSWrapper.connection import APNSBufferedConnection, \
+            APNSConnectionContext, APNSConnectionPool, \
+            APNSResilientConnection, APNSServiceConnection, \
+            OpenSSLCommandLine, SERVICE_FRAME_HEADER, \
+            SERVICE_FRAME_HEADER_LENGTH, SERVICE_ACK_OK, SERVICE_ACK_ERROR
+from APNSWrapper.notifications import APNSNotification, \
+                                        APNSNotificationWrapper
+
+
+class RecordingConnection(APNSConnectionContext):
+    """
+    Connection which keeps written data in memory
+    """
+    opened = []
+
+    def __init__(self, certificate=None):
+        self.data = []
+        self.closed = False
+        RecordingConnection.opened.append(self)
+
+    def connect(self, host, port):
+        pass
+
+    def write(self, data=None):
+        if self.closed:
+            raise IOError("connection is closed")
+        self.data.append(data)
+
+    def readable(self, timeout=0):
+        return False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        RecordingConnection.opened = []
+
+    def shared(self):
+        return APNSConnectionPool.shared('cert.pem', \
+                    APNSNotificationWrapper.apnsSandboxHost, \
+                    APNSNotificationWrapper.apnsPort, size=2, \
+                    factory=RecordingConnection)
+
+    def testSharedPoolIsKeptForOtherWrappers(self):
+        first = APNSNotificationWrapper(connection=self.shared())
+        second = APNSNotificationWrapper(connection=self.shared())
+        self.assertTrue(first.connection is second.connection)
+        first.connect()
+        second.connect()
+
+        first.disconnect()
+        second.notify_raw('data')
+        self.assertEqual(len(RecordingConnection.opened), 2)
+        self.assertEqual(sum([len(c.data) for c in \
+                                        RecordingConnection.opened]), 1)
+
+        second.disconnect()
+        self.assertTrue(second.connection.closed.is_set())
+        self.assertEqual([c.closed for c in RecordingConnection.opened], \
+                                                                [True, True])
+        self.assertRaises(APNSConnectionError, second.notify_raw, 'data')
+
+        # pool closed by all users is not shared any more
+        pool = self.shared()
+        self.assertFalse(pool is second.connection)
+        pool.close()
+
+    def testOwnPoolIsClosed(self):
+        pool = APNSConnectionPool(size=2, factory=RecordingConnection)
+        wrapper = APNSNotificationWrapper(connection=pool)
+        wrapper.connect()
+        wrapper.disconnect()
+        self.assertEqual([c.closed for c in RecordingConnection.opened], \
+                                                                [True, True])
+
+        # and may be connected again
+        wrapper.connect()
+        wrapper.notify_raw('data')
+        wrapper.disconnect()
+        self.assertEqual(len(RecordingConnection.opened), 4)
+
+
+
+class FlakyConnection(RecordingConnection):
+    """
+    Connection which fails `failures` next writes, counts
+    flushes and may be connected again after close
+    """
+    def __init__(self, certificate=None):
+        RecordingConnection.__init__(self, certificate)
+        self.failures = 0
+        self.flushes = 0
+        self.connects = 0
+
+    def connect(self, host, port):
+        self.closed = False
+        self.connects += 1
+
+    def write(self, data=None):
+        if self.failures:
+            self.failures -= 1
+            raise APNSConnectionError("write failed")
+        RecordingConnection.write(self, data)
+
+    def flush(self):
+        self.flushes += 1
+
+
+class BufferedConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = FlakyConnection()
+
+    def buffered(self, **kwargs):
+        buffered = APNSBufferedConnection(self.connection, **kwargs)
+        buffered.connect('gateway.push.apple.com', 2195)
+        return buffered
+
+    def testWritesAreCoalesced(self):
+        buffered = self.buffered(bufferSize=10, flushDelay=None)
+        for data in ('abc', 'def', 'ghi'):
+            buffered.write(data)
+        self.assertEqual(self.connection.data, [])
+
+        buffered.write('jkl')
+        self.assertEqual(self.connection.data, ['abcdefghijkl'])
+        self.assertEqual(self.connection.flushes, 1)
+
+        buffered.write('mno')
+        buffered.close()
+        self.assertEqual(self.connection.data, ['abcdefghijkl', 'mno'])
+        self.assertTrue(self.connection.closed)
+
+    def testBufferIsKeptWhenWriteFails(self):
+        buffered = self.buffered(flushDelay=None)
+        buffered.write('abc')
+        self.connection.failures = 1
+        self.assertRaises(APNSConnectionError, buffered.flush)
+
+        buffered.write('def')
+        buffered.flush()
+        self.assertEqual(self.connection.data, ['abcdef'])
+        buffered.close()
+
+    def testDelayedFlush(self):
+        buffered = self.buffered(flushDelay=0.01)
+        try:
+            buffered.write('abc')
+            deadline = time.time() + 5
+            while not self.connection.data and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.connection.data, ['abc'])
+        finally:
+            buffered.close()
+
+    def testErrorOfDelayedFlush(self):
+        buffered = self.buffered(flushDelay=0.01)
+        try:
+            self.connection.failures = 1
+            buffered.write('abc')
+            deadline = time.time() + 5
+            while buffered.error is None and time.time() < deadline:
+                time.sleep(0.01)
+
+            # error is raised by next call, data is written after it
+            self.assertRaises(APNSConnectionError, buffered.write, 'def')
+            deadline = time.time() + 5
+            while not self.connection.data and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.connection.data, ['abc'])
+        finally:
+            buffered.close()
+
+    def testNotifyFlushesConnection(self):
+        # e.g. uncorks TCP_CORK socket of APNSConnection
+        wrapper = APNSNotificationWrapper(connection=self.connection)
+        wrapper.append(APNSNotification().token('t' * 32).badge(1))
+        wrapper.notify()
+        self.assertEqual(self.connection.flushes, 1)
+
+        wrapper.broadcast(APNSNotification().badge(1), ['t' * 32])
+        self.assertEqual(self.connection.flushes, 2)
+
+
+
+class ResilientConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = FlakyConnection()
+
+    def resilient(self, **kwargs):
+        resilient = APNSResilientConnection(self.connection, backoff=0, \
+                                                                **kwargs)
+        resilient.connect('gateway.push.apple.com', 2195)
+        return resilient
+
+    def testInflightDataIsReplayed(self):
+        resilient = self.resilient()
+        resilient.write('a')
+        resilient.write('b')
+
+        self.connection.failures = 1
+        resilient.write('c')
+        self.assertEqual(self.connection.connects, 2)
+        self.assertEqual(self.connection.data, ['a', 'b', 'a', 'b', 'c'])
+        self.assertEqual((resilient.reconnects, resilient.replayed), (1, 3))
+
+    def testInflightSize(self):
+        resilient = self.resilient(inflightSize=2)
+        for data in ('a', 'b', 'c'):
+            resilient.write(data)
+
+        self.connection.failures = 1
+        resilient.write('d')
+        self.assertEqual(self.connection.data[3:], ['c', 'd'])
+
+    def testReconnectAfterIdle(self):
+        resilient = self.resilient(inflightAge=0.05)
+        resilient.write('a')
+        time.sleep(0.1)
+
+        # data older than error-response window is not written again
+        self.connection.failures = 1
+        resilient.write('b')
+        self.assertEqual(self.connection.data, ['a', 'b'])
+
+    def testCheckedDataIsNotReplayed(self):
+        resilient = self.resilient()
+        resilient.write('a')
+        self.assertFalse(resilient.readable(0.01))
+
+        self.connection.failures = 1
+        resilient.write('b')
+        self.assertEqual(self.connection.data, ['a', 'b'])
+
+    def testRetriesAreLimited(self):
+        resilient = self.resilient(retries=2)
+        self.connection.failures = 3
+        self.assertRaises(APNSConnectionError, resilient.write, 'a')
+        self.assertTrue(resilient.broken)
+
+        # next write reconnects again
+        resilient.write('b')
+        self.assertEqual(self.connection.data, ['a', 'b'])
+
+
+# stands in for openssl s_client: echoes input, like gateway
+# which would send error-responses back
+ECHO = """
+import os
+while True:
+    data = os.read(0, 1024)
+    if not data:
+        break
+    os.write(1, data)
+"""
+
+
+class EchoCommandLine(OpenSSLCommandLine):
+    """
+    Persistent OpenSSLCommandLine which runs python echo
+    process instead of openssl s_client
+    """
+    def _arguments(self):
+        return [sys.executable, '-u', '-c', ECHO]
+
+
+class PersistentCommandLineTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = EchoCommandLine(persistent=True, processes=2)
+        self.connection.closeTimeout = 5
+
+    def tearDown(self):
+        self.connection.close()
+
+    def received(self, length):
+        data = ""
+        deadline = time.time() + 5
+        while len(data) < length and time.time() < deadline:
+            if self.connection.readable(0.1):
+                data += self.connection.read()
+        return data
+
+    def testWritesAreStreamedToProcesses(self):
+        self.connection.connect('gateway.push.apple.com', 2195)
+        pipes = list(self.connection.pipes)
+        self.assertEqual(len(pipes), 2)
+
+        for data in ('a', 'b', 'c', 'd'):
+            self.connection.write(data)
+        self.assertEqual(sorted(self.received(4)), ['a', 'b', 'c', 'd'])
+
+        # processes are kept alive between writes
+        self.assertEqual(self.connection.pipes, pipes)
+        self.assertEqual([pipe.poll() for pipe in pipes], [None, None])
+
+    def testDeadProcessIsRestarted(self):
+        self.connection.connect('gateway.push.apple.com', 2195)
+        dead = self.connection.pipes[0]
+        dead.kill()
+        dead.wait()
+
+        self.connection.write('a')
+        self.assertEqual(self.connection.restarts, 1)
+        self.assertFalse(self.connection.pipes[0] is dead)
+        self.assertEqual(self.received(1), 'a')
+
+    def testClose(self):
+        self.connection.connect('gateway.push.apple.com', 2195)
+        pipes = list(self.connection.pipes)
+        self.connection.close()
+
+        self.assertEqual(self.connection.pipes, [])
+        self.assertEqual([pipe.returncode for pipe in pipes], [0, 0])
+        self.assertRaises(APNSConnectionError, self.connection.write, 'a')
+
+
+class ServiceStandIn(threading.Thread):
+    """
+    Stands in for service.py: answers negotiation with `reply` (or
+    doesn't answer if it's None, like old service), receives messages
+    and acknowledges them if asked, message 'bad' is rejected.
+    """
+    def __init__(self, reply):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.reply = reply
+        self.messages = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        sock = self.listener.accept()[0]
+        self.listener.close()
+        stream = sock.makefile('rb')
+        stream.readline()
+
+        reply = self.reply or {}
+        if self.reply is not None:
+            sock.sendall(json.dumps(reply) + "\r\n")
+
+        while True:
+            if reply.get('framing') == APNSServiceConnection.BINARY:
+                header = stream.read(SERVICE_FRAME_HEADER_LENGTH)
+                if not header:
+                    break
+                length, identifier = struct.unpack(SERVICE_FRAME_HEADER, \
+                                                                    header)
+                data = stream.read(length)
+            else:
+                line = stream.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                identifier = int(message['id'].lstrip('#'))
+                data = base64.standard_b64decode(message['message'])
+
+            self.messages.append(data)
+            if reply.get('acks'):
+                sock.sendall(self.ack(reply, identifier, data != 'bad'))
+        sock.close()
+
+    def ack(self, reply, identifier, ok):
+        if reply.get('framing') == APNSServiceConnection.BINARY:
+            if ok:
+                body = chr(SERVICE_ACK_OK)
+            else:
+                body = chr(SERVICE_ACK_ERROR) + 'rejected'
+            return struct.pack(SERVICE_FRAME_HEADER, len(body), \
+                                                        identifier) + body
+
+        ack = {'id': '#%d' % identifier, 'status': 'ok'}
+        if not ok:
+            ack.update(status='error', error='rejected')
+        return json.dumps(ack) + "\r\n"
+
+
+class ServiceConnectionTest(unittest.TestCase):
+    def connection(self, reply, **kwargs):
+        self.service = ServiceStandIn(reply)
+        self.service.start()
+        connection = APNSServiceConnection(port=self.service.port, **kwargs)
+        connection.negotiationTimeout = 0.1
+        return connection
+
+    def finish(self, connection):
+        connection.close()
+        self.service.join(5)
+
+    def testBinaryBatchWithAcks(self):
+        connection = self.connection({'framing': 'binary', 'acks': True}, \
+                                            framing='binary', acks=True)
+        try:
+            ids = connection.writeMany(['a', 'bad', 'c' * 35000])
+            self.assertEqual(connection.framing, 'binary')
+            self.assertEqual(sorted(connection.results()), [
+                            (ids[0], True, None), (ids[1], False, 'rejected'),
+                            (ids[2], True, None)])
+            self.assertEqual(connection.outstanding, set())
+        finally:
+            self.finish(connection)
+
+        self.assertEqual(self.service.messages, ['a', 'bad', 'c' * 35000])
+
+    def testWindowOfOutstandingAcks(self):
+        connection = self.connection({'acks': True}, acks=True, window=2)
+        try:
+            ids = connection.writeMany(['m%d' % i for i in range(5)] + \
+                                                                    ['bad'])
+            self.assertTrue(len(connection.outstanding) <= 2)
+            results = connection.results()
+            results.extend(connection.results(wait=False))
+        finally:
+            self.finish(connection)
+
+        self.assertEqual(connection.framing, 'json')
+        self.assertEqual(sorted(results), sorted([(i, True, None) \
+                    for i in ids[:5]] + [(ids[5], False, 'rejected')]))
+        self.assertEqual(self.service.messages, \
+                                ['m%d' % i for i in range(5)] + ['bad'])
+
+    def testServiceWithoutNegotiation(self):
+        connection = self.connection(None, framing='binary', acks=True)
+        try:
+            ids = connection.writeMany(['a', 'b'])
+            self.assertEqual((connection.framing, connection.acks), \
+                                                            ('json', False))
+            self.assertEqual(connection.results(), [])
+        finally:
+            self.finish(connection)
+
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(self.service.messages, ['a', 'b'])
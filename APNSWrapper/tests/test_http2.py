@@ -0,0 +1,258 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import binascii
+import socket
+import threading
+import unittest
+
+from APNSWrapper.http2 import h2, HTTP2Connection, _unpack
+from APNSWrapper.notifications import APNSNotificationWrapper, _pack
+
+
+TOKEN = '\x01' * 32
+BAD_TOKEN = '\x02' * 32
+
+
+class HTTP2StandInServer(object):
+    """
+    Local HTTP/2 server (prior knowledge, no TLS) which answers like
+    APNS provider API. Responses are sent only when `batch` streams
+    are received, so client has to keep them open concurrently.
+    With `goaway` server answers only that count of streams of the
+    first batch, sends GOAWAY and closes connection.
+    """
+    def __init__(self, batch, goaway=None):
+        self.batch = batch
+        self.goaway = goaway
+        self.requests = []
+        self.maxOpen = 0
+        self.connections = 0
+
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.listener.settimeout(0.05)
+        self.port = self.listener.getsockname()[1]
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _serve(self):
+        while not self.stopped:
+            try:
+                sock, address = self.listener.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                return
+            sock.settimeout(None)
+            self.connections += 1
+            try:
+                self._serveConnection(sock)
+            finally:
+                sock.close()
+
+    def _serveConnection(self, sock):
+        connection = h2.connection.H2Connection(\
+                    config=h2.config.H2Configuration(client_side=False))
+        connection.initiate_connection()
+        sock.sendall(connection.data_to_send())
+
+        streams = {}
+        ended = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                return
+
+            for event in connection.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    streams[event.stream_id] = [dict(event.headers), []]
+                    self.maxOpen = max(self.maxOpen, len(streams))
+                elif isinstance(event, h2.events.DataReceived):
+                    streams[event.stream_id][1].append(event.data)
+                    connection.acknowledge_received_data(\
+                            event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    ended.append(event.stream_id)
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    return
+
+            if len(ended) >= self.batch:
+                if self.goaway is not None:
+                    ended.sort()
+                    for streamId in ended[:self.goaway]:
+                        self._respond(connection, streamId, \
+                                                    *streams.pop(streamId))
+                    connection.close_connection(last_stream_id=\
+                        ended[self.goaway - 1], \
+                        additional_data='{"reason":"Shutdown"}')
+                    sock.sendall(connection.data_to_send())
+                    self.goaway = None
+                    return
+
+                for streamId in ended:
+                    self._respond(connection, streamId, \
+                                                    *streams.pop(streamId))
+                ended = []
+            sock.sendall(connection.data_to_send())
+
+    def _respond(self, connection, streamId, headers, body):
+        self.requests.append((headers, "".join(body)))
+        if headers[':path'].endswith(binascii.hexlify(BAD_TOKEN)):
+            connection.send_headers(streamId, [(':status', '400')])
+            connection.send_data(streamId, '{"reason":"BadDeviceToken"}', \
+                                                            end_stream=True)
+        else:
+            connection.send_headers(streamId, [(':status', '200')], \
+                                                            end_stream=True)
+
+    def close(self):
+        self.stopped = True
+        self.thread.join(5)
+        self.listener.close()
+
+
+class UnpackTest(unittest.TestCase):
+    def testSimpleFrame(self):
+        frame = _pack(0, TOKEN, '{"aps":{}}')
+        self.assertEqual(_unpack(frame, 0), \
+                        (len(frame), TOKEN, '{"aps":{}}', None, None, None))
+
+    def testEnhancedFrame(self):
+        frame = _pack(1, TOKEN, '{}', identifier=7, expiry=1300000000)
+        self.assertEqual(_unpack(frame, 0), \
+                        (len(frame), TOKEN, '{}', 7, 1300000000, None))
+
+    def testItemsFrame(self):
+        frame = _pack(2, TOKEN, '{}', identifier=9, expiry=5, priority=5)
+        self.assertEqual(_unpack(frame, 0), (len(frame), TOKEN, '{}', 9, 5, 5))
+
+    def testFramesAtOffset(self):
+        first = _pack(1, TOKEN, '{"a":1}', identifier=1)
+        second = _pack(2, BAD_TOKEN, '{"b":2}', identifier=2)
+        data = first + second
+
+        offset, token, payload = _unpack(data, 0)[:3]
+        self.assertEqual((offset, token, payload), \
+                                            (len(first), TOKEN, '{"a":1}'))
+        self.assertEqual(_unpack(data, offset)[:4], \
+                                    (len(data), BAD_TOKEN, '{"b":2}', 2))
+
+    def testIncompleteFrame(self):
+        for command in (0, 1, 2):
+            frame = _pack(command, TOKEN, '{"aps":{"badge":1}}')
+            for end in (0, 4, 10, len(frame) - 1):
+                self.assertEqual(_unpack(frame[:end], 0), None)
+
+
+class HTTP2ConnectionTest(unittest.TestCase):
+    def setUp(self):
+        if h2 is None:
+            self.skipTest("h2 module is not available")
+
+    def testMultiplexedStreams(self):
+        server = HTTP2StandInServer(batch=5)
+        connection = HTTP2Connection(topic='com.example.app', \
+                    host='127.0.0.1', port=server.port, secure=False)
+        wrapper = APNSNotificationWrapper(connection=connection, command=2)
+        try:
+            wrapper.connect()
+
+            tokens = [TOKEN, TOKEN, BAD_TOKEN, TOKEN, TOKEN]
+            frames = "".join([_pack(2, token, '{"n":%d}' % index, \
+                                identifier=index, expiry=60, priority=5) \
+                                for index, token in enumerate(tokens)])
+            # frame split between writes is kept until the rest comes
+            wrapper.notify_raw(frames[:50])
+            wrapper.notify_raw(frames[50:])
+
+            responses = sorted(connection.responses())
+        finally:
+            wrapper.disconnect()
+            server.close()
+
+        self.assertEqual(server.maxOpen, 5)
+        self.assertEqual(responses, [
+                (0, TOKEN, 200, None),
+                (1, TOKEN, 200, None),
+                (2, BAD_TOKEN, 400, 'BadDeviceToken'),
+                (3, TOKEN, 200, None),
+                (4, TOKEN, 200, None)])
+
+        headers, body = server.requests[0]
+        self.assertEqual(headers[':method'], 'POST')
+        self.assertEqual(headers['apns-topic'], 'com.example.app')
+        self.assertEqual(headers['apns-expiration'], '60')
+        self.assertEqual(headers['apns-priority'], '5')
+        self.assertTrue(headers[':path'].startswith('/3/device/'))
+        self.assertEqual(sorted([body for headers, body in server.requests]), \
+                        ['{"n":%d}' % index for index in range(5)])
+
+    def testConcurrencyLimit(self):
+        server = HTTP2StandInServer(batch=2)
+        connection = HTTP2Connection(host='127.0.0.1', port=server.port, \
+                                    secure=False, maxConcurrentStreams=2)
+        connection.connect('gateway.push.apple.com', 2195)
+        try:
+            for identifier in range(6):
+                connection.send(TOKEN, '{}', identifier)
+            statuses = [status for identifier, token, status, reason \
+                                                in connection.responses()]
+        finally:
+            connection.close()
+            server.close()
+
+        self.assertEqual(server.maxOpen, 2)
+        self.assertEqual(statuses, [200] * 6)
+
+    def testGoawayRetriesRefusedStreams(self):
+        server = HTTP2StandInServer(batch=5, goaway=2)
+        connection = HTTP2Connection(host='127.0.0.1', port=server.port, \
+                                                                secure=False)
+        connection.connect('gateway.push.apple.com', 2195)
+        try:
+            for identifier in range(5):
+                connection.send(TOKEN, '{"n":%d}' % identifier, identifier)
+            server.batch = 1
+            responses = sorted(connection.responses())
+            # new streams go to the new connection
+            connection.send(TOKEN, '{}', 5)
+            responses.extend(connection.responses())
+        finally:
+            connection.close()
+            server.close()
+
+        self.assertEqual(server.connections, 2)
+        self.assertEqual(responses, [(identifier, TOKEN, 200, None) \
+                                            for identifier in range(6)])
+        self.assertEqual(sorted([body for headers, body in server.requests]), \
+                ['{"n":%d}' % index for index in range(5)] + ['{}'])
+
+    def testCloseOfDeadConnection(self):
+        server = HTTP2StandInServer(batch=1)
+        connection = HTTP2Connection(host='127.0.0.1', port=server.port, \
+                                                                secure=False)
+        connection.connect('gateway.push.apple.com', 2195)
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+            connection.close()
+        finally:
+            server.close()
+
+        self.assertEqual((connection.sock, connection.h2), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import shutil
+import tempfile
+import unittest
+
+from APNSWrapper.apnsexceptions import APNSValueError
+from APNSWrapper.journal import APNSJournal, RECORD_HEADER_LENGTH
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def open(self, segmentSize=1000):
+        return APNSJournal(self.path, segmentSize=segmentSize)
+
+    def testAppendAndReplay(self):
+        journal = self.open()
+        offsets = [journal.append('record%d' % i) for i in range(3)]
+        self.assertEqual(list(journal.replay()), \
+                [(offset, 'record%d' % i) for i, offset in enumerate(offsets)])
+        self.assertEqual(journal.pending(), offsets[-1])
+        journal.close()
+
+    def testEmptyRecord(self):
+        journal = self.open()
+        self.assertRaises(APNSValueError, journal.append, '')
+        journal.close()
+
+    def testReopenWithoutClose(self):
+        journal = self.open()
+        offsets = [journal.append('x%02d' % i) for i in range(10)]
+        journal.ack(offsets[3])
+        journal.sync()
+        del journal
+
+        journal = self.open()
+        self.assertEqual([data for end, data in journal.replay()], \
+                                        ['x%02d' % i for i in range(4, 10)])
+        self.assertEqual(journal.offset, offsets[-1])
+        journal.close()
+
+    def testTornRecord(self):
+        journal = self.open()
+        end = journal.append('complete')
+        segment = journal.segments[-1]
+        journal.append('torn record')
+        # broken checksum, as if process died in the middle of write
+        segment.map[end + RECORD_HEADER_LENGTH] = 'X'
+        journal.close()
+
+        journal = self.open()
+        self.assertEqual(list(journal.replay()), [(end, 'complete')])
+        self.assertEqual(journal.append('next') > end, True)
+        journal.close()
+
+    def testSegmentsAndCompact(self):
+        journal = self.open(segmentSize=100)
+        offsets = [journal.append('r' * 40) for i in range(6)]
+        self.assertEqual(len(journal.segments), 3)
+
+        journal.ack(offsets[2])
+        self.assertEqual(journal.compact(), 1)
+        self.assertEqual(len(journal.segments), 2)
+        self.assertEqual([end for end, data in journal.replay()], offsets[3:])
+
+        journal.ack(offsets[3])
+        self.assertEqual(journal.compact(), 1)
+        self.assertEqual(len(journal.segments), 1)
+        self.assertEqual([end for end, data in journal.replay()], offsets[4:])
+
+        # record larger than segment gets its own segment
+        big = journal.append('B' * 500)
+        self.assertEqual(list(journal.replay())[-1], (big, 'B' * 500))
+        journal.close()
+
+        journal = self.open(segmentSize=100)
+        self.assertEqual([end for end, data in journal.replay()], \
+                                                        offsets[4:] + [big])
+        journal.close()
+
+    def testAckEverything(self):
+        journal = self.open(segmentSize=100)
+        for i in range(5):
+            journal.ack(journal.append('r' * 40))
+        journal.compact()
+        journal.close()
+
+        journal = self.open(segmentSize=100)
+        self.assertEqual(list(journal.replay()), [])
+        self.assertEqual(journal.pending(), 0)
+        journal.close()
+
+    def testCompactKeepsReplayedSegments(self):
+        journal = self.open(segmentSize=100)
+        offsets = [journal.append('r' * 40) for i in range(6)]
+        replay = journal.replay()
+        self.assertEqual(replay.next(), (offsets[0], 'r' * 40))
+
+        # records are acknowledged while they are replayed
+        journal.ack(offsets[-1])
+        self.assertEqual(journal.compact(), 0)
+        self.assertEqual([end for end, data in replay], offsets[1:])
+
+        self.assertEqual(journal.compact(), 2)
+        journal.close()
+
+    def testReplayUpToOffset(self):
+        journal = self.open()
+        offsets = [journal.append('record%d' % i) for i in range(3)]
+        replay = journal.replay(offsets[1])
+        journal.append('appended during replay')
+        self.assertEqual([end for end, data in replay], offsets[:2])
+        journal.close()
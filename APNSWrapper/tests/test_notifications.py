@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import struct
+import unittest
+
+from APNSWrapper.apnsexceptions import APNSConnectionError, \
+                        APNSPayloadLengthError, APNSUndefinedDeviceToken, \
+                        APNSValueError
+from APNSWrapper.connection import APNSConnectionContext
+from APNSWrapper.http2 import _unpack
+from APNSWrapper.notifications import APNSAlert, APNSNotification, \
+                        APNSNotificationWrapper, APNSPayloadCache, APNSProperty, \
+                        _truncate
+from APNSWrapper.tokens import TokenBatch
+
+
+TOKENS = [chr(i) * 32 for i in range(1, 4)]
+
+
+class MemoryConnection(APNSConnectionContext):
+    """
+    Connection which keeps written data in memory
+    """
+    def __init__(self):
+        self.writes = []
+
+    def connect(self, host, port):
+        pass
+
+    def write(self, data=None):
+        self.writes.append(data)
+
+    def readable(self, timeout=0):
+        return False
+
+    def close(self):
+        pass
+
+    def data(self):
+        return "".join(self.writes)
+
+
+class PayloadTest(unittest.TestCase):
+    def testEscapedAlert(self):
+        message = APNSNotification().alert('C:\\dir\n"quoted"\x01')
+        self.assertEqual(json.loads(message.build()), \
+                        {u'aps': {u'alert': u'C:\\dir\n"quoted"\x01'}})
+
+    def testUnicodeAlert(self):
+        alert = APNSAlert().body(u'Привіт, "світ"')
+        alert.loc_args([u'ї', 'a\\b'])
+        message = APNSNotification().alert(alert).badge(2)
+        self.assertEqual(json.loads(message.build()), {u'aps': {
+                        u'alert': {u'body': u'Привіт, "світ"', \
+                                    u'loc-args': [u'ї', u'a\\b']}, \
+                        u'badge': 2}})
+
+    def testProperties(self):
+        message = APNSNotification()
+        message.appendProperty(APNSProperty('int', 42), \
+                        APNSProperty('float', 0.5), \
+                        APNSProperty('list', (1, 'two\n', u'три')), \
+                        APNSProperty('quote"d', 'x'))
+        self.assertEqual(json.loads(message.build()), {u'int': 42, \
+                        u'float': 0.5, u'list': [1, u'two\n', u'три'], \
+                        u'quote"d': u'x'})
+
+
+class BroadcastTest(unittest.TestCase):
+    def template(self, token=None):
+        message = APNSNotification().alert(u'Привіт').badge(3)
+        message.expiry(1300000000).priority(5)
+        if token:
+            message.token(token)
+        return message
+
+    def assertSameAsNotify(self, **kwargs):
+        notified = MemoryConnection()
+        wrapper = APNSNotificationWrapper(connection=notified, **kwargs)
+        for token in TOKENS:
+            wrapper.append(self.template(token))
+        wrapper.notify()
+
+        broadcasted = MemoryConnection()
+        wrapper = APNSNotificationWrapper(connection=broadcasted, **kwargs)
+        self.assertTrue(wrapper.broadcast(self.template(), TOKENS))
+        self.assertEqual(broadcasted.data(), notified.data())
+        return broadcasted.data()
+
+    def testSimpleFormat(self):
+        data = self.assertSameAsNotify()
+        self.assertEqual(ord(data[0]), 0)
+
+    def testCommandOfWrapper(self):
+        self.assertEqual(ord(self.assertSameAsNotify(command=0)[0]), 0)
+
+    def testEnhancedFormat(self):
+        self.assertEqual(ord(self.assertSameAsNotify(enhanced=True)[0]), 1)
+
+    def testFrameFormat(self):
+        self.assertEqual(ord(self.assertSameAsNotify(command=2)[0]), 2)
+
+    def testTokenBatch(self):
+        connection = MemoryConnection()
+        wrapper = APNSNotificationWrapper(connection=connection, command=2)
+        wrapper.broadcast(self.template(), TokenBatch("".join(TOKENS)))
+        self.assertEqual(connection.data(), self.assertSameAsNotify(command=2))
+
+    def testPayloadLimitOfFormat(self):
+        template = APNSNotification().alert('x' * 1000)
+        wrapper = APNSNotificationWrapper(connection=MemoryConnection())
+        self.assertRaises(APNSPayloadLengthError, wrapper.broadcast, \
+                                                        template, TOKENS)
+
+        # frame-based format allows larger payloads
+        wrapper = APNSNotificationWrapper(connection=MemoryConnection(), \
+                                                                command=2)
+        self.assertTrue(wrapper.broadcast(template, TOKENS))
+
+
+class CompactQueueTest(unittest.TestCase):
+    def notifications(self):
+        return [APNSNotification().token(token).alert('message %d' % index) \
+                                    for index, token in enumerate(TOKENS)]
+
+    def testQueueKeepsOrder(self):
+        notified = MemoryConnection()
+        wrapper = APNSNotificationWrapper(connection=notified)
+        for notification in self.notifications():
+            wrapper.append(notification)
+        wrapper.notify()
+
+        compacted = MemoryConnection()
+        wrapper = APNSNotificationWrapper(connection=compacted, compact=True)
+        for notification in self.notifications():
+            wrapper.append(notification)
+
+        self.assertEqual([o.deviceToken for o in wrapper.payloads], TOKENS)
+        wrapper.notify()
+        self.assertEqual(compacted.data(), notified.data())
+
+    def testCompactNotificationHasNoDict(self):
+        compact = self.notifications()[0].compact()
+        self.assertFalse(hasattr(compact, '__dict__'))
+        self.assertRaises(AttributeError, setattr, compact, 'badge', 1)
+
+    def testPayloadIsCheckedOnAppend(self):
+        wrapper = APNSNotificationWrapper(connection=MemoryConnection(), \
+                                                                compact=True)
+        notification = APNSNotification().token(TOKENS[0]).alert('x' * 300)
+        self.assertRaises(APNSPayloadLengthError, wrapper.append, \
+                                                                notification)
+        self.assertEqual(wrapper.count(), 0)
+
+    def testTokenIsRequired(self):
+        wrapper = APNSNotificationWrapper(connection=MemoryConnection(), \
+                                                                compact=True)
+        self.assertRaises(APNSUndefinedDeviceToken, wrapper.append, \
+                                            APNSNotification().badge(1))
+
+
+class FailingConnection(MemoryConnection):
+    """
+    Connection which fails after `limit` writes
+    """
+    def __init__(self, limit):
+        MemoryConnection.__init__(self)
+        self.limit = limit
+
+    def write(self, data=None):
+        if len(self.writes) >= self.limit:
+            raise APNSConnectionError("connection lost")
+        MemoryConnection.write(self, data)
+
+
+class NotifyStreamTest(unittest.TestCase):
+    def notifications(self, count, pulled=None, connection=None):
+        for index in range(count):
+            if pulled is not None:
+                # count of writes done before notification is pulled
+                pulled.append(connection and len(connection.writes))
+            yield APNSNotification().token(TOKENS[index % len(TOKENS)])\
+                                                                .badge(1)
+
+    def frameLength(self):
+        return len(APNSNotification().token(TOKENS[0]).badge(1).payload())
+
+    def testChunksAreWrittenWhileStreaming(self):
+        connection = MemoryConnection()
+        wrapper = APNSNotificationWrapper(connection=connection)
+        wrapper.chunkSize = self.frameLength() * 3
+
+        pulled = []
+        self.assertEqual(wrapper.notify_stream(self.notifications(7, \
+                                                pulled, connection)), 7)
+        self.assertEqual(pulled, [0, 0, 0, 1, 1, 1, 2])
+        self.assertEqual(len(connection.writes), 3)
+
+        expected = "".join([o.payload() for o in self.notifications(7)])
+        self.assertEqual(connection.data(), expected)
+
+    def testQueueOfWrapperIsStreamed(self):
+        connection = MemoryConnection()
+        wrapper = APNSNotificationWrapper(connection=connection)
+        for notification in self.notifications(3):
+            wrapper.append(notification)
+        self.assertEqual(wrapper.notify_stream(), 3)
+        self.assertEqual(connection.data(), wrapper.prepared_message)
+
+    def testEmptyStream(self):
+        connection = MemoryConnection()
+        wrapper = APNSNotificationWrapper(connection=connection)
+        self.assertEqual(wrapper.notify_stream(iter([])), 0)
+        self.assertEqual(connection.writes, [])
+
+    def testWriteErrorStopsStream(self):
+        connection = FailingConnection(1)
+        wrapper = APNSNotificationWrapper(connection=connection)
+        wrapper.chunkSize = self.frameLength() * 2
+
+        pulled = []
+        self.assertRaises(APNSConnectionError, wrapper.notify_stream, \
+                                self.notifications(10, pulled, connection))
+        # first chunk is written, stream is not read after failed write
+        self.assertEqual(len(connection.writes), 1)
+        self.assertEqual(pulled, [0, 0, 1, 1])
+
+    def testBrokenNotificationStopsStream(self):
+        connection = MemoryConnection()
+        wrapper = APNSNotificationWrapper(connection=connection)
+        notifications = [APNSNotification().token(TOKENS[0]).badge(1), \
+                                                APNSNotification().badge(2)]
+        self.assertRaises(APNSUndefinedDeviceToken, wrapper.notify_stream, \
+                                                                notifications)
+        self.assertEqual(connection.writes, [])
+
+
+class GatewayConnection(MemoryConnection):
+    """
+    Connection which returns queued error-responses on read
+    """
+    def __init__(self):
+        MemoryConnection.__init__(self)
+        self.errors = []
+        self.events = []
+
+    def connect(self, host, port):
+        self.events.append('connect')
+
+    def readable(self, timeout=0):
+        return len(self.errors) > 0
+
+    def read(self, blockSize=1024):
+        return self.errors.pop(0)
+
+    def close(self):
+        self.events.append('close')
+
+
+class EnhancedRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = GatewayConnection()
+
+    def wrapper(self, **kwargs):
+        wrapper = APNSNotificationWrapper(connection=self.connection, \
+                                                                **kwargs)
+        for token in TOKENS:
+            wrapper.append(APNSNotification().token(token).badge(1))
+        wrapper.notify()
+        self.connection.writes = []
+        return wrapper
+
+    def identifiers(self, data):
+        identifiers = []
+        offset = 0
+        while offset < len(data):
+            offset, token, payload, identifier = _unpack(data, offset)[:4]
+            identifiers.append(identifier)
+        return identifiers
+
+    def testIdentifiersAreAssigned(self):
+        connection = self.connection
+        wrapper = APNSNotificationWrapper(connection=connection, \
+                                                                enhanced=True)
+        for token in TOKENS:
+            wrapper.append(APNSNotification().token(token).badge(1))
+        wrapper.append(APNSNotification().token(TOKENS[0]).identifier(100))
+        wrapper.notify()
+        self.assertEqual(self.identifiers(connection.data()), [1, 2, 3, 100])
+        self.assertEqual(len(wrapper.sent), 4)
+
+    def testRecoverResendsFramesAfterFailed(self):
+        wrapper = self.wrapper(enhanced=True)
+        self.connection.errors.append(struct.pack("!BBI", 8, 8, 1))
+
+        self.assertEqual(wrapper.recover(timeout=0), (8, 1))
+        self.assertEqual(self.connection.events, ['close', 'connect'])
+        self.assertEqual(self.identifiers(self.connection.data()), [2, 3])
+
+    def testRecoverInFrameFormat(self):
+        wrapper = self.wrapper(command=2)
+        self.connection.errors.append(struct.pack("!BBI", 8, 8, 2))
+
+        self.assertEqual(wrapper.recover(timeout=0), (8, 2))
+        self.assertEqual(self.identifiers(self.connection.data()), [3])
+
+    def testFailedFrameIsNotBuffered(self):
+        wrapper = self.wrapper(enhanced=True, sentBufferSize=2)
+        self.assertEqual(len(wrapper.sent), 2)
+        self.connection.errors.append(struct.pack("!BBI", 8, 8, 1))
+
+        # frame 1 aged out, so all buffered frames were sent after it
+        self.assertEqual(wrapper.recover(timeout=0), (8, 1))
+        self.assertEqual(self.identifiers(self.connection.data()), [2, 3])
+
+    def testRecoverWithoutError(self):
+        wrapper = self.wrapper(enhanced=True)
+        self.assertEqual(wrapper.recover(timeout=0), None)
+        self.assertEqual(self.connection.events, [])
+        self.assertEqual(self.connection.writes, [])
+
+    def testUnexpectedResponse(self):
+        wrapper = self.wrapper(enhanced=True)
+        self.connection.errors.append(struct.pack("!BBI", 1, 8, 1))
+        self.assertRaises(APNSValueError, wrapper.read_error)
+
+        # short response is ignored
+        self.connection.errors.append("\x08\x08")
+        self.assertEqual(wrapper.read_error(), None)
+
+
+class FrameFormatTest(unittest.TestCase):
+    def items(self, frame):
+        command, length = struct.unpack_from("!BI", frame)
+        self.assertEqual(command, 2)
+        self.assertEqual(length, len(frame) - 5)
+
+        items = []
+        offset = 5
+        while offset < len(frame):
+            item, size = struct.unpack_from("!BH", frame, offset)
+            items.append((item, frame[offset + 3:offset + 3 + size]))
+            offset += 3 + size
+        self.assertEqual(offset, len(frame))
+        return items
+
+    def testItems(self):
+        notification = APNSNotification().token(TOKENS[0]).badge(1)\
+                            .identifier(0x01020304).expiry(1300000000)\
+                            .priority(5)
+        payload = notification.build()
+        frame = notification.payload(command=2)
+
+        self.assertEqual(self.items(frame), [
+                (1, TOKENS[0]),
+                (2, payload),
+                (3, '\x01\x02\x03\x04'),
+                (4, struct.pack("!I", 1300000000)),
+                (5, '\x05')])
+
+    def testBytes(self):
+        frame = APNSNotification().token(TOKENS[0]).badge(1)\
+                                .identifier(7).payload(command=2)
+        payload = '{"aps":{"badge":1}}'
+        self.assertEqual(frame, '\x02' + struct.pack("!I", 3 * 5 + 32 + \
+                    len(payload) + 4 + 4 + 1) + \
+                '\x01\x00\x20' + TOKENS[0] + \
+                '\x02' + struct.pack("!H", len(payload)) + payload + \
+                '\x03\x00\x04\x00\x00\x00\x07' + \
+                '\x04\x00\x04\x00\x00\x00\x00' + \
+                '\x05\x00\x01\x0a')
+
+    def testDefaultPriority(self):
+        frame = APNSNotification().token(TOKENS[0]).badge(1).payload(command=2)
+        self.assertEqual(self.items(frame)[-1], (5, '\x0a'))
+        self.assertEqual(self.items(frame)[2], (3, '\x00' * 4))
+
+    def testInvalidPriority(self):
+        self.assertRaises(APNSValueError, APNSNotification().priority, 7)
+
+
+class PayloadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = APNSPayloadCache(size=2)
+
+    def notification(self, text='hello'):
+        notification = APNSNotification().alert(text).badge(1)
+        notification.payloadCache = self.cache
+        return notification
+
+    def testHits(self):
+        payload = self.notification().build()
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+
+        self.assertEqual(self.notification().build(), payload)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(len(self.cache), 1)
+
+    def testChangedContentIsNotCached(self):
+        notification = self.notification()
+        first = notification.build()
+        notification.badge(2)
+        second = notification.build()
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(json.loads(second)['aps']['badge'], 2)
+        self.assertEqual(self.cache.hits, 0)
+
+        alert = APNSAlert().body('one')
+        notification.alert(alert)
+        notification.build()
+        alert.body('two')
+        self.assertEqual(json.loads(notification.build())['aps']['alert'], \
+                                                            {'body': 'two'})
+
+        notification.appendProperty(APNSProperty('key', 1))
+        self.assertEqual(json.loads(notification.build())['key'], 1)
+        self.assertEqual(self.cache.hits, 0)
+
+    def testTypeOfPropertyIsKept(self):
+        first = self.notification()
+        first.appendProperty(APNSProperty('key', 1))
+        second = self.notification()
+        second.appendProperty(APNSProperty('key', True))
+        self.assertNotEqual(first.build(), second.build())
+
+    def testLimitOfFormatIsKept(self):
+        notification = self.notification('x' * 1000)
+        self.assertTrue(len(notification.build(command=2)) > 1000)
+        self.assertRaises(APNSPayloadLengthError, notification.build)
+
+    def testLeastRecentlyUsedIsEvicted(self):
+        self.notification('first').build()
+        self.notification('second').build()
+        self.notification('first').build()
+        self.notification('third').build()
+        self.assertEqual(self.cache.evictions, 1)
+
+        # 'second' was evicted, 'first' is still cached
+        hits = self.cache.hits
+        self.notification('first').build()
+        self.assertEqual(self.cache.hits, hits + 1)
+        self.notification('second').build()
+        self.assertEqual(self.cache.hits, hits + 1)
+
+    def testClear(self):
+        self.notification().build()
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 0))
+
+    def testSize(self):
+        self.assertRaises(APNSValueError, APNSPayloadCache, 0)
+
+
+class TruncateTest(unittest.TestCase):
+    def testFits(self):
+        self.assertEqual(_truncate('short', 10, '...'), 'short')
+
+    def testCut(self):
+        self.assertEqual(_truncate('abcdefghij', 6, '...'), 'abc...')
+
+    def testEscapesAreCounted(self):
+        # every backslash takes two bytes in payload
+        self.assertEqual(_truncate('\\' * 10, 7, '.'), '\\\\' * 3 + '.')
+
+    def testUTF8CharacterIsNotSplit(self):
+        ellipsis = u'\u2026'.encode("utf-8")
+        result = _truncate(u'їїїїї', 6, ellipsis)
+        self.assertEqual(result, u'ї'.encode("utf-8") + ellipsis)
+        result.decode("utf-8")
+
+    def testEllipsisDoesntFit(self):
+        self.assertEqual(_truncate('abcdef', 2, '...'), '')
+
+    def testAlertIsTruncated(self):
+        message = APNSNotification().alert(u'ї' * 200).truncate()
+        payload = message.build()
+        self.assertEqual(len(payload) <= message.maxPayloadLength, True)
+        alert = json.loads(payload)['aps']['alert']
+        self.assertTrue(alert.endswith(u'\u2026'))
+
+    def testPropertyIsTruncated(self):
+        message = APNSNotification().alert('hi')
+        message.appendProperty(APNSProperty('text', 'a\\' * 200))
+        message.truncate('text', ellipsis='')
+        payload = json.loads(message.build())
+        self.assertEqual(payload['aps']['alert'], 'hi')
+        self.assertTrue(payload['text'].startswith('a\\a\\'))
+
+    def testMissingProperty(self):
+        message = APNSNotification().alert('hi').truncate('no_such_property')
+        self.assertEqual(message.build(), '{"aps":{"alert":"hi"}}')
+
+        message.alert('x' * 300)
+        self.assertRaises(APNSPayloadLengthError, message.build)
+
+    def testWithoutTruncation(self):
+        message = APNSNotification().alert('x' * 300)
+        self.assertRaises(APNSPayloadLengthError, message.build)
+
+    def testSharedObjectsAreNotChanged(self):
+        alert = APNSAlert().body('x' * 150)
+        property = APNSProperty('text', 'y' * 150)
+        message = APNSNotification().alert(alert).truncate()
+        message.appendProperty(property)
+
+        other = APNSNotification().alert(alert)
+        other.appendProperty(property)
+        other.truncate('text')
+
+        self.assertTrue(len(message.build()) <= message.maxPayloadLength)
+        self.assertTrue(len(other.build()) <= other.maxPayloadLength)
+        self.assertEqual((alert.alertBody, property.data), \
+                                                ('x' * 150, 'y' * 150))
+        self.assertTrue(message.alertObject is alert)
+        self.assertEqual(other.properties, [property])
@@ -0,0 +1,162 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from APNSWrapper.connection import APNSConnectionContext
+from APNSWrapper.pacing import APNSPacedConnection, APNSRateController, \
+                                TokenBucket
+
+
+class ResponseConnection(APNSConnectionContext):
+    """
+    Connection which returns queued responses on read
+    and fails writes while `failing` is True
+    """
+    def __init__(self):
+        self.writes = []
+        self.responses = []
+        self.failing = False
+
+    def connect(self, host, port):
+        pass
+
+    def write(self, data=None):
+        if self.failing:
+            raise socket.error("connection reset")
+        self.writes.append(data)
+
+    def readable(self, timeout=0):
+        return len(self.responses) > 0
+
+    def read(self, blockSize=1024):
+        return self.responses.pop(0)
+
+    def close(self):
+        pass
+
+
+class ResizedPool(object):
+    """
+    Pool which records resizes, resize waits for `gate`
+    """
+    def __init__(self):
+        self.size = 1
+        self.resized = threading.Event()
+        self.gate = threading.Event()
+        self.threads = []
+
+    def resize(self, size):
+        self.threads.append(threading.currentThread())
+        self.gate.wait(5)
+        self.size = size
+        self.resized.set()
+
+
+class TokenBucketTest(unittest.TestCase):
+    def testBurstIsNotPaced(self):
+        bucket = TokenBucket(1000, burst=1000)
+        self.assertEqual(bucket.take(1000), 0)
+
+    def testDebtIsPaid(self):
+        bucket = TokenBucket(1000, burst=1000)
+        bucket.take(1000)
+        waited = bucket.take(50)
+        self.assertTrue(0.02 < waited <= 0.05, waited)
+
+
+class RateControllerTest(unittest.TestCase):
+    def controller(self, **kwargs):
+        options = dict(rate=10000, minRate=1000, increase=1000, \
+                                                        interval=0.05)
+        options.update(kwargs)
+        return APNSRateController(**options)
+
+    def testInvalidTokenIsNotCongestion(self):
+        connection = ResponseConnection()
+        controller = self.controller()
+        paced = APNSPacedConnection(connection, controller=controller)
+
+        connection.responses.append(struct.pack("!BBI", 8, 8, 1))
+        paced.read(6)
+        self.assertEqual((controller.rate, controller.congestions), \
+                                                                (10000, 0))
+
+        # shutdown of gateway and closed connection are congestions
+        time.sleep(0.06)
+        connection.responses.append(struct.pack("!BBI", 8, 10, 1))
+        paced.read(6)
+        self.assertEqual((controller.rate, controller.congestions), \
+                                                                (5000, 1))
+
+        time.sleep(0.06)
+        connection.responses.append("")
+        paced.read(6)
+        self.assertEqual(controller.congestions, 2)
+
+    def testResetIsCongestion(self):
+        connection = ResponseConnection()
+        controller = self.controller()
+        paced = APNSPacedConnection(connection, controller=controller)
+
+        time.sleep(0.06)
+        connection.failing = True
+        self.assertRaises(socket.error, paced.write, 'data')
+        self.assertRaises(socket.error, paced.write, 'data')
+        # rate is decreased once per interval
+        self.assertEqual((controller.rate, controller.congestions), \
+                                                                (5000, 1))
+
+    def testGrowthIsLimitedByObservedRate(self):
+        controller = self.controller()
+        time.sleep(0.06)
+        # writer uses only ~500 bytes per second
+        controller.success(0, 30)
+        self.assertEqual(controller.rate, 10000)
+
+        time.sleep(0.06)
+        # writer is limited by rate
+        controller.success(0, 10000)
+        self.assertEqual(controller.rate, 11000)
+
+    def testMaxRate(self):
+        controller = self.controller(maxRate=10500)
+        time.sleep(0.06)
+        controller.success(0, 10000)
+        self.assertEqual(controller.rate, 10500)
+
+    def testSlowWriteIsCongestion(self):
+        controller = self.controller(latency=0.1)
+        time.sleep(0.06)
+        controller.success(0.2, 100)
+        self.assertEqual(controller.rate, 5000)
+
+    def testPoolIsResizedInBackground(self):
+        pool = ResizedPool()
+        controller = self.controller(pool=pool, connectionRate=5000)
+        try:
+            # write doesn't wait for connections to be opened
+            paced = APNSPacedConnection(ResponseConnection(), \
+                                                    controller=controller)
+            paced.write('data')
+            self.assertFalse(pool.resized.is_set())
+
+            pool.gate.set()
+            pool.resized.wait(5)
+            self.assertEqual(pool.size, 2)
+            self.assertFalse(threading.currentThread() in pool.threads)
+        finally:
+            pool.gate.set()
+            controller.close()
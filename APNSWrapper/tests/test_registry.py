@@ -0,0 +1,156 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from APNSWrapper.apnsexceptions import APNSCertificateNotFoundError
+from APNSWrapper.connection import APNSConnectionContext
+from APNSWrapper.notifications import APNSNotification
+from APNSWrapper.registry import APNSCertificateRegistry
+
+
+TOKEN = '\x01' * 32
+
+
+class CertificateConnection(APNSConnectionContext):
+    """
+    Connection which keeps its certificate and written data
+    """
+    def __init__(self, certificate=None):
+        self.certificate = certificate
+        self.data = []
+        self.connected = False
+        self.closed = False
+
+    def connect(self, host, port):
+        self.connected = True
+
+    def write(self, data=None):
+        self.data.append(data)
+
+    def readable(self, timeout=0):
+        return False
+
+    def close(self):
+        self.closed = True
+
+
+class CertificateRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.opened = []
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def factory(self, certificate):
+        connection = CertificateConnection(certificate)
+        self.opened.append(connection)
+        return connection
+
+    def certificate(self, name):
+        path = os.path.join(self.path, name + '.pem')
+        open(path, 'w').close()
+        return path
+
+    def registry(self, apps, **kwargs):
+        registry = APNSCertificateRegistry(factory=self.factory, **kwargs)
+        for app in apps:
+            registry.register(app, self.certificate(app))
+        return registry
+
+    def notifications(self, count=1):
+        return [APNSNotification().token(TOKEN).badge(1)] * count
+
+    def testConnectionIsOpenedOnceAndKept(self):
+        registry = self.registry(['first', 'second'])
+        try:
+            self.assertEqual(registry.send('first', self.notifications(2)), 2)
+            self.assertEqual(registry.send('first', self.notifications()), 1)
+            registry.send('second', self.notifications(), sandbox=False)
+
+            self.assertEqual(registry.opened, 2)
+            self.assertEqual([os.path.basename(c.certificate) \
+                    for c in self.opened], ['first.pem', 'second.pem'])
+            self.assertEqual([len(c.data) for c in self.opened], [2, 1])
+        finally:
+            registry.close()
+
+        self.assertEqual([c.closed for c in self.opened], [True, True])
+        self.assertEqual(registry.connections(), 0)
+
+    def testUnknownApplication(self):
+        registry = self.registry([])
+        self.assertRaises(APNSCertificateNotFoundError, registry.send, \
+                                                'first', self.notifications())
+        self.assertRaises(APNSCertificateNotFoundError, registry.register, \
+                                'first', os.path.join(self.path, 'no.pem'))
+
+    def testLeastRecentlyUsedIsEvicted(self):
+        registry = self.registry(['first', 'second', 'third'], \
+                                                        maxConnections=2)
+        try:
+            registry.send('first', self.notifications())
+            registry.send('second', self.notifications())
+            registry.send('first', self.notifications())
+            registry.send('third', self.notifications())
+
+            self.assertEqual([c.closed for c in self.opened], \
+                                                    [False, True, False])
+            self.assertEqual((registry.connections(), registry.evicted), \
+                                                                    (2, 1))
+        finally:
+            registry.close()
+
+    def testIdleConnectionsAreSwept(self):
+        registry = self.registry(['first'], idleTimeout=0.05, \
+                                                        sweepInterval=0.01)
+        try:
+            registry.send('first', self.notifications())
+            deadline = time.time() + 5
+            while registry.connections() and time.time() < deadline:
+                time.sleep(0.01)
+
+            # closed by sweeper thread without new sends
+            self.assertEqual(registry.connections(), 0)
+            self.assertTrue(self.opened[0].closed)
+        finally:
+            registry.close()
+        self.assertEqual(registry.sweeper, None)
+
+    def testExplicitSweep(self):
+        registry = self.registry(['first'], idleTimeout=0.01, \
+                                                        sweepInterval=None)
+        try:
+            registry.send('first', self.notifications())
+            self.assertEqual(registry.sweeper, None)
+            time.sleep(0.02)
+            self.assertEqual(registry.sweep(), 1)
+            self.assertTrue(self.opened[0].closed)
+        finally:
+            registry.close()
+
+    def testChangedCertificateClosesConnection(self):
+        registry = self.registry(['first'])
+        try:
+            registry.send('first', self.notifications())
+            registry.register('first', self.certificate('renewed'))
+            self.assertTrue(self.opened[0].closed)
+
+            registry.send('first', self.notifications())
+            self.assertEqual(os.path.basename(self.opened[1].certificate), \
+                                                                'renewed.pem')
+        finally:
+            registry.close()
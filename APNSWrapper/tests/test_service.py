@@ -0,0 +1,127 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+import struct
+import unittest
+
+try:
+    from twisted.internet import defer, protocol
+    from twisted.test.proto_helpers import StringTransport
+    from APNSWrapper.service import APNSServiceListener
+except ImportError:
+    defer = None
+
+from APNSWrapper.apnsexceptions import APNSConnectionError
+from APNSWrapper.connection import SERVICE_FRAME_HEADER, \
+            SERVICE_MAX_MESSAGE_LENGTH, SERVICE_ACK_OK, SERVICE_ACK_ERROR
+
+
+class ServiceUpstream(object):
+    """
+    Upstream of APNSUpstream interface, writes are finished by test
+    """
+    paused = False
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data, offset=None):
+        deferred = defer.Deferred()
+        self.writes.append((data, deferred))
+        return deferred
+
+
+class ServiceListenerTest(unittest.TestCase):
+    def setUp(self):
+        if defer is None:
+            self.skipTest("Twisted is not available")
+
+        self.upstream = ServiceUpstream()
+        APNSServiceListener._upstream = self.upstream
+
+        factory = protocol.ServerFactory()
+        factory.protocol = APNSServiceListener
+        factory.clients = []
+        self.listener = factory.buildProtocol(None)
+        self.transport = StringTransport()
+        self.listener.makeConnection(self.transport)
+
+    def tearDown(self):
+        APNSServiceListener._upstream = None
+
+    def received(self):
+        data = self.transport.value()
+        self.transport.clear()
+        return data
+
+    def frame(self, identifier, data):
+        return struct.pack(SERVICE_FRAME_HEADER, len(data), identifier) + data
+
+    def negotiate(self, hello):
+        self.listener.dataReceived(json.dumps(hello) + "\r\n")
+        return json.loads(self.received())
+
+    def testJSONMessagesWithAcks(self):
+        self.assertEqual(self.negotiate({'acks': True}), {'acks': True})
+
+        for identifier in ('#1', '#2'):
+            self.listener.dataReceived(json.dumps({'id': identifier, \
+                'message': base64.standard_b64encode('data' + identifier)}) + \
+                                                                    "\r\n")
+        self.assertEqual([data for data, deferred in self.upstream.writes], \
+                                                    ['data#1', 'data#2'])
+        self.assertEqual(self.received(), "")
+
+        # acknowledges are sent in order of writes to APNS
+        self.upstream.writes[1][1].callback(None)
+        self.upstream.writes[0][1].errback(APNSConnectionError("lost"))
+        self.assertEqual([json.loads(line) for line in \
+                                    self.received().splitlines()], [
+                {'id': '#2', 'status': 'ok'},
+                {'id': '#1', 'status': 'error', 'error': "'lost'"}])
+
+    def testMessagesWithoutAcks(self):
+        self.listener.dataReceived(json.dumps({'id': '#1', \
+                        'message': base64.standard_b64encode('data')}) + "\r\n")
+        self.upstream.writes[0][1].callback(None)
+        self.assertEqual(self.received(), "")
+
+    def testBinaryFraming(self):
+        self.assertEqual(self.negotiate({'framing': 'binary', \
+                    'acks': True}), {'framing': 'binary', 'acks': True})
+
+        # frames are split between reads
+        data = self.frame(1, 'first') + self.frame(0, 'no id') + \
+                                                    self.frame(3, 'third')
+        for offset in range(0, len(data), 7):
+            self.listener.dataReceived(data[offset:offset + 7])
+        self.assertEqual([data for data, deferred in self.upstream.writes], \
+                                                ['first', 'no id', 'third'])
+
+        for data, deferred in self.upstream.writes[:2]:
+            deferred.callback(None)
+        self.upstream.writes[2][1].errback(APNSConnectionError("lost"))
+        # message without id is not acknowledged, error is
+        # message of exception
+        self.assertEqual(self.received(), self.frame(1, \
+                chr(SERVICE_ACK_OK)) + self.frame(3, \
+                                    chr(SERVICE_ACK_ERROR) + "'lost'"))
+
+    def testTooLongFrameDisconnectsClient(self):
+        self.negotiate({'framing': 'binary'})
+        self.listener.dataReceived(struct.pack(SERVICE_FRAME_HEADER, \
+                                    SERVICE_MAX_MESSAGE_LENGTH + 1, 1) + 'x')
+        self.assertTrue(self.transport.disconnecting)
+
+        self.listener.dataReceived(self.frame(2, 'after'))
+        self.assertEqual(self.upstream.writes, [])
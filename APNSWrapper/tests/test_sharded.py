@@ -0,0 +1,138 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import struct
+import time
+import unittest
+
+from APNSWrapper.connection import APNSConnectionContext
+from APNSWrapper.http2 import _unpack
+from APNSWrapper.notifications import APNSNotification
+from APNSWrapper.sharded import APNSShardedSender
+
+
+GOOD_TOKEN = '\x01' * 32
+BAD_TOKEN = '\x02' * 32
+
+
+class GatewayConnection(APNSConnectionContext):
+    """
+    Connection which behaves like binary gateway: on invalid token
+    it sends error-response, drops the rest and closes connection.
+    """
+    def __init__(self):
+        self.error = ""
+        self.closed = True
+
+    def connect(self, host, port):
+        self.error = ""
+        self.closed = False
+
+    def write(self, data=None):
+        if self.closed:
+            raise socket.error("connection closed by gateway")
+
+        offset = 0
+        while offset < len(data):
+            offset, token, payload, identifier = _unpack(data, offset)[:4]
+            if token == BAD_TOKEN:
+                self.error = struct.pack("!BBI", 8, 8, identifier or 0)
+                self.closed = True
+                return
+
+    def readable(self, timeout=0):
+        if not self.error and timeout:
+            time.sleep(timeout)
+        return len(self.error) > 0
+
+    def read(self, blockSize=1024):
+        error, self.error = self.error, ""
+        return error
+
+    def close(self):
+        self.closed = True
+
+
+class ShardedSenderTest(unittest.TestCase):
+    def sender(self, **kwargs):
+        return APNSShardedSender(processes=1, shardSize=5, \
+                connectionFactory=GatewayConnection, errorTimeout=0, **kwargs)
+
+    def tokens(self):
+        tokens = [GOOD_TOKEN] * 12
+        for index in (3, 6, 8):
+            tokens[index] = BAD_TOKEN
+        return tokens
+
+    def testBroadcastErrors(self):
+        sender = self.sender(enhanced=True)
+        try:
+            result = sender.broadcast(APNSNotification().badge(1), \
+                                                            self.tokens())
+        finally:
+            sender.close()
+
+        self.assertEqual((result['sent'], result['failed'], \
+                                    result['shards']), (9, 3, 3))
+        self.assertEqual(result['errors'], [
+                (0, "status 8 of notification 4"),
+                (5, "status 8 of notification 7, "\
+                    "status 8 of notification 9")])
+
+    def testNotifyErrors(self):
+        notifications = [APNSNotification().token(token).alert('hi') \
+                                                for token in self.tokens()]
+        sender = self.sender(command=2)
+        try:
+            result = sender.notify(notifications)
+        finally:
+            sender.close()
+
+        self.assertEqual((result['sent'], result['failed']), (9, 3))
+        self.assertEqual([offset for offset, error in result['errors']], \
+                                                                    [0, 5])
+
+    def testReconnectAfterFailedShard(self):
+        sender = self.sender()
+        try:
+            # without enhanced format gateway closes connection,
+            # so the whole shard is counted as failed
+            result = sender.broadcast(APNSNotification().badge(1), \
+                                    [GOOD_TOKEN, BAD_TOKEN] + [GOOD_TOKEN] * 5)
+            self.assertEqual((result['sent'], result['failed']), (2, 5))
+            self.assertEqual(result['errors'], \
+                                    [(0, "connection closed by gateway")])
+
+            result = sender.broadcast(APNSNotification().badge(1), \
+                                                        [GOOD_TOKEN] * 10)
+        finally:
+            sender.close()
+
+        self.assertEqual((result['sent'], result['failed']), (10, 0))
+
+    def testErrorsAreFoundWithoutWaiting(self):
+        sender = APNSShardedSender(processes=2, shardSize=5, \
+                connectionFactory=GatewayConnection, errorTimeout=0.5, \
+                                                                enhanced=True)
+        try:
+            sender.start()
+            started = time.time()
+            result = sender.broadcast(APNSNotification().badge(1), \
+                                                            self.tokens() * 5)
+            elapsed = time.time() - started
+        finally:
+            sender.close()
+
+        self.assertEqual((result['sent'], result['failed'], \
+                                    result['shards']), (45, 15, 12))
+        # workers wait for error-responses only once, not after every shard
+        self.assertTrue(elapsed < 0.5 * 3, elapsed)
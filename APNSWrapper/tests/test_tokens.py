@@ -0,0 +1,90 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import os
+import tempfile
+import unittest
+
+from APNSWrapper.apnsexceptions import APNSValueError
+from APNSWrapper.tokens import TokenBatch
+
+
+TOKENS = [chr(i) * 32 for i in range(1, 6)]
+
+
+class TokenBatchTest(unittest.TestCase):
+    def testHex(self):
+        hexTokens = [token.encode("hex") for token in TOKENS]
+        # formatting of XCode console is stripped out
+        hexTokens[0] = '<' + hexTokens[0][:8] + ' ' + hexTokens[0][8:] + '>'
+        batch = TokenBatch.fromHex(hexTokens)
+        self.assertEqual(list(batch), TOKENS)
+
+    def testBase64(self):
+        batch = TokenBatch.fromBase64([base64.b64encode(token) \
+                                                    for token in TOKENS])
+        self.assertEqual(list(batch), TOKENS)
+
+    def testFile(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, "\n".join([token.encode("hex") \
+                                            for token in TOKENS]) + "\n\n")
+            os.close(fd)
+            self.assertEqual(list(TokenBatch.fromFile(path)), TOKENS)
+        finally:
+            os.remove(path)
+
+    def testChunks(self):
+        batch = TokenBatch()
+        batch.chunkSize = 2
+        batch.extendHex([token.encode("hex") for token in TOKENS])
+        self.assertEqual(batch.tostring(), "".join(TOKENS))
+
+    def testBrokenToken(self):
+        hexTokens = [token.encode("hex") for token in TOKENS]
+        hexTokens[3] = hexTokens[3][:-2]
+        try:
+            TokenBatch.fromHex(hexTokens)
+        except APNSValueError, e:
+            self.assertTrue("#3" in str(e))
+        else:
+            self.fail("APNSValueError is not raised")
+
+        self.assertRaises(APNSValueError, TokenBatch.fromHex, ['zz' * 32])
+        self.assertRaises(APNSValueError, TokenBatch().append, 'x')
+        self.assertRaises(APNSValueError, TokenBatch, 'x' * 33)
+
+    def testIndexAndSlice(self):
+        batch = TokenBatch("".join(TOKENS))
+        self.assertEqual(len(batch), 5)
+        self.assertEqual(batch[0], TOKENS[0])
+        self.assertEqual(batch[-1], TOKENS[-1])
+        self.assertRaises(IndexError, batch.__getitem__, 5)
+        self.assertEqual(list(batch[1:3]), TOKENS[1:3])
+        self.assertRaises(APNSValueError, batch.__getitem__, slice(0, 5, 2))
+
+    def testTokenLength(self):
+        batch = TokenBatch(tokenLength=8).append('12345678')
+        batch.extend(TokenBatch('abcdefgh', tokenLength=8))
+        self.assertEqual(list(batch), ['12345678', 'abcdefgh'])
+
+    def testNewlineInToken(self):
+        hexTokens = [token.encode("hex") for token in TOKENS]
+        # two tokens in one item are not counted as two items
+        hexTokens[1] = hexTokens[1] + "\n" + hexTokens[2]
+        try:
+            TokenBatch.fromHex(hexTokens)
+        except APNSValueError, e:
+            self.assertTrue("#1" in str(e))
+        else:
+            self.fail("APNSValueError is not raised")
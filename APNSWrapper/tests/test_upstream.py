@@ -0,0 +1,216 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import shutil
+import tempfile
+import unittest
+
+try:
+    from twisted.internet import defer, task
+    from APNSWrapper.upstream import APNSUpstream
+except ImportError:
+    defer = None
+
+from APNSWrapper.apnsexceptions import APNSConnectionError
+from APNSWrapper.journal import APNSJournal
+
+
+class UpstreamConnection(object):
+    """
+    Connection of AsyncAPNSConnection interface. Writes are finished
+    by test, or fail at once if `failing` is True.
+    """
+    concurrency = 1
+
+    def __init__(self):
+        self.writes = []
+        self.failing = False
+
+    def isConnected(self):
+        return True
+
+    def isBusy(self):
+        return len(self.writes) >= self.concurrency
+
+    def write(self, data=None):
+        if self.failing:
+            return defer.fail(APNSConnectionError("write failed"))
+
+        deferred = defer.Deferred()
+        self.writes.append((data, deferred))
+        return deferred
+
+    def finish(self):
+        data, deferred = self.writes.pop(0)
+        deferred.callback(None)
+        return data
+
+
+class UpstreamJournalTest(unittest.TestCase):
+    def setUp(self):
+        if defer is None:
+            self.skipTest("Twisted is not available")
+
+        self.path = tempfile.mkdtemp()
+        self.journal = APNSJournal(self.path, segmentSize=4096)
+        self.clock = task.Clock()
+        self.connection = UpstreamConnection()
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.path)
+
+    def upstream(self):
+        upstream = APNSUpstream(None, True, [], self.journal, \
+                        connection=self.connection, reactor=self.clock)
+        upstream.chunkSize = 100
+        upstream.retries = 0
+        # commit runs synchronously instead of thread
+        upstream.deferToThread = defer.maybeDeferred
+        return upstream
+
+    def reopen(self):
+        self.journal.close()
+        self.journal = APNSJournal(self.path, segmentSize=4096)
+
+    def testWrittenMessagesAreAcknowledged(self):
+        upstream = self.upstream()
+        upstream.write('first')
+        upstream.write('second')
+        self.clock.advance(0)
+
+        self.assertEqual(self.journal.pending() > 0, True)
+        self.assertEqual(self.connection.finish(), 'firstsecond')
+        self.assertEqual(self.journal.pending(), 0)
+
+    def testFailedMessageIsRetried(self):
+        upstream = self.upstream()
+        self.connection.failing = True
+        results = []
+        upstream.write('lost').addBoth(results.append)
+        self.clock.advance(0)
+        # journaled message is not given up
+        self.assertEqual(results, [])
+        self.assertEqual(self.connection.writes, [])
+
+        self.connection.failing = False
+        upstream.write('next')
+        self.clock.advance(0)
+        self.connection.finish()
+
+        # later messages don't acknowledge failed one
+        upstream.commit()
+        self.assertEqual([data for offset, data in self.journal.replay()], \
+                                                            ['lost', 'next'])
+
+        self.clock.advance(upstream.retryDelay)
+        self.assertEqual(self.connection.finish(), 'lost')
+        self.assertEqual(results, [None])
+        self.assertEqual(self.journal.pending(), 0)
+
+    def testNotWrittenMessageIsReplayed(self):
+        upstream = self.upstream()
+        upstream.write('lost')
+        self.clock.advance(0)
+        upstream.write('next')
+        self.clock.advance(0)
+
+        # restart before the first write is finished
+        self.connection.writes[1][1].callback(None)
+        self.connection.writes = []
+        upstream.commit()
+        self.reopen()
+
+        upstream = self.upstream()
+        upstream.replay()
+        self.clock.advance(0)
+        self.assertEqual(self.connection.finish(), 'lostnext')
+        self.assertEqual(self.journal.pending(), 0)
+
+    def testReplayIsLazy(self):
+        for index in range(20):
+            self.journal.append('message%02d' % index + 'x' * 30)
+        self.reopen()
+
+        upstream = self.upstream()
+        upstream.replay()
+        # only one chunk of 3 messages is read while write is not finished
+        self.assertEqual(upstream.replayed, 3)
+        self.assertEqual(len(self.connection.writes), 1)
+
+        written = []
+        while self.connection.writes:
+            written.append(self.connection.finish())
+            self.clock.advance(0)
+            self.assertTrue(upstream.replayed <= 3 * (len(written) + 1))
+
+        self.assertEqual(upstream.replayed, 20)
+        self.assertEqual("".join(written), "".join(['message%02d' % index + \
+                                            'x' * 30 for index in range(20)]))
+        self.assertEqual(self.journal.pending(), 0)
+
+    def testRejectedDataIsWrittenAgain(self):
+        upstream = self.upstream()
+        upstream.write('first')
+        self.clock.advance(0)
+        self.connection.finish()
+
+        # connection passes error-response with data written after
+        # the failed notification
+        self.connection.onError(8, 1, 'second')
+        self.clock.advance(0)
+        self.assertEqual(self.connection.finish(), 'second')
+        self.assertEqual(self.journal.pending(), 0)
+
+    def testClientWriteDuringReplay(self):
+        for index in range(20):
+            self.journal.append('message%02d' % index + 'x' * 30)
+        self.reopen()
+
+        upstream = self.upstream()
+        upstream.replay()
+        upstream.write('client')
+        self.clock.advance(0)
+        self.assertEqual(self.connection.writes[-1][0], 'client')
+
+        # client's message is written before replayed ones,
+        # it doesn't acknowledge them
+        self.connection.writes.pop()[1].callback(None)
+        upstream.commit()
+        self.assertEqual(self.journal.ackOffset, 0)
+
+        while self.connection.writes:
+            self.assertTrue(self.journal.pending() > 0)
+            self.connection.finish()
+            self.clock.advance(0)
+            upstream.commit()
+
+        self.assertEqual(upstream.replayed, 20)
+        self.assertEqual(self.journal.pending(), 0)
+
+    def testCommitsDoNotOverlap(self):
+        upstream = self.upstream()
+        commits = []
+        upstream.deferToThread = lambda function: commits.append(function) \
+                                                    or defer.Deferred()
+
+        first = upstream.commit()
+        self.assertTrue(upstream.commit() is first)
+        self.assertEqual(len(commits), 1)
+
+        closed = []
+        upstream.close().addCallback(closed.append)
+        self.assertEqual(closed, [])
+        first.callback(None)
+        self.assertEqual(closed, [None])
+        self.assertEqual(upstream.committing, None)
+        # journal closed by upstream is opened again for tearDown
+        self.journal = APNSJournal(self.path, segmentSize=4096)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+from APNSWrapper.apnsexceptions import APNSValueError
+from APNSWrapper.utils import _doublequote, _quote, _encode
+
+
+class DoubleQuoteTest(unittest.TestCase):
+    def testPlainString(self):
+        self.assertEqual(_doublequote('plain text'), 'plain text')
+
+    def testBackslashAndQuote(self):
+        self.assertEqual(_doublequote('a\\b"c'), 'a\\\\b\\"c')
+
+    def testShortEscapes(self):
+        self.assertEqual(_doublequote('\b\f\n\r\t'), '\\b\\f\\n\\r\\t')
+
+    def testControlCharacters(self):
+        self.assertEqual(_doublequote('\x00\x01\x1f'), \
+                                                '\\u0000\\u0001\\u001f')
+
+    def testUTF8IsKept(self):
+        text = u'Привіт'.encode("utf-8")
+        self.assertEqual(_doublequote(text), text)
+
+
+class QuoteTest(unittest.TestCase):
+    def assertRoundTrip(self, value):
+        quoted = _quote(value)
+        if isinstance(value, str):
+            value = value.decode("utf-8")
+        self.assertEqual(json.loads(quoted), value)
+        return quoted
+
+    def testASCII(self):
+        self.assertEqual(self.assertRoundTrip('hello'), '"hello"')
+
+    def testEscapes(self):
+        for value in ('C:\\path\\', 'line\nline', 'say "hi"', \
+                            'tab\tbell\x07', '\x00', '\\u0041'):
+            self.assertRoundTrip(value)
+
+    def testUnicodeIsUTF8(self):
+        quoted = self.assertRoundTrip(u'Привіт\n"світ"')
+        self.assertTrue(isinstance(quoted, str))
+        self.assertTrue(u'Привіт'.encode("utf-8") in quoted)
+
+    def testUTF8String(self):
+        self.assertRoundTrip(u'emoji \U0001f600 \\'.encode("utf-8"))
+
+
+class EncodeTest(unittest.TestCase):
+    def testNumbers(self):
+        self.assertEqual(_encode(1), '1')
+        self.assertEqual(_encode(-7L), '-7')
+        self.assertEqual(json.loads(_encode(0.1)), 0.1)
+        self.assertEqual(json.loads(_encode(1e100)), 1e100)
+
+    def testConstants(self):
+        self.assertEqual(_encode(True), 'true')
+        self.assertEqual(_encode(False), 'false')
+        self.assertEqual(_encode(None), 'null')
+
+    def testContainers(self):
+        value = [1, "a\\b", (2.5, u'ї'), {'key': [None, False]}]
+        self.assertEqual(json.loads(_encode(value)), \
+                        [1, u"a\\b", [2.5, u'ї'], {u'key': [None, False]}])
+
+    def testUnsupportedType(self):
+        self.assertRaises(APNSValueError, _encode, object())
@@ -0,0 +1,191 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import binascii
+import itertools
+
+from apnsexceptions import *
+
+
+__all__ = ('TokenBatch',)
+
+
+# characters which may surround or split hex tokens copied
+# from XCode console, see APNSNotification.tokenHex
+HEX_JUNK = '<> -\t\r'
+
+
+class TokenBatch(object):
+    """
+    Container of binary device tokens stored in one contiguous
+    buffer (tokenLength * N bytes). Tokens are decoded in bulk
+    with fromHex/fromBase64/fromFile and may be passed directly
+    to APNSNotificationWrapper.broadcast.
+    """
+    tokenLength = 32
+    chunkSize = 4096    # count of tokens decoded at once
+
+    def __init__(self, data=None, tokenLength=32):
+        self.tokenLength = tokenLength
+        self.buffer = bytearray()
+
+        if data:
+            self.extend(data)
+
+    @classmethod
+    def fromHex(cls, tokens, tokenLength=32):
+        """
+        Create batch from list or iterator of hex encoded tokens
+        """
+        return cls(tokenLength=tokenLength).extendHex(tokens)
+
+    @classmethod
+    def fromBase64(cls, tokens, tokenLength=32):
+        """
+        Create batch from list or iterator of base64 encoded tokens
+        """
+        return cls(tokenLength=tokenLength).extendBase64(tokens)
+
+    @classmethod
+    def fromFile(cls, path, encoding='hex', tokenLength=32):
+        """
+        Create batch from file with one encoded token per line.
+        Encoding should be 'hex' or 'base64', empty lines are skipped.
+        """
+        batch = cls(tokenLength=tokenLength)
+        fh = open(path, 'r')
+        try:
+            lines = (line.strip() for line in fh if line.strip())
+            if encoding == 'hex':
+                batch.extendHex(lines)
+            elif encoding == 'base64':
+                batch.extendBase64(lines)
+            else:
+                raise APNSValueError("Unexpected encoding of tokens file. "\
+                                        "It should be 'hex' or 'base64'")
+        finally:
+            fh.close()
+        return batch
+
+    def _chunks(self, tokens):
+        tokens = iter(tokens)
+        while True:
+            chunk = list(itertools.islice(tokens, self.chunkSize))
+            if not chunk:
+                return
+            yield chunk
+
+    def _check(self, lengths, expected, offset):
+        """
+        Validate length of all tokens in chunk at once and
+        look for broken one only if validation failed.
+        """
+        if lengths.count(expected) == len(lengths):
+            return
+
+        for i, length in enumerate(lengths):
+            if length != expected:
+                raise APNSValueError("Device token #%d has unexpected "\
+                    "length %d, expected %d." % (offset + i, length, expected))
+
+    def extend(self, data):
+        """
+        Append binary tokens. Data should be string with
+        tokens in binary format or another TokenBatch.
+        """
+        if isinstance(data, TokenBatch):
+            data = data.buffer
+
+        if len(data) % self.tokenLength != 0:
+            raise APNSValueError("Length of binary tokens data should be "\
+                                    "multiple of %d bytes." % self.tokenLength)
+        self.buffer.extend(data)
+        return self
+
+    def append(self, token):
+        """
+        Append one token in binary format.
+        """
+        if len(token) != self.tokenLength:
+            raise APNSValueError("Device token should be %d bytes "\
+                                    "length." % self.tokenLength)
+        self.buffer.extend(token)
+        return self
+
+    def extendHex(self, tokens):
+        """
+        Decode and append hex encoded tokens. Whitespace, dashes
+        and <> are stripped out like in APNSNotification.tokenHex
+        """
+        offset = len(self)
+        for chunk in self._chunks(tokens):
+            # every token is stripped and checked on its own, so
+            # separators inside one token can't shift the others
+            lines = [str(token).translate(None, HEX_JUNK) for token in chunk]
+            self._check(map(len, lines), self.tokenLength * 2, offset)
+            try:
+                decoded = binascii.unhexlify("".join(lines))
+            except TypeError:
+                raise APNSValueError("Hex tokens #%d-#%d contain non-hex "\
+                            "characters." % (offset, offset + len(chunk) - 1))
+            self.buffer.extend(decoded)
+            offset += len(chunk)
+        return self
+
+    def extendBase64(self, tokens):
+        """
+        Decode and append base64 encoded tokens.
+        """
+        offset = len(self)
+        for chunk in self._chunks(tokens):
+            try:
+                decoded = map(binascii.a2b_base64, chunk)
+            except (binascii.Error, UnicodeError):
+                raise APNSValueError("Base64 tokens #%d-#%d are not "\
+                            "valid." % (offset, offset + len(chunk) - 1))
+
+            self._check(map(len, decoded), self.tokenLength, offset)
+            self.buffer.extend("".join(decoded))
+            offset += len(chunk)
+        return self
+
+    def tostring(self):
+        """
+        Return all tokens as one binary string
+        """
+        return str(self.buffer)
+
+    def __len__(self):
+        return len(self.buffer) / self.tokenLength
+
+    def __getitem__(self, index):
+        length = self.tokenLength
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise APNSValueError("TokenBatch slices don't support step")
+            batch = self.__class__(tokenLength=length)
+            batch.buffer = self.buffer[start * length:stop * length]
+            return batch
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("TokenBatch index out of range")
+
+        return str(self.buffer[index * length:(index + 1) * length])
+
+    def __iter__(self):
+        length = self.tokenLength
+        data = self.buffer
+        for offset in xrange(0, len(data), length):
+            yield str(data[offset:offset + length])
@@ -0,0 +1,328 @@
+# Copyright 2009-2011 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Upstream connections of service.py to APNS. Requires Twisted, so
+module is not imported by APNSWrapper package.
+"""
+
+import collections
+import logging
+
+from twisted.internet import defer, threads, reactor as default_reactor
+from twisted.python import log
+
+from asynchronous import AsyncAPNSConnection
+from notifications import APNSNotificationWrapper, ERROR_STATUSES
+
+
+__all__ = ('APNSUpstream',)
+
+
+class APNSUpstream(object):
+    """
+    Non-blocking TLS connections to APNS shared by all clients of the
+    service. Messages received from all clients in the same reactor
+    iteration are coalesced into one write (up to chunkSize bytes),
+    every write goes to the least loaded connection. While APNS
+    doesn't accept data as fast as clients send it, or there is no
+    connection to APNS, clients are paused, so messages are not
+    accumulated in memory. Lost connections are reopened, data of
+    failed write is written again (up to `retries` times) to
+    another connection. When APNS rejects a notification with
+    error-response, notifications written after it to the same
+    connection (which APNS dropped) are written again.
+
+    With `journal` every message is appended to the journal before
+    write and acknowledged in it when written. Message which was not
+    written because of restart holds acknowledged offset back, so
+    it's sent again (with messages after it) by .replay() after
+    restart. Journaled messages are not given up after `retries`
+    failed writes, they are written again every `retryDelay` seconds.
+    Replayed messages are read from journal only as fast as APNS
+    connections accept them, messages of clients are not acknowledged
+    until all replayed ones are written. Journal is synced and
+    compacted by .commit() in thread.
+    """
+    chunkSize = 65536
+    retries = 3
+    retryDelay = 1
+    deferToThread = staticmethod(threads.deferToThread)
+
+    def __init__(self, certificate, sandbox, clients, journal=None,
+                 connections=1, connection=None, reactor=None):
+        self.sandbox = sandbox
+        self.clients = clients
+        self.reactor = reactor or default_reactor
+        if connection is None:
+            connection = AsyncAPNSConnection(certificate, connections,
+                                             reactor=self.reactor,
+                                             reconnect=True)
+        self.connection = connection
+        self.connection.onError = self._rejected
+
+        self.journal = journal
+        # [journal offset, done] of messages in order of writes
+        self.offsets = collections.deque()
+        # iterator of journal records which are not replayed yet,
+        # entries of replayed messages and entry which stands in
+        # offsets for the whole replayed range
+        self.replaying = None
+        self.replayEntries = collections.deque()
+        self.replayEnd = None
+        self.replayed = 0
+        self.pulling = False
+        self.committing = None
+
+        self.buffer = []
+        self.buffered = 0
+        self.deferreds = []
+        self.retrying = []
+        self.scheduled = None
+        self.writing = 0
+        self.paused = False
+        self.reconnecting = False
+
+    def connect(self):
+        if self.sandbox:
+            host = APNSNotificationWrapper.apnsSandboxHost
+        else:
+            host = APNSNotificationWrapper.apnsHost
+
+        deferred = self.connection.connect(host,
+                                           APNSNotificationWrapper.apnsPort)
+        deferred.addErrback(lambda failure: log.msg("Unable to connect to "
+                "APNS: %s" % failure.getErrorMessage(),
+                logLevel=logging.ERROR))
+        return deferred
+
+    def write(self, data, offset=None):
+        """
+        Queue data for the next write. Return Deferred which fires
+        when data is accepted by transport of APNS connection.
+        Data replayed from journal should have its `offset`.
+        """
+        deferred = defer.Deferred()
+        if self.journal is not None:
+            entry = [offset, False]
+            if offset is None:
+                entry[0] = self.journal.append(data)
+                self.offsets.append(entry)
+            else:
+                self.replayEntries.append(entry)
+            deferred.addCallback(self._done, entry)
+
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.deferreds.append(deferred)
+
+        if self.buffered >= self.chunkSize:
+            self.flush()
+        else:
+            self.schedule()
+        return deferred
+
+    def schedule(self):
+        if self.scheduled is None:
+            self.scheduled = self.reactor.callLater(0, self.flush)
+
+    def flush(self):
+        if self.scheduled is not None:
+            if self.scheduled.active():
+                self.scheduled.cancel()
+            self.scheduled = None
+
+        if not self.buffer and not self.retrying:
+            return
+
+        if not self.connection.isConnected():
+            # keep buffer until connection to APNS is reopened
+            self.pause()
+            if not self.reconnecting:
+                self.reconnecting = True
+                self.connection.whenConnected().addCallback(self._connected)
+            return
+
+        retrying, self.retrying = self.retrying, []
+        for data, deferreds, attempt in retrying:
+            self._send(data, deferreds, attempt)
+
+        if self.buffer:
+            data = "".join(self.buffer)
+            deferreds = self.deferreds
+            self.buffer = []
+            self.buffered = 0
+            self.deferreds = []
+            self._send(data, deferreds, 0)
+
+    def _send(self, data, deferreds, attempt):
+        self.writing += 1
+        written = self.connection.write(data)
+        if not written.called and self.connection.isBusy():
+            # transport buffers of all connections are full
+            self.pause()
+        written.addCallbacks(self._written, self._failed,
+                             callbackArgs=(deferreds,),
+                             errbackArgs=(data, deferreds, attempt))
+
+    def _connected(self, ignored):
+        self.reconnecting = False
+        self.flush()
+        self.resume()
+        self._pull()
+
+    def _written(self, ignored, deferreds):
+        self.writing -= 1
+        self.resume()
+        for deferred in deferreds:
+            deferred.callback(None)
+        self._pull()
+
+    def _failed(self, failure, data, deferreds, attempt):
+        self.writing -= 1
+        if attempt < self.retries or self.journal is not None:
+            log.msg("Write to APNS failed, retrying: %s" % \
+                    failure.getErrorMessage(), logLevel=logging.ERROR)
+            if attempt < self.retries:
+                self._retry(data, deferreds, attempt + 1)
+            else:
+                self.reactor.callLater(self.retryDelay, self._retry, data,
+                                       deferreds, attempt + 1)
+            return
+
+        self.resume()
+        for deferred in deferreds:
+            deferred.errback(failure)
+        self._pull()
+
+    def _retry(self, data, deferreds, attempt):
+        self.retrying.append((data, deferreds, attempt))
+        self.schedule()
+
+    def _rejected(self, status, identifier, data):
+        """
+        Error-response of APNS: write again data dropped after
+        the failed notification.
+        """
+        log.msg("APNS rejected notification %d: %s, writing %d bytes "
+                "sent after it again" % (identifier,
+                ERROR_STATUSES.get(status, status), len(data)),
+                logLevel=logging.ERROR)
+        if data:
+            self.retrying.append((data, [], 0))
+            self.schedule()
+
+    def _done(self, result, entry):
+        entry[1] = True
+        self._acknowledge()
+        return result
+
+    def _acknowledge(self):
+        """
+        Acknowledge in journal all messages up to the
+        first one which is not written yet.
+        """
+        while self.replayEntries and self.replayEntries[0][1]:
+            self.journal.ack(self.replayEntries.popleft()[0])
+
+        if self.replayEnd is not None and self.replaying is None and \
+                                                    not self.replayEntries:
+            self.replayEnd[1] = True
+            self.replayEnd = None
+
+        while self.offsets and self.offsets[0][1]:
+            self.journal.ack(self.offsets.popleft()[0])
+
+    def replay(self):
+        """
+        Send messages of journal which were not written before restart.
+        Should be called before messages of clients are written.
+        """
+        end = self.journal.offset
+        self.replaying = self.journal.replay(end)
+        self.replayed = 0
+        # holds back acknowledges of clients' messages
+        self.replayEnd = [end, False]
+        self.offsets.appendleft(self.replayEnd)
+        self._pull()
+
+    def _pull(self):
+        """
+        Read next replayed messages from journal while there are
+        free connections, so journal is not loaded into memory.
+        """
+        if self.pulling:
+            # writes may be finished synchronously by write below
+            return
+
+        self.pulling = True
+        try:
+            while self.replaying is not None and not self.paused and \
+                        self.writing < self.connection.concurrency:
+                try:
+                    offset, data = self.replaying.next()
+                except StopIteration:
+                    self.replaying = None
+                    log.msg("Replayed %d messages from journal" % \
+                            self.replayed, logLevel=logging.INFO)
+                    self._acknowledge()
+                    break
+
+                self.write(data, offset).addErrback(lambda failure: None)
+                self.replayed += 1
+        finally:
+            self.pulling = False
+
+    def commit(self):
+        """
+        Group commit: write journal to disk, remove written segments.
+        Runs in thread, return Deferred which fires when it's done.
+        Commit is not started while previous one is running.
+        """
+        if self.committing is not None:
+            return self.committing
+
+        def failed(failure):
+            log.msg("Commit of journal failed: %s" % \
+                    failure.getErrorMessage(), logLevel=logging.ERROR)
+
+        def done(ignored):
+            self.committing = None
+
+        deferred = self.committing = self.deferToThread(self._commit)
+        return deferred.addErrback(failed).addCallback(done)
+
+    def _commit(self):
+        self.journal.sync()
+        self.journal.compact()
+
+    def close(self):
+        """
+        Wait for running commit and close journal
+        """
+        deferred = defer.succeed(None)
+        if self.committing is not None:
+            deferred = defer.Deferred()
+            self.committing.addCallback(deferred.callback)
+        return deferred.addCallback(lambda ignored: self.journal.close())
+
+    def pause(self):
+        if not self.paused:
+            self.paused = True
+            for client in self.clients:
+                client.transport.pauseProducing()
+
+    def resume(self):
+        if self.paused and not self.buffer and not self.retrying and \
+                                            not self.connection.isBusy():
+            self.paused = False
+            for client in self.clients:
+                client.transport.resumeProducing()
@@ -11,14 +11,98 @@
 
 
 import os
+import re
 import sys
 
+from apnsexceptions import APNSValueError
+
+try:
+    from json.encoder import c_encode_basestring_ascii
+except ImportError:
+    # without C speedups every string takes the regular path of _quote
+    c_encode_basestring_ascii = lambda value: ''
+
+
+# characters which should be escaped inside of JSON string
+ESCAPE = re.compile(r'[\x00-\x1f\\"]')
+ESCAPE_DCT = {
+    '\\': '\\\\',
+    '"': '\\"',
+    '\b': '\\b',
+    '\f': '\\f',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\t': '\\t',
+}
+for i in range(0x20):
+    ESCAPE_DCT.setdefault(chr(i), '\\u%04x' % i)
+
+
+def _escape(match):
+    return ESCAPE_DCT[match.group(0)]
+
 
 def _doublequote(str):
     """
-    Replace double quotes if it's necessary
+    Escape double quotes, backslashes and control characters
+    if it's necessary
     """
-    return str.replace('"', '\\"')
+    if ESCAPE.search(str) is None:
+        return str
+    return ESCAPE.sub(_escape, str)
+
+
+def _quote(value):
+    """
+    Encode string to JSON string literal. Unicode is encoded to UTF-8
+    as is (without \\uXXXX escapes) to keep payload compact.
+    """
+    # fast path: plain ASCII string without special characters
+    # is returned by C encoder with quotes only
+    try:
+        quoted = c_encode_basestring_ascii(value)
+        if len(quoted) == len(value) + 2:
+            return quoted
+    except UnicodeDecodeError:
+        pass
+
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return '"' + _doublequote(value) + '"'
+
+
+def _encode(value):
+    """
+    Encode value to compact JSON in one pass. Supports strings,
+    numbers, booleans, None, lists, tuples and dicts.
+    """
+    if isinstance(value, (str, unicode)):
+        return _quote(value)
+
+    if value is True:
+        return 'true'
+
+    if value is False:
+        return 'false'
+
+    if value is None:
+        return 'null'
+
+    if isinstance(value, (int, long)):
+        return str(value)
+
+    if isinstance(value, float):
+        return repr(value)
+
+    if isinstance(value, (list, tuple)):
+        return '[' + ",".join([_encode(x) for x in value]) + ']'
+
+    if isinstance(value, dict):
+        return '{' + ",".join([_quote(k) + ':' + _encode(v) \
+                                    for k, v in value.iteritems()]) + '}'
+
+    raise APNSValueError("Unexpected type %s of value to encode "\
+                                    "to JSON" % type(value).__name__)
 
 
 def if_else(condition, a, b):
@@ -0,0 +1,146 @@
+#!/usr/bin/env python2.6
+#
+#  benchmarks.py
+#  wrapper
+#
+#  Rough benchmarks of APNSWrapper internals. Don't need
+#  certificate or network connection, run it as:
+#
+#     python benchmarks.py
+#
+
+import os
+import sys
+import timeit
+
+from APNSWrapper import *
+from APNSWrapper.connection import DummyConnection
+
+
+def deepsize(obj, seen=None):
+    """
+    Approximate count of bytes used by object and all objects
+    referenced by it. Shared objects are counted only once.
+    """
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, (list, tuple, set)):
+        size += sum([deepsize(x, seen) for x in obj])
+    elif isinstance(obj, dict):
+        size += sum([deepsize(k, seen) + deepsize(v, seen) \
+                                        for k, v in obj.iteritems()])
+
+    if hasattr(obj, '__dict__'):
+        size += deepsize(obj.__dict__, seen)
+
+    for name in getattr(obj.__class__, '__slots__', ()):
+        size += deepsize(getattr(obj, name, None), seen)
+
+    return size
+
+
+def notification(i):
+    alert = APNSAlert()
+    alert.body("Very important alert message")
+    alert.loc_key("ALERTMSG")
+
+    message = APNSNotification()
+    message.token(os.urandom(32))
+    message.badge(i % 100)
+    message.sound("default")
+    message.alert(alert)
+    message.appendProperty(APNSProperty("acme", "custom %d" % i))
+    return message
+
+
+def legacy_build(message):
+    """
+    Payload builder of APNSWrapper 0.6, for comparison only
+    """
+    quote = lambda s: s.replace('"', '\\"')
+
+    def alert_build(alert):
+        arguments = []
+        if alert.alertBody:
+            arguments.append('"body":"%s"' % quote(alert.alertBody))
+        if alert.actionLocKey:
+            arguments.append('"action-loc-key":"%s"' % quote(\
+                                                    alert.actionLocKey))
+        if alert.locKey:
+            arguments.append('"loc-key":"%s"' % quote(alert.locKey))
+        return ",".join(arguments)
+
+    def property_build(prop):
+        return '"%s":"%s"' % (prop.name, quote(
+                                    unicode(prop.data).encode("utf-8")))
+
+    keys = []
+    apsKeys = []
+    if message.soundValue:
+        apsKeys.append('"sound":"%s"' % quote(message.soundValue))
+    if message.badgeValue:
+        apsKeys.append('"badge":%d' % int(message.badgeValue))
+    if message.alertObject != None:
+        apsKeys.append('"alert":{%s}' % alert_build(message.alertObject))
+    if len(apsKeys) > 0:
+        keys.append('"aps":{%s}' % ",".join(apsKeys))
+    for prop in message.properties:
+        keys.append(property_build(prop))
+
+    return "{%s}" % ",".join(keys)
+
+
+def encoding(count=100000):
+    """
+    Time of payload building by current and legacy builders
+    """
+    print "Encoding, %d payloads:" % count
+
+    message = notification(1)
+    for name, build in (('legacy', lambda: legacy_build(message)),
+                        ('current', message.build)):
+        seconds = timeit.timeit(build, number=count)
+        print "  %-8s %6.2f us per payload" % (\
+                                        name, seconds * 1000000 / count)
+
+
+def caching(count=100000):
+    """
+    Time of payload building with payload cache of repeated content
+    """
+    print "Caching, %d payloads:" % count
+
+    message = notification(1)
+    message.payloadCache = APNSPayloadCache()
+    seconds = timeit.timeit(message.build, number=count)
+    print "  cached   %6.2f us per payload" % (seconds * 1000000 / count)
+
+
+def memory(count=10000):
+    """
+    Bytes per queued notification with and without compact queue
+    """
+    print "Memory, %d queued notifications:" % count
+
+    for compact in (False, True):
+        wrapper = APNSNotificationWrapper(None, compact=compact, \
+                                        connection=DummyConnection())
+        for i in xrange(count):
+            wrapper.append(notification(i))
+
+        total = deepsize(wrapper.payloads)
+        print "  compact=%-5s %6d bytes per notification" % (\
+                                            compact, total / count)
+
+
+if __name__ == "__main__":
+    memory()
+    encoding()
+    caching()
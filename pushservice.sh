@@ -7,6 +7,16 @@ CERT_PATH=$HOME/cert.pem
 SANDBOX=0
 
 SERVICE=`dirname $0`
+# directory of journal of accepted messages, they are sent again
+# after restart if service was stopped before sending them
+JOURNAL=$SERVICE/journal
+
+# seconds between writes of journal to disk (fsync)
+JOURNAL_SYNC=0.1
+
+# count of connections to APNS
+CONNECTIONS=4
+
 PIDFILE=$SERVICE/apns.pid
 LOGFILE=$SERVICE/logs/push.log
 ENV=$HOME/env
@@ -21,7 +31,7 @@ cd $SERVICE
 case $1 in
 start)
 	echo "Starting APNS Service..."
-	PYTHONPATH=.:.. python $BIN "$CERT_PATH" "$SANDBOX" &> $LOGFILE &
+	PYTHONPATH=.:.. python $BIN "$CERT_PATH" "$SANDBOX" "$JOURNAL" "$CONNECTIONS" "$JOURNAL_SYNC" &> $LOGFILE &
 	PID_NUM=$!
 	echo $PID_NUM > $PIDFILE
 	echo "Done."